@@ -0,0 +1,62 @@
+"""
+repair_json 解析基准
+
+对语料中的每条模型输出分别运行 快速路径 + 回退 (try_parse_json_object) 与仅回退
+(try_parse_json_object_fallback)，统计解析耗时与成功率（返回非空 dict 即为成功）。
+
+语料为 JSONL，每行包含 source（模型）、defect（输出问题类型）、text（原始输出），
+可以把线上采集到的 GLM / Qwen 输出追加到语料中。
+
+    python benchmarks/bench_repair_json.py [--corpus benchmarks/repair_json_corpus.jsonl] [--repeat 200]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from shiertier_caption.repair_json import try_parse_json_object, try_parse_json_object_fallback  # noqa: E402
+
+
+def bench(func, text: str, repeat: int) -> tuple[float, bool]:
+    ok = False
+    start = time.perf_counter()
+    for _ in range(repeat):
+        try:
+            _, result = func(text)
+            ok = isinstance(result, dict) and bool(result)
+        except Exception:
+            ok = False
+    return (time.perf_counter() - start) / repeat, ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "repair_json_corpus.jsonl"))
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    with open(args.corpus, encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+
+    print(f"{'defect':<24}{'bytes':>8}{'fast us':>12}{'ok':>4}{'fallback us':>14}{'ok':>4}")
+    totals = {"fast": [0.0, 0], "fallback": [0.0, 0]}
+    for case in cases:
+        fast_time, fast_ok = bench(try_parse_json_object, case["text"], args.repeat)
+        slow_time, slow_ok = bench(try_parse_json_object_fallback, case["text"], args.repeat)
+        totals["fast"][0] += fast_time
+        totals["fast"][1] += fast_ok
+        totals["fallback"][0] += slow_time
+        totals["fallback"][1] += slow_ok
+        print(f"{case['defect']:<24}{len(case['text'].encode()):>8}{fast_time * 1e6:>12.1f}{'Y' if fast_ok else 'N':>4}"
+              f"{slow_time * 1e6:>14.1f}{'Y' if slow_ok else 'N':>4}")
+    for name, (total, ok) in totals.items():
+        print(f"{name}: mean {total / len(cases) * 1e6:.1f} us, success {ok}/{len(cases)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+启动基准：测量导入耗时、首个请求的耗时与连接数，比较每个密钥独立连接池与共用连接池
+
+短生命周期的工作进程（命令行的多进程、定时任务）每次启动都要付出导入与建立连接的开销。
+每个组合在新的子进程中运行：先测量 import shiertier_caption 与首次访问 MultiGLM4V（导入 openai）的耗时，
+再对本地替身服务发出第一个请求，最后并发处理 --images 张图片，统计替身服务上新建的 TCP 连接数。
+
+模式：
+    per-key   每个密钥一个独立的 HttpPool（相当于每个密钥各自的 httpx 客户端）
+    shared    MultiGLM4V 默认行为，所有密钥共用一个按 max_workers 设置大小的 HttpPool
+
+    python benchmarks/bench_startup.py [--keys 32] [--workers 64] [--images 256] [--latency fixed:0.05]
+        [--json results.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib.request
+
+from bench_throughput import SRC, make_images, start_mock
+
+MODES = ("per-key", "shared")
+
+
+def mock_counts(url: str) -> dict:
+    with urllib.request.urlopen(url + "/stats") as response:
+        return json.load(response)
+
+
+def run_mode(mode: str, url: str, keys: int, workers: int, images: int) -> dict:
+    """在新的子进程中运行，导入耗时不受之前组合的影响"""
+    sys.path.insert(0, SRC)
+    start = time.perf_counter()
+    import shiertier_caption
+    import_seconds = time.perf_counter() - start
+    providers_loaded = sorted(name for name in ("zhipuai", "openai") if name in sys.modules)
+
+    start = time.perf_counter()
+    MultiGLM4V = shiertier_caption.MultiGLM4V
+    provider_import_seconds = time.perf_counter() - start
+
+    import shiertier_caption.glm4v as glm4v
+    from shiertier_caption import GLM4V, HttpPool, KeyPool
+    from shiertier_caption.aio import run_sync
+
+    glm4v.GLM_BASE_URL = url + "/api/paas/v4/"
+    api_keys = [f"bench-key-{i:04d}" for i in range(keys)]
+    if mode == "per-key":
+        client = MultiGLM4V(None, max_workers=workers,
+                            key_pool=KeyPool([GLM4V(key, http_pool=HttpPool()) for key in api_keys]))
+    else:
+        client = MultiGLM4V(api_keys, max_workers=workers)
+
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    try:
+        paths = make_images(workdir, images + 1, 16)
+        connections = mock_counts(url)["connections"]
+        start = time.perf_counter()
+        run_sync(client.arequest(paths[0]))
+        first_request_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        client.prompt_images(paths[1:])
+        elapsed = time.perf_counter() - start
+        connections = mock_counts(url)["connections"] - connections
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "mode": mode,
+        "import_ms": round(import_seconds * 1000, 1),
+        "provider_import_ms": round(provider_import_seconds * 1000, 1),
+        "loaded_on_import": providers_loaded,
+        "first_request_ms": round(first_request_seconds * 1000, 1),
+        "images_per_second": round(images / elapsed, 2),
+        "connections": connections,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--keys", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--images", type=int, default=256)
+    parser.add_argument("--latency", default="fixed:0.05")
+    parser.add_argument("--json", default=None, help="把结果写入该 JSON 文件，便于比较改动前后")
+    args = parser.parse_args()
+    # start_mock 使用的其余参数：不注入错误与损坏 JSON
+    args.malformed, args.errors, args.seed = 0.0, "", 0
+
+    process, url = start_mock(args)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    print(f"{'mode':<10}{'import ms':>11}{'provider ms':>13}{'first ms':>10}{'img/s':>9}{'conns':>7}  loaded on import")
+    try:
+        for mode in [m for m in args.modes.split(",") if m]:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_mode, (mode, url, args.keys, args.workers, args.images))
+            results.append(result)
+            print(f"{mode:<10}{result['import_ms']:>11.1f}{result['provider_import_ms']:>13.1f}"
+                  f"{result['first_request_ms']:>10.1f}{result['images_per_second']:>9.1f}{result['connections']:>7}"
+                  f"  {result['loaded_on_import']}", flush=True)
+    finally:
+        process.terminate()
+        process.wait()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+吞吐基准：在本地替身服务上测量各处理入口的扩展性，不消耗真实额度
+
+启动 mock_server.py 子进程模拟智谱 / 硅基流动接口，对每个 场景 x 并发数 x 图片大小 的组合
+在独立的子进程中运行一次，统计 图片/秒、单次请求耗时的 p50 / p99、峰值 RSS 与每张图片的 CPU 时间。
+
+场景：
+    glm-images    MultiGLM4V.prompt_images
+    glm-folder    MultiGLM4V.prompt_folder（return_results=False）
+    glm-mongo     MultiGLM4V_Mongo.prompt_images，需要 --mongo-url；
+                  任务写入 art.caption，_id 以 bench- 开头，结束后删除。mongomock:// 表示使用 mongomock
+    silicon-flow  SiliconFlow.prompt，由 --workers 个线程并发调用
+
+图片为指定大小的随机字节，替身服务不解码图片，只模拟上传与响应。
+
+    python benchmarks/bench_throughput.py [--scenarios glm-images,glm-folder,silicon-flow]
+        [--workers 16,64,256] [--image-kb 64,1024] [--images 500]
+        [--latency lognormal:0.8,0.5] [--malformed 0.05] [--errors 1305:0.02,1301:0.01,429:0.01]
+        [--mongo-url mongomock://] [--json results.json]
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+SCENARIOS = ("glm-images", "glm-folder", "glm-mongo", "silicon-flow")
+KEYS = 32
+
+
+def make_images(folder: str, count: int, image_kb: int) -> list[str]:
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f"bench-{i}.jpg")
+        with open(path, "wb") as f:
+            f.write(os.urandom(image_kb * 1024))
+        paths.append(path)
+    return paths
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_mongo(keys: list[str], workers: int, folder: str, count: int, mongo_url: str):
+    from shiertier_caption import LocalDirFetcher, MultiGLM4V_Mongo
+
+    if mongo_url.startswith("mongomock://"):
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        mongo_url = "mongodb://localhost:27017"
+    client = MultiGLM4V_Mongo(keys, mongo_url, max_workers=workers, fetcher=LocalDirFetcher(folder))
+    ids = [f"bench-{i}" for i in range(count)]
+    client.caption_collection.delete_many({"_id": {"$in": ids}})
+    client.caption_collection.insert_many([{"_id": task_id, "status": 0} for task_id in ids])
+    try:
+        while True:
+            client.prompt_images()
+            if not client.tasks:
+                break
+    finally:
+        client.close()
+        client.caption_collection.delete_many({"_id": {"$in": ids}})
+
+
+def run_silicon_flow(keys: list[str], workers: int, paths: list[str], url: str):
+    from openai import OpenAI
+    from shiertier_caption import SiliconFlow
+
+    client = SiliconFlow(keys[0])
+    client.base_url = url + "/v1"
+    client.client = OpenAI(api_key=client.api_key, base_url=client.base_url, http_client=client.http_pool.sync_client(client._http_slot),
+                           max_retries=0)
+
+    def prompt(path: str):
+        try:
+            return client.prompt(path)
+        except Exception:
+            # 注入的 1301 / 429 错误由调用方处理，这里只计入追踪
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(prompt, paths))
+
+
+def run_scenario(scenario: str, url: str, workers: int, image_kb: int, images: int,
+                 mongo_url: str | None) -> dict:
+    """在子进程中运行单个组合，峰值 RSS 与 CPU 时间只统计该组合"""
+    sys.path.insert(0, SRC)
+    import shiertier_caption.glm4v as glm4v
+    from shiertier_caption import MultiGLM4V, enable_metrics
+
+    glm4v.GLM_BASE_URL = url + "/api/paas/v4/"
+    workdir = tempfile.mkdtemp(prefix="bench-throughput-")
+    folder = os.path.join(workdir, "images")
+    paths = make_images(folder, images, image_kb)
+    trace_path = os.path.join(workdir, "trace.jsonl")
+    metrics = enable_metrics(trace_path=trace_path)
+    keys = [f"bench-key-{i:04d}" for i in range(KEYS)]
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    try:
+        if scenario == "glm-images":
+            MultiGLM4V(keys, max_workers=workers).prompt_images(paths)
+        elif scenario == "glm-folder":
+            MultiGLM4V(keys, max_workers=workers).prompt_folder(folder, return_results=False)
+        elif scenario == "glm-mongo":
+            run_mongo(keys, workers, folder, images, mongo_url)
+        elif scenario == "silicon-flow":
+            run_silicon_flow(keys, workers, paths, url)
+        else:
+            raise ValueError(f"scenario must be one of {SCENARIOS}")
+        elapsed = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        metrics.close()
+
+        outcomes = {}
+        latencies = []
+        with open(trace_path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+                if record["outcome"] == "ok":
+                    latencies.append(record["latency"])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return {
+        "scenario": scenario,
+        "workers": workers,
+        "image_kb": image_kb,
+        "images": images,
+        "seconds": round(elapsed, 3),
+        "images_per_second": round(images / elapsed, 2),
+        "p50": round(percentile(latencies, 0.5), 3),
+        "p99": round(percentile(latencies, 0.99), 3),
+        "peak_rss_mb": round(after.ru_maxrss / 1024, 1),
+        "cpu_ms_per_image": round(cpu / images * 1000, 2),
+        "outcomes": outcomes,
+    }
+
+
+def start_mock(args) -> tuple[subprocess.Popen, str]:
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "mock_server.py"), "--port", "0", "--latency", args.latency,
+         "--malformed", str(args.malformed), "--errors", args.errors, "--seed", str(args.seed)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    return process, process.stdout.readline().strip()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default="glm-images,glm-folder,silicon-flow")
+    parser.add_argument("--workers", default="16,64,256")
+    parser.add_argument("--image-kb", default="64,1024")
+    parser.add_argument("--images", type=int, default=500)
+    parser.add_argument("--latency", default="lognormal:0.8,0.5")
+    parser.add_argument("--malformed", type=float, default=0.05)
+    parser.add_argument("--errors", default="1305:0.02,1301:0.01,429:0.01")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo-url", default=None)
+    parser.add_argument("--json", default=None, help="把结果写入该 JSON 文件，便于比较改动前后")
+    args = parser.parse_args()
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    if "glm-mongo" in scenarios and not args.mongo_url:
+        parser.error("glm-mongo needs --mongo-url")
+    workers = [int(x) for x in args.workers.split(",")]
+    sizes = [int(x) for x in args.image_kb.split(",")]
+
+    process, url = start_mock(args)
+    # 每个组合使用新的子进程，避免峰值 RSS 与已加载模块在组合之间累积
+    context = multiprocessing.get_context("spawn")
+    results = []
+    print(f"{'scenario':<14}{'workers':>8}{'kb':>6}{'img/s':>9}{'p50':>8}{'p99':>8}{'rss MB':>9}{'cpu ms':>9}  outcomes")
+    try:
+        for scenario in scenarios:
+            for size in sizes:
+                for worker_count in workers:
+                    with context.Pool(1) as pool:
+                        result = pool.apply(run_scenario, (scenario, url, worker_count, size, args.images, args.mongo_url))
+                    results.append(result)
+                    print(f"{scenario:<14}{worker_count:>8}{size:>6}{result['images_per_second']:>9.1f}"
+                          f"{result['p50']:>8.3f}{result['p99']:>8.3f}{result['peak_rss_mb']:>9.1f}"
+                          f"{result['cpu_ms_per_image']:>9.2f}  {result['outcomes']}", flush=True)
+    finally:
+        process.terminate()
+        process.wait()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+智谱 / 硅基流动 chat.completions 接口的本地替身，用于离线基准测试
+
+接受任意以 chat/completions 结尾的 POST 请求（智谱 /api/paas/v4/chat/completions，
+硅基流动 /v1/chat/completions），按配置的分布延迟后返回描述 JSON，或注入错误：
+1301（敏感内容，400）、1305（服务过载，429）、429（OpenAI 兼容接口的限流）。
+一部分成功响应会返回格式损坏的 JSON（尾随逗号、被截断、夹杂说明文字），用于覆盖 repair_json。
+
+同时提供 Batch API 所需的 files / batches 接口：上传的 batch 文件在 --batch-delay 秒后完成，
+每行请求按同样的错误与损坏比例生成结果。
+
+    python benchmarks/mock_server.py [--port 0] [--latency lognormal:0.8,0.5] [--malformed 0.05]
+                                     [--errors 1305:0.02,1301:0.01,429:0.01] [--batch-delay 5] [--seed 0]
+
+启动后在标准输出的第一行打印监听地址。
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CAPTION = {
+    "regular": "A cat sitting on a wooden windowsill, looking out at a rainy street.",
+    "midjoury": ["cat on windowsill", "rain streaked glass", "soft grey daylight"],
+    "structural": ["foreground: cat", "background: street", "lighting: overcast"],
+    "middle": {"subject": {"animal": "cat"}, "setting": {"place": "window"}},
+    "creation": ["photograph a cat at a window", "shoot on a rainy day"],
+    "deviantart request": "A cosy photo of a cat watching the rain from a windowsill.",
+}
+
+ERRORS = {
+    "1301": (400, "系统检测到输入或生成内容可能包含不安全或敏感内容"),
+    "1305": (429, "当前API请求过多，请稍后重试"),
+    "429": (429, "Rate limit reached for requests"),
+}
+
+
+def parse_latency(spec: str):
+    """解析延迟分布：fixed:秒、uniform:下限,上限、lognormal:中位数,sigma"""
+    kind, _, args = spec.partition(":")
+    values = [float(x) for x in args.split(",") if x]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+def parse_errors(spec: str) -> list[tuple[str, float]]:
+    errors = []
+    for item in filter(None, spec.split(",")):
+        code, _, rate = item.partition(":")
+        if code not in ERRORS:
+            raise ValueError(f"error code must be one of {list(ERRORS)}")
+        errors.append((code, float(rate)))
+    return errors
+
+
+def malformed_caption() -> str:
+    text = json.dumps(CAPTION, ensure_ascii=False)
+    return random.choice([
+        text[:-1] + ",}",  # 尾随逗号
+        text[: len(text) * 2 // 3],  # 输出被截断
+        "好的，以下是描述：\n" + text + "\n希望对你有帮助。",  # 夹杂说明文字
+        text.replace('"', "'"),  # 单引号
+    ])
+
+
+class MockState:
+    def __init__(self, latency, malformed: float, errors: list[tuple[str, float]], batch_delay: float = 5.0):
+        self.latency = latency
+        self.malformed = malformed
+        self.errors = errors
+        self.batch_delay = batch_delay
+        self.lock = threading.Lock()
+        self.counts = {"connections": 0, "requests": 0, "ok": 0, "malformed": 0, **{code: 0 for code in ERRORS}}
+        self.files = {}
+        self.batches = {}
+        self.ids = itertools.count(1)
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}-{next(self.ids)}"
+
+    def pick_error(self):
+        roll = random.random()
+        for code, rate in self.errors:
+            if roll < rate:
+                return code
+            roll -= rate
+        return None
+
+    def complete(self, model: str, prompt_bytes: int) -> tuple[int, dict]:
+        """生成一次 chat.completions 的响应：(状态码, 响应体)"""
+        self.count("requests")
+        code = self.pick_error()
+        if code:
+            self.count(code)
+            status, message = ERRORS[code]
+            return status, {"error": {"code": code, "message": message}}
+        if random.random() < self.malformed:
+            self.count("malformed")
+            content = malformed_caption()
+        else:
+            self.count("ok")
+            content = "```json\n" + json.dumps(CAPTION, ensure_ascii=False) + "\n```"
+        prompt_tokens = prompt_bytes // 4
+        completion_tokens = len(content) // 2
+        return 200, {
+            "id": "mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def run_batch(self, batch: dict):
+        # 延迟 batch_delay 秒后逐行生成结果，成功与失败分别写入 output / error 文件
+        time.sleep(self.batch_delay)
+        output, errors = [], []
+        for line in self.files[batch["input_file_id"]]["content"].splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            status, body = self.complete(request["body"].get("model", "mock"), len(line))
+            record = {"id": self.new_id("req"), "custom_id": request["custom_id"],
+                      "response": {"status_code": status, "request_id": "mock", "body": body}, "error": None}
+            (output if status == 200 else errors).append(json.dumps(record, ensure_ascii=False))
+        with self.lock:
+            for name, lines in (("output_file_id", output), ("error_file_id", errors)):
+                if lines:
+                    file_id = self.new_id("file")
+                    self.files[file_id] = {"content": ("\n".join(lines) + "\n").encode(), "filename": f"{name}.jsonl"}
+                    batch[name] = file_id
+            batch["status"] = "completed"
+            batch["completed_at"] = int(time.time())
+            batch["request_counts"] = {"total": len(output) + len(errors), "completed": len(output),
+                                       "failed": len(errors)}
+
+
+def parse_multipart(content_type: str, body: bytes) -> dict:
+    message = BytesParser(policy=default_policy).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        fields[name] = (part.get_filename(), part.get_payload(decode=True))
+    return fields
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # 保持连接，和真实接口一样复用连接
+
+        def setup(self):
+            # 每个新的 TCP 连接调用一次，用于比较连接复用
+            super().setup()
+            state.count("connections")
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            path = self.path.rstrip("/")
+            if path.endswith("chat/completions"):
+                threading.Event().wait(max(0.0, state.latency()))
+                try:
+                    model = json.loads(body).get("model", "mock")
+                except ValueError:
+                    model = "mock"
+                return self.reply(*state.complete(model, len(body)))
+            if path.endswith("/files"):
+                fields = parse_multipart(self.headers["Content-Type"], body)
+                filename, content = fields["file"]
+                file_id = state.new_id("file")
+                with state.lock:
+                    state.files[file_id] = {"content": content, "filename": filename}
+                return self.reply(200, {"id": file_id, "object": "file", "bytes": len(content),
+                                        "created_at": int(time.time()), "filename": filename, "purpose": "batch",
+                                        "status": "processed"})
+            if path.endswith("/batches"):
+                request = json.loads(body)
+                if request.get("input_file_id") not in state.files:
+                    return self.reply(404, {"error": {"code": "404", "message": "input file not found"}})
+                batch = {"id": state.new_id("batch"), "object": "batch", "endpoint": request.get("endpoint"),
+                         "input_file_id": request["input_file_id"],
+                         "completion_window": request.get("completion_window", "24h"), "status": "in_progress",
+                         "output_file_id": None, "error_file_id": None, "created_at": int(time.time()),
+                         "metadata": request.get("metadata"),
+                         "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+                with state.lock:
+                    state.batches[batch["id"]] = batch
+                threading.Thread(target=state.run_batch, args=(batch,), daemon=True).start()
+                return self.reply(200, batch)
+            self.reply(404, {"error": {"code": "404", "message": "not found"}})
+
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            match = re.search(r"/batches/([^/]+)$", path)
+            if match:
+                with state.lock:
+                    batch = state.batches.get(match.group(1))
+                    batch = dict(batch) if batch else None
+                if batch is None:
+                    return self.reply(404, {"error": {"code": "404", "message": "batch not found"}})
+                return self.reply(200, batch)
+            match = re.search(r"/files/([^/]+)/content$", path)
+            if match:
+                file = state.files.get(match.group(1))
+                if file is None:
+                    return self.reply(404, {"error": {"code": "404", "message": "file not found"}})
+                return self.reply_bytes(200, file["content"], "application/octet-stream")
+            # 其余路径（例如 /stats）返回各类响应的计数
+            with state.lock:
+                self.reply(200, dict(state.counts))
+
+        def reply(self, status: int, payload: dict):
+            self.reply_bytes(status, json.dumps(payload, ensure_ascii=False).encode(), "application/json")
+
+        def reply_bytes(self, status: int, out: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096  # 默认的 5 在高并发下会导致连接被拒绝
+
+
+def start(port: int = 0, latency: str = "fixed:0.05", malformed: float = 0.0, errors: str = "",
+          host: str = "127.0.0.1", batch_delay: float = 5.0) -> tuple[MockServer, str]:
+    """在后台线程中启动替身服务，返回 (服务, 根地址)"""
+    state = MockState(parse_latency(latency), malformed, parse_errors(errors), batch_delay)
+    server = MockServer((host, port), make_handler(state))
+    server.state = state
+    threading.Thread(target=server.serve_forever, name="mock-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", default="lognormal:0.8,0.5", help="fixed:s | uniform:a,b | lognormal:median,sigma")
+    parser.add_argument("--malformed", type=float, default=0.05, help="返回损坏 JSON 的比例")
+    parser.add_argument("--errors", default="1305:0.02,1301:0.01,429:0.01", help="错误码:比例，逗号分隔")
+    parser.add_argument("--batch-delay", type=float, default=5.0, help="batch 任务从提交到完成的秒数")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    server, url = start(args.port, args.latency, args.malformed, args.errors, args.host, args.batch_delay)
+    print(url, flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        json.dump(server.state.counts, sys.stderr)
+        print(file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,59 @@
-from .glm4v import *
-from .silicon_flow import *
+import importlib
+import importlib.util
+from .key_pool import KeyPool
+from .concurrency import AIMDLimit, AdaptiveConcurrency
+from .hedging import HedgePolicy
+from .transport import HttpPool
+from .cache import CaptionCache
+from .preprocess import ImagePreprocessor
+from .mongo_writer import BulkWriter
+from .mongo_queue import TaskQueue
+from .fetcher import PicFetcher, HfPicsFetcher, LocalDirFetcher
+from .provider import CaptionProvider, RepairOverloaded
+from .router import Router
+from .metrics import metrics, enable_metrics
+from .manifest import Manifest
+from .batch import BatchRunner
+from .sinks import Sink, JsonFileSink, JsonlSink, ParquetSink
+
+# 服务商模块会导入 zhipuai / openai，首次访问时才导入，只用其中一个服务商时不加载另一个；
+# 近似重复检测依赖 numpy，同样按需导入
+_LAZY = {
+    "GLM4V": "glm4v",
+    "AsyncMultiGLM4V": "glm4v",
+    "MultiGLM4V": "glm4v",
+    "MultiGLM4V_Mongo": "glm4v",
+    "GLM_BASE_URL": "glm4v",
+    "get_api_keys": "glm4v",
+    "convert_str_to_list": "glm4v",
+    "SiliconFlow": "silicon_flow",
+    "encode_image": "silicon_flow",
+    "image_content": "silicon_flow",
+    "NearDuplicateCache": "dedup",
+    "HammingIndex": "dedup",
+    "dhash_file": "dedup",
+}
+# 可选依赖（pip install shiertier_caption[dedup]）未安装时不放进 __all__，否则 import * 会失败
+_OPTIONAL = {"dedup": "numpy"}
+
+__all__ = [
+    "KeyPool", "AIMDLimit", "AdaptiveConcurrency", "HedgePolicy", "HttpPool", "CaptionCache", "ImagePreprocessor", "BulkWriter",
+    "TaskQueue", "PicFetcher", "HfPicsFetcher", "LocalDirFetcher", "CaptionProvider", "RepairOverloaded", "Router", "metrics",
+    "enable_metrics", "Manifest", "BatchRunner", "Sink", "JsonFileSink", "JsonlSink", "ParquetSink",
+    *(name for name, module in _LAZY.items()
+      if module not in _OPTIONAL or importlib.util.find_spec(_OPTIONAL[module]) is not None),
+]
+
+
+def __getattr__(name: str):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with metrics.timer("caption_import_seconds", module=module):
+        value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
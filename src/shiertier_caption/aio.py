@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Coroutine, Optional
+
+log = logging.getLogger(__name__)
+
+# 事件循环 -> 循环结束前需要调用的协程函数
+_loop_callbacks = weakref.WeakKeyDictionary()
+_callbacks_lock = threading.Lock()
+
+
+def on_loop_close(callback: Callable[[], Awaitable]):
+    """
+    登记当前事件循环结束前需要调用的协程函数，例如关闭绑定该循环的 httpx.AsyncClient
+
+    run_sync 在协程结束后、事件循环关闭前依次调用；自行用 asyncio.run 运行时需要在最后调用 aclose_loop_resources。
+    """
+    loop = asyncio.get_running_loop()
+    with _callbacks_lock:
+        _loop_callbacks.setdefault(loop, []).append(callback)
+
+
+async def aclose_loop_resources():
+    """调用当前事件循环上登记的 on_loop_close 回调"""
+    loop = asyncio.get_running_loop()
+    with _callbacks_lock:
+        callbacks = _loop_callbacks.pop(loop, [])
+    for callback in callbacks:
+        try:
+            await callback()
+        except Exception:
+            log.exception("loop close callback failed")
+
+
+async def _run_and_cleanup(coro: Coroutine) -> Any:
+    try:
+        return await coro
+    finally:
+        await aclose_loop_resources()
+
+
+def run_sync(coro: Coroutine) -> Any:
+    """
+    在同步代码中运行协程
+
+    普通脚本中直接使用 asyncio.run；如果当前线程已经有正在运行的事件循环
+    （例如 Jupyter / Kaggle Notebook），则在新线程中开启独立的事件循环运行，
+    避免 "asyncio.run() cannot be called from a running event loop"。
+    协程结束后关闭 on_loop_close 登记的资源，每次调用新建的事件循环不会留下未关闭的连接。
+
+    Args:
+        coro (Coroutine): 需要运行的协程
+
+    Returns:
+        Any: 协程的返回值
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_run_and_cleanup(coro))
+
+    result = {}
+
+    def runner():
+        try:
+            result["value"] = asyncio.run(_run_and_cleanup(coro))
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=runner, daemon=True)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+class LoopLocal:
+    """
+    按事件循环缓存对象
+
+    asyncio.Semaphore、httpx.AsyncClient 等对象会绑定到首次使用它们的事件循环，
+    同步包装器每次调用都会新建事件循环，因此需要按循环分别创建。
+    多个线程各自运行事件循环时每个循环有自己的对象，互不覆盖；
+    循环结束时（见 on_loop_close）丢弃该循环的对象，传入 close 时先用它关闭对象。
+    """
+
+    def __init__(self, factory: Callable[[], Any], close: Optional[Callable[[Any], Awaitable]] = None):
+        self.factory = factory
+        self.close = close
+        self._values = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop in self._values:
+                return self._values[loop]
+        # 同一个循环的调用都在同一个线程中，创建对象时不需要持有锁
+        value = self.factory()
+        with self._lock:
+            self._values[loop] = value
+        on_loop_close(self._close_loop)
+        return value
+
+    def pop(self):
+        """取出当前事件循环上的对象，之后 get 重新创建；当前循环上还没有创建时返回 None"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            return self._values.pop(loop, None)
+
+    async def _close_loop(self):
+        value = self.pop()
+        if value is not None and self.close is not None:
+            await self.close(value)
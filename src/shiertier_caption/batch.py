@@ -0,0 +1,293 @@
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List
+try:
+    from .key_pool import mask_key
+    from .provider import CaptionProvider, parse_caption
+except:
+    from key_pool import mask_key
+    from provider import CaptionProvider, parse_caption
+
+log = logging.getLogger(__name__)
+
+# 服务商 batch 的终止状态；本地额外使用 packed（已打包）、uploaded（已上传）、collected（结果已交付）、
+# orphaned（所属密钥不在 clients 中，无法继续，图片已记为失败）
+TERMINAL = ("completed", "failed", "expired", "cancelled")
+FINISHED = ("collected", "orphaned")
+
+
+def parse_batch_line(record: dict, model: str = "") -> dict:
+    # batch 结果文件中的一行转换为与 caption 相同格式的结果
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    if response.get("status_code") == 200 and body.get("choices"):
+        return parse_caption(body["choices"][0]["message"]["content"], model)
+    error = json.dumps([record.get("error"), body.get("error")], ensure_ascii=False)
+    if "1301" in error:
+        return {"nsfw": True}
+    return {"error": True}
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        clients: List[CaptionProvider],
+        on_result: Callable[[str, dict], object],
+        work_dir: str = "caption_batches",
+        max_requests: int = 1000,
+        max_bytes: int = 90 * 1024 * 1024,
+        poll_interval: float = 60.0,
+        completion_window: str = "24h",
+        encode_workers: int = 8,
+    ):
+        """
+        通过服务商的 Batch API 离线处理大量图片，不需要实时结果时配额更高、单价更低
+
+        图片编码后与默认提示词一起打包为 JSONL batch 文件，按密钥轮流上传并创建 batch，
+        轮询状态，完成后逐行读取结果文件，经 repair_json 解析后交给 on_result。
+        所有 batch 的状态保存在 work_dir 中的 SQLite 文件里，中断后重新运行会继续上传、轮询与收取，
+        已经打包过的图片不会重复打包。
+
+        Args:
+            clients (list): 模型客户端，例如 GLM4V / SiliconFlow 实例，batch 按顺序轮流使用各个密钥
+            on_result (callable): 每张图片的结果回调 on_result(image_path, result)
+            work_dir (str): batch 文件与状态的保存目录
+            max_requests (int): 单个 batch 文件的最大请求数
+            max_bytes (int): 单个 batch 文件的最大字节数
+            poll_interval (float): 轮询 batch 状态的间隔（秒）
+            completion_window (str): batch 的完成时限
+            encode_workers (int): 打包时编码图片的线程数
+        """
+        if not clients:
+            raise ValueError("clients must not be empty")
+        self.clients = {mask_key(client.api_key): client for client in clients}
+        self.on_result = on_result
+        self.work_dir = work_dir
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.encode_workers = encode_workers
+        self._lock = threading.Lock()
+        os.makedirs(work_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(work_dir, "batches.sqlite3"), check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            "name TEXT PRIMARY KEY, key TEXT NOT NULL, status TEXT NOT NULL, requests INTEGER NOT NULL, "
+            "input_file_id TEXT, batch_id TEXT, output_file_id TEXT, error_file_id TEXT, updated REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS items (custom_id TEXT PRIMARY KEY, batch TEXT NOT NULL, path TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS items_path ON items (path)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS items_batch ON items (batch)")
+
+    def _update(self, name: str, **fields):
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE batches SET {columns}, updated = ? WHERE name = ?",
+                               (*fields.values(), time.time(), name))
+
+    def _select(self, where: str, params: tuple = ()) -> List[dict]:
+        with self._lock:
+            cursor = self._conn.execute(f"SELECT * FROM batches WHERE {where} ORDER BY name", params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _batches(self, *statuses: str) -> List[dict]:
+        return self._select(f"status IN ({', '.join('?' * len(statuses))})", statuses)
+
+    def is_packed(self, image_path: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM items WHERE path = ? LIMIT 1", (image_path,)).fetchone() is not None
+
+    def pack(self, image_paths: Iterable[str]) -> List[str]:
+        """把尚未打包的图片写入 batch 文件，返回新建的 batch 名称"""
+        with self._lock:
+            index = self._conn.execute("SELECT COUNT(*) FROM batches").fetchone()[0]
+        keys = list(self.clients)
+        paths = (path for path in image_paths if not self.is_packed(path))
+        names = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.encode_workers) as executor:
+            encoded = self._encode_all(paths, executor)
+            carry = []
+            while True:
+                name = f"batch-{index:05d}"
+                key = keys[index % len(keys)]
+                items, carry = self._write_batch(name, self.clients[key], itertools.chain(carry, encoded))
+                if not items:
+                    break
+                with self._lock:
+                    self._conn.execute("BEGIN")
+                    self._conn.executemany("INSERT OR REPLACE INTO items (custom_id, batch, path) VALUES (?, ?, ?)",
+                                           [(custom_id, name, path) for custom_id, path in items])
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO batches (name, key, status, requests, updated) VALUES (?, ?, 'packed', ?, ?)",
+                        (name, key, len(items), time.time()))
+                    self._conn.execute("COMMIT")
+                names.append(name)
+                index += 1
+        return names
+
+    def _encode_all(self, paths: Iterator[str], executor: concurrent.futures.Executor) -> Iterator[tuple]:
+        # 编码与服务商无关，按块并行；编码失败的图片直接记为失败
+        client = next(iter(self.clients.values()))
+        while True:
+            chunk = list(islice(paths, self.encode_workers * 4))
+            if not chunk:
+                return
+            for path, encoded in zip(chunk, executor.map(self._encode, [client] * len(chunk), chunk)):
+                if encoded is None:
+                    self.on_result(path, {"error": True})
+                else:
+                    yield path, encoded
+
+    def _write_batch(self, name: str, client: CaptionProvider, encoded: Iterator[tuple]) -> tuple[List[tuple], list]:
+        # 写满 max_requests 条或再写一行会超过 max_bytes 时换下一个文件，放不下的一条留给下一个文件
+        path = os.path.join(self.work_dir, f"{name}.jsonl")
+        items = []
+        size = 0
+        with open(path, "w", encoding="utf-8") as f:
+            for image_path, image in encoded:
+                custom_id = f"{name}-{len(items):06d}"
+                line = json.dumps({"custom_id": custom_id, "method": "POST", "url": client.batch_endpoint,
+                                   "body": client.batch_body(image_path, image)}, ensure_ascii=False) + "\n"
+                if items and (len(items) >= self.max_requests or size + len(line) > self.max_bytes):
+                    return items, [(image_path, image)]
+                f.write(line)
+                size += len(line)
+                items.append((custom_id, image_path))
+        if not items:
+            os.remove(path)
+        return items, []
+
+    @staticmethod
+    def _encode(client: CaptionProvider, path: str):
+        try:
+            return client.encode_image(path)
+        except Exception as e:
+            log.warning("failed to encode %s: %r", path, e)
+            return None
+
+    def submit(self) -> int:
+        """上传已打包的 batch 文件并创建 batch，返回创建的数量"""
+        count = 0
+        for batch in self._batches("packed", "uploaded"):
+            client = self.clients.get(batch["key"])
+            if client is None:
+                self._orphan(batch)
+                continue
+            input_file_id = batch["input_file_id"]
+            if input_file_id is None:
+                with open(os.path.join(self.work_dir, f"{batch['name']}.jsonl"), "rb") as f:
+                    input_file_id = client.client.files.create(file=f, purpose="batch").id
+                # 先记录文件 id，创建 batch 失败时重新运行不会重复上传
+                self._update(batch["name"], status="uploaded", input_file_id=input_file_id)
+            job = client.client.batches.create(input_file_id=input_file_id, endpoint=client.batch_endpoint,
+                                               completion_window=self.completion_window,
+                                               metadata={"name": batch["name"]})
+            self._update(batch["name"], status=job.status, batch_id=job.id)
+            count += 1
+        return count
+
+    def poll(self) -> dict:
+        """查询所有进行中的 batch，收取已结束的 batch，返回各状态的 batch 数量"""
+        local = TERMINAL + FINISHED + ("packed", "uploaded")
+        for batch in self._select(f"status NOT IN ({', '.join('?' * len(local))})", local):
+            client = self.clients.get(batch["key"])
+            if client is None:
+                self._orphan(batch)
+                continue
+            job = client.client.batches.retrieve(batch["batch_id"])
+            self._update(batch["name"], status=job.status, output_file_id=job.output_file_id,
+                         error_file_id=job.error_file_id)
+        for batch in self._batches(*TERMINAL):
+            self.collect(batch["name"])
+        return self.stats()
+
+    def collect(self, name: str) -> int:
+        """下载已结束 batch 的结果文件并逐行交给 on_result，没有结果的图片记为失败，返回结果数"""
+        batches = self._select("name = ?", (name,))
+        if not batches or batches[0]["status"] not in TERMINAL:
+            return 0
+        batch = batches[0]
+        client = self.clients.get(batch["key"])
+        if client is None:
+            self._orphan(batch)
+            return 0
+        with self._lock:
+            pending = dict(self._conn.execute("SELECT custom_id, path FROM items WHERE batch = ?", (name,)).fetchall())
+        count = 0
+        for kind in ("output_file_id", "error_file_id"):
+            if not batch[kind]:
+                continue
+            path = os.path.join(self.work_dir, f"{name}.{kind.split('_')[0]}.jsonl")
+            client.client.files.content(batch[kind]).write_to_file(path)
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    image_path = pending.pop(record.get("custom_id"), None)
+                    if image_path is None:
+                        continue
+                    self.on_result(image_path, parse_batch_line(record, client.model))
+                    count += 1
+        if pending:
+            log.warning("%s finished as %s with %d requests missing", name, batch["status"], len(pending))
+        for image_path in pending.values():
+            self.on_result(image_path, {"error": True})
+        self._update(name, status="collected")
+        input_path = os.path.join(self.work_dir, f"{name}.jsonl")
+        if os.path.exists(input_path):
+            # 打包的 base64 图片体积很大，交付后删除
+            os.remove(input_path)
+        return count
+
+    def _orphan(self, batch: dict):
+        # 所属密钥不在 clients 中（例如换了一组密钥后继续运行），无法提交、查询或下载结果：
+        # 其中的图片记为失败并移出 items，之后可以重新打包重试；batch 记为 orphaned，不再等待
+        with self._lock:
+            paths = [row[0] for row in self._conn.execute("SELECT path FROM items WHERE batch = ?", (batch["name"],))]
+            self._conn.execute("DELETE FROM items WHERE batch = ?", (batch["name"],))
+        log.error("no client for %s (key %s, status %s), marking its %d requests failed",
+                  batch["name"], batch["key"], batch["status"], len(paths))
+        for image_path in paths:
+            self.on_result(image_path, {"error": True})
+        self._update(batch["name"], status="orphaned")
+
+    def run(self, image_paths: Iterable[str] = (), wait: bool = True) -> dict:
+        """
+        打包、提交并等待所有 batch 结束
+
+        Args:
+            image_paths (Iterable[str]): 新的图片，为空时只继续之前未完成的 batch
+            wait (bool): 是否等待所有 batch 结束，为 False 时提交后立即返回，之后可以再次调用 run / poll
+
+        Returns:
+            dict: 各状态的 batch 数量
+        """
+        self.pack(image_paths)
+        self.submit()
+        stats = self.poll()
+        while wait and any(status not in FINISHED for status in stats):
+            time.sleep(self.poll_interval)
+            self.submit()
+            stats = self.poll()
+        return stats
+
+    def stats(self) -> dict:
+        """各状态的 batch 数量"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM batches GROUP BY status").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
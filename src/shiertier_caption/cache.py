@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    # 分块读取，避免大图片一次性读入内存
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CaptionCache:
+    def __init__(self, path: str = "caption_cache.sqlite3", max_size_mb: float = 1024):
+        """
+        基于内容寻址的描述结果缓存，持久化在本地 SQLite 文件中
+
+        缓存键为 图片内容哈希（URL 则为 URL 本身）+ 模型 + 提示词 + 温度，
+        值为解析后的结果；总大小超过上限时按最近使用时间淘汰。
+
+        Args:
+            path (str): SQLite 文件路径
+            max_size_mb (float): 缓存值总大小上限（MB）
+        """
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used)")
+        self.size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM captions").fetchone()[0]
+
+    @staticmethod
+    def image_hash(image_path_or_url: str, is_url: bool = False) -> str:
+        # 本地图片读取整个文件计算哈希，异步代码中需要放到线程中执行
+        return hashlib.sha256(image_path_or_url.encode()).hexdigest() if is_url else hash_file(image_path_or_url)
+
+    @staticmethod
+    def make_key(image_path_or_url: str, model: str, prompt: str, temperature: float, is_url: bool = False,
+                 image_hash: Optional[str] = None) -> str:
+        # image_hash 为 CaptionCache.image_hash 的结果，同一张图片的多个请求可以只计算一次
+        if image_hash is None:
+            image_hash = CaptionCache.image_hash(image_path_or_url, is_url)
+        payload = json.dumps([image_hash, model, prompt, temperature], ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM captions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE captions SET last_used = ? WHERE key = ?", (time.time(), key))
+            return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode())
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM captions WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO captions (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time()),
+            )
+            self.size += size - (row[0] if row else 0)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # 淘汰到上限的 90%，避免每次写入都触发淘汰
+        target = self.max_size * 0.9
+        keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM captions ORDER BY last_used"):
+            if self.size <= target:
+                break
+            keys.append((key,))
+            self.size -= size
+        self._conn.executemany("DELETE FROM captions WHERE key = ?", keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
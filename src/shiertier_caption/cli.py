@@ -0,0 +1,290 @@
+"""
+shiertier-caption 命令行入口
+
+    shiertier-caption folder PATH [--sink jsonl --output captions/ --manifest caption_manifest.sqlite3]
+    shiertier-caption mongo --mongo-url mongodb://... [--pics-dir DIR]
+    shiertier-caption urls URLS.txt --output captions/
+
+主进程只负责监督，按 --processes 启动若干工作进程，每个工作进程有独立的 MultiGLM4V 客户端与事件循环，
+编码、JSON 修复与结果序列化分摊到多个核上。输入按哈希确定性地分到各节点（--node-index / --num-nodes）
+与各工作进程，重新运行时同一张图片总是落在同一个进程。
+收到 SIGTERM / SIGINT 时停止读取新的输入，等待在途请求完成、结果落盘后退出；再次收到信号则立即终止。
+"""
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+from typing import Iterable, Iterator, List, Optional
+try:
+    from .glm4v import GLM4V, MultiGLM4V, MultiGLM4V_Mongo, get_api_keys
+    from .key_pool import KeyPool
+    from .hedging import HedgePolicy
+    from .transport import HttpPool
+    from .manifest import Manifest, STATUS_ERROR
+    from .pipeline import scan_images
+    from .preprocess import ImagePreprocessor
+    from .sinks import JsonFileSink, JsonlSink, ParquetSink
+    from .fetcher import HfPicsFetcher, LocalDirFetcher
+    from .metrics import enable_metrics
+except:
+    from glm4v import GLM4V, MultiGLM4V, MultiGLM4V_Mongo, get_api_keys
+    from key_pool import KeyPool
+    from hedging import HedgePolicy
+    from transport import HttpPool
+    from manifest import Manifest, STATUS_ERROR
+    from pipeline import scan_images
+    from preprocess import ImagePreprocessor
+    from sinks import JsonFileSink, JsonlSink, ParquetSink
+    from fetcher import HfPicsFetcher, LocalDirFetcher
+    from metrics import enable_metrics
+
+log = logging.getLogger("shiertier_caption")
+
+
+def shard_of(key: str, num_nodes: int, processes: int) -> tuple[int, int]:
+    """输入所属的 (节点, 工作进程)，只取决于 key 与节点数、进程数"""
+    h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+    return h % num_nodes, (h // num_nodes) % processes
+
+
+def split_keys(keys: List[str], processes: int, index: int) -> List[str]:
+    # 密钥足够时各进程使用互不相同的密钥，否则共用全部密钥
+    if len(keys) >= processes:
+        return keys[index::processes]
+    return keys
+
+
+def load_api_keys(args) -> List[str]:
+    if args.api_keys_file:
+        with open(args.api_keys_file, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = os.environ.get("ZHIPUAI_API_KEYS") or os.environ.get("ZHIPUAI_API_KEY", "")
+    keys = [key.strip() for key in get_api_keys(text.replace(",", "\n").strip()) if key.strip()]
+    if not keys:
+        raise SystemExit("no API keys: use --api-keys-file or set ZHIPUAI_API_KEYS")
+    return keys
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="shiertier-caption", description="多进程批量图片描述")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--api-keys-file", help="每行一个密钥，默认读取环境变量 ZHIPUAI_API_KEYS（逗号或换行分隔）")
+    common.add_argument("--model", default="glm-4v-plus-0111")
+    common.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="工作进程数")
+    common.add_argument("--max-workers", type=int, default=64, help="每个进程同时在途的请求数")
+    common.add_argument("--adaptive", action="store_true",
+                        help="按 AIMD 自动调整在途请求数（整体与每个密钥），--max-workers 为上限")
+    common.add_argument("--hedge-percentile", type=float, default=None,
+                        help="耗时超过该分位数（例如 0.95）的请求在另一个密钥上重发，默认不对冲")
+    common.add_argument("--hedge-budget", type=float, default=0.05, help="对冲请求占总请求数的比例上限")
+    common.add_argument("--rpm", type=float, default=None, help="每个密钥每分钟的请求数上限，进程共用密钥时自动均分")
+    common.add_argument("--dedup", default=None,
+                        help="近似重复检测的 SQLite 路径，各进程共用；看起来相同的本地图片复用已有描述")
+    common.add_argument("--dedup-threshold", type=int, default=5, help="视为同一张图片的最大汉明距离（64 位 dHash）")
+    common.add_argument("--node-index", type=int, default=0)
+    common.add_argument("--num-nodes", type=int, default=1)
+    common.add_argument("--max-side", type=int, default=None, help="上传前把图片最长边缩放到该值")
+    common.add_argument("--metrics-port", type=int, default=None,
+                        help="Prometheus /metrics 端口，第 i 个工作进程使用 端口 + i")
+    common.add_argument("--log-level", default="INFO")
+
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument("--sink", choices=["json", "jsonl", "parquet"], default=None,
+                        help="输出格式，folder 默认为 json（同名json文件），urls 默认为 jsonl")
+    output.add_argument("--output", default="captions", help="jsonl / parquet 分片的输出目录")
+    output.add_argument("--records-per-shard", type=int, default=100_000)
+    output.add_argument("--remove-source", action="store_true", help="结果落盘后删除原图（json 输出总是删除）")
+    output.add_argument("--manifest", default=None, help="完成清单路径，各进程共用")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    folder = subparsers.add_parser("folder", parents=[common, output], help="处理文件夹中的图片")
+    folder.add_argument("path")
+    folder.add_argument("--retry-failed", action="store_true", help="只重试完成清单中失败的图片")
+
+    mongo = subparsers.add_parser("mongo", parents=[common], help="从 MongoDB 领取任务")
+    mongo.add_argument("--mongo-url", required=True)
+    mongo.add_argument("--pics-dir", default=None, help="从本地目录读取图片，默认从 HuggingFace 下载")
+    mongo.add_argument("--max-tasks", type=int, default=None, help="每个进程最多处理的任务数")
+    mongo.add_argument("--wait", action="store_true", help="没有任务时等待新任务而不是退出")
+
+    urls = subparsers.add_parser("urls", parents=[common, output], help="处理URL列表文件中的图片，每行一个URL")
+    urls.add_argument("path")
+    return parser
+
+
+def make_sink(args, index: int, default: str):
+    kind = args.sink or default
+    if kind == "json":
+        return JsonFileSink()
+    prefix = f"captions-n{args.node_index:03d}-w{index:03d}"
+    sink_class = JsonlSink if kind == "jsonl" else ParquetSink
+    return sink_class(args.output, prefix=prefix, records_per_shard=args.records_per_shard,
+                      remove_source=args.remove_source)
+
+
+def make_hedge(args) -> Optional[HedgePolicy]:
+    if args.hedge_percentile is None:
+        return None
+    return HedgePolicy(percentile=args.hedge_percentile, budget=args.hedge_budget)
+
+
+def make_dedup(args):
+    if not args.dedup:
+        return None
+    # dedup 依赖 numpy，开启时才导入；已经是多进程，哈希在当前进程中计算
+    try:
+        from .dedup import NearDuplicateCache
+    except ImportError:
+        from dedup import NearDuplicateCache
+    return NearDuplicateCache(args.dedup, threshold=args.dedup_threshold, processes=0)
+
+
+def make_key_pool(args, keys: List[str]) -> KeyPool:
+    # 已经是多进程，预处理在当前进程中进行
+    preprocessor = ImagePreprocessor(max_side=args.max_side, processes=0) if args.max_side else None
+    rpm = args.rpm / args.processes if args.rpm and args.shared_keys else args.rpm
+    http_pool = HttpPool(max_connections=args.max_workers)
+    return KeyPool([GLM4V(api_key=key, model=args.model, preprocessor=preprocessor, http_pool=http_pool)
+                    for key in keys], rpm=rpm, adaptive=args.adaptive)
+
+
+def take(items: Iterable[str], args, index: int, stop: threading.Event, key=os.path.basename) -> Iterator[str]:
+    # 只产出属于本节点、本进程的输入；收到停止信号后不再产出
+    for item in items:
+        if stop.is_set():
+            return
+        if shard_of(key(item), args.num_nodes, args.processes) == (args.node_index, index):
+            yield item
+
+
+def read_lines(path: str) -> Iterator[str]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+def run_worker(args, index: int, keys: List[str]) -> int:
+    """单个工作进程：处理属于自己的分片，返回处理的数量"""
+    stop = threading.Event()
+    client = None
+
+    def drain(signum, frame):
+        log.info("worker %d: draining after signal %d", index, signum)
+        stop.set()
+        if isinstance(client, MultiGLM4V_Mongo):
+            client.drain()
+
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
+    if args.metrics_port:
+        enable_metrics(prometheus_port=args.metrics_port + index)
+    key_pool = make_key_pool(args, keys)
+    dedup = make_dedup(args)
+
+    if args.command == "mongo":
+        fetcher = LocalDirFetcher(args.pics_dir) if args.pics_dir else HfPicsFetcher()
+        # 任务通过租约原子领取，各进程与节点之间不需要再分片
+        client = MultiGLM4V_Mongo(None, args.mongo_url, max_workers=args.max_workers, key_pool=key_pool,
+                                  fetcher=fetcher, adaptive=args.adaptive, hedge=make_hedge(args), dedup=dedup)
+        try:
+            return client.run(max_tasks=args.max_tasks, stop_when_empty=not args.wait)
+        finally:
+            client.close()
+            if dedup is not None:
+                dedup.close()
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    sink = make_sink(args, index, "json" if args.command == "folder" else "jsonl")
+    client = MultiGLM4V(None, max_workers=args.max_workers, key_pool=key_pool, manifest=manifest, sink=sink,
+                        adaptive=args.adaptive, hedge=make_hedge(args), dedup=dedup)
+    try:
+        if args.command == "folder":
+            if args.retry_failed:
+                if manifest is None:
+                    raise SystemExit("--retry-failed needs --manifest")
+                source = manifest.paths(STATUS_ERROR, prefix=args.path)
+            else:
+                source = scan_images(args.path)
+            return client.prompt_folder(args.path, return_results=False, images=take(source, args, index, stop))
+        return client.prompt_urls(take(read_lines(args.path), args, index, stop, key=lambda url: url),
+                                  return_results=False)
+    finally:
+        sink.close()
+        if manifest is not None:
+            manifest.close()
+        if dedup is not None:
+            dedup.close()
+
+
+def _worker_entry(args, index: int, keys: List[str]):
+    logging.basicConfig(level=args.log_level, format=f"%(asctime)s worker-{index} %(levelname)s %(message)s")
+    # 每个请求一行的 httpx 日志在多进程下过多
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    count = run_worker(args, index, keys)
+    log.info("processed %d", count)
+
+
+def supervise(args, keys: List[str]) -> int:
+    """启动工作进程并转发退出信号，返回退出码"""
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=_worker_entry, args=(args, index, split_keys(keys, args.processes, index)),
+                        name=f"caption-worker-{index}")
+        for index in range(args.processes)
+    ]
+    signals = []
+    # 多个进程的进度条会互相覆盖，工作进程只在结束时输出数量；tqdm 在导入时读取该变量
+    os.environ["TQDM_DISABLE"] = "1"
+
+    def forward(signum, frame):
+        signals.append(signum)
+        for worker in workers:
+            if not worker.is_alive():
+                continue
+            if len(signals) == 1:
+                # 第一次：通知工作进程停止读取新的输入并等待在途请求完成
+                os.kill(worker.pid, signal.SIGTERM)
+            else:
+                worker.kill()
+        log.info("received signal %d, %s", signum, "draining workers" if len(signals) == 1 else "killing workers")
+
+    for worker in workers:
+        worker.start()
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(timeout=1)
+    failed = [worker.name for worker in workers if worker.exitcode]
+    if failed:
+        log.error("workers failed: %s", ", ".join(failed))
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(asctime)s supervisor %(levelname)s %(message)s")
+    if not 0 <= args.node_index < args.num_nodes:
+        raise SystemExit("--node-index must be in [0, --num-nodes)")
+    if args.processes < 1:
+        raise SystemExit("--processes must be at least 1")
+    keys = load_api_keys(args)
+    args.shared_keys = args.processes > 1 and len(keys) < args.processes
+    if args.processes == 1:
+        # 单进程时不需要监督进程，直接在当前进程中运行
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        count = run_worker(args, 0, keys)
+        log.info("processed %d", count)
+        return 0
+    return supervise(args, keys)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+import asyncio
+import collections
+import threading
+import time
+from typing import Optional
+try:
+    from .metrics import metrics
+except:
+    from metrics import metrics
+
+
+class AIMDLimit:
+    def __init__(self, initial: int = 16, min_limit: int = 1, max_limit: int = 1024, increase: float = 1.0,
+                 backoff: float = 0.5, latency_tolerance: float = 2.0, **labels):
+        """
+        加性增、乘性减（AIMD）的并发上限
+
+        请求健康时每轮（约 limit 个成功请求）上限加 increase；收到过载 / 限流错误，
+        或最近的耗时超过长期耗时的 latency_tolerance 倍时，上限乘以 backoff。
+        同一批在途请求往往一起失败，两次减小之间至少间隔一个典型耗时，避免一次过载把上限压到最低。
+        只在在途请求达到上限的一半以上时增加，输入跟不上时上限不会无限增长。
+
+        Args:
+            initial (int): 初始上限
+            min_limit (int): 上限的最小值
+            max_limit (int): 上限的最大值
+            increase (float): 每轮增加的并发数
+            backoff (float): 过载时上限乘以的系数
+            latency_tolerance (float): 近期耗时 / 长期耗时 超过该值时视为拥塞
+            **labels: 指标 caption_concurrency_limit 的标签
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.increase = increase
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.labels = labels
+        self.latency = None  # 近期耗时的指数移动平均（秒）
+        self.baseline = None  # 长期耗时的指数移动平均（秒）
+        self.decreases = 0
+        self._last_decrease = 0.0
+        metrics.set("caption_concurrency_limit", self.value, **labels)
+
+    @property
+    def value(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def on_success(self, in_flight: int, latency: Optional[float] = None, now: Optional[float] = None):
+        """成功请求，in_flight 为请求开始时的在途数量"""
+        now = time.monotonic() if now is None else now
+        if latency is not None:
+            if self.baseline is None:
+                self.latency = self.baseline = latency
+            else:
+                self.latency += 0.2 * (latency - self.latency)
+                self.baseline += 0.02 * (latency - self.baseline)
+            if self.latency > self.baseline * self.latency_tolerance:
+                self._decrease(now)
+                return
+        if in_flight * 2 >= self.value:
+            self._set(self.limit + self.increase / max(self.limit, 1.0))
+
+    def on_overload(self, now: Optional[float] = None):
+        self._decrease(time.monotonic() if now is None else now)
+
+    def _decrease(self, now: float):
+        if now - self._last_decrease < max(self.baseline or 0.0, 1.0):
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self._set(self.limit * self.backoff)
+
+    def _set(self, limit: float):
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        metrics.set("caption_concurrency_limit", self.value, **self.labels)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.value,
+            "decreases": self.decreases,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "baseline": round(self.baseline, 3) if self.baseline is not None else None,
+        }
+
+
+class AdaptiveConcurrency:
+    def __init__(self, limit: Optional[AIMDLimit] = None):
+        """
+        上限随 AIMDLimit 变化的信号量，同步线程与多个事件循环可以共用
+
+        Args:
+            limit (AIMDLimit): 并发上限，默认 AIMDLimit(scope="global")
+        """
+        self.limit = limit or AIMDLimit(scope="global")
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._waiters = collections.deque()  # 异步等待者 (事件循环, future)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            return self._take()
+
+    def _take(self) -> bool:
+        if self.in_flight >= self.limit.value:
+            return False
+        self.in_flight += 1
+        return True
+
+    def acquire(self):
+        with self._condition:
+            while not self._take():
+                self._condition.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._take():
+                    return
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._lock:
+                    try:
+                        self._waiters.remove((loop, future))
+                    except ValueError:
+                        # 已经被唤醒，把空出的名额让给下一个等待者
+                        self._notify()
+                raise
+
+    def release(self, ok: bool = True, overloaded: bool = False, latency: Optional[float] = None):
+        """
+        归还名额并更新上限
+
+        Args:
+            ok (bool): 请求是否成功，失败但不是过载时上限不变
+            overloaded (bool): 是否返回了过载 / 限流错误
+            latency (float): 成功请求的耗时（秒）
+        """
+        with self._lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            if overloaded:
+                self.limit.on_overload()
+            elif ok:
+                self.limit.on_success(in_flight, latency)
+            self._notify()
+
+    def _notify(self):
+        # 按空出的名额唤醒等待者，被唤醒的等待者重新检查上限
+        free = self.limit.value - self.in_flight
+        if free <= 0:
+            return
+        self._condition.notify(free)
+        for _ in range(min(free, len(self._waiters))):
+            loop, future = self._waiters.popleft()
+            loop.call_soon_threadsafe(_wake, future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": self.in_flight, "waiting": len(self._waiters), **self.limit.stats()}
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,275 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+try:
+    from .metrics import metrics
+    from .schema import invalid_fields
+except:
+    from metrics import metrics
+    from schema import invalid_fields
+
+log = logging.getLogger(__name__)
+
+
+def dhash_file(path: str, hash_size: int = 8) -> int:
+    """
+    图片的差值哈希（dHash），hash_size * hash_size 位
+
+    缩小为 (hash_size + 1) x hash_size 的灰度图后比较每行相邻像素的明暗，
+    重新编码、缩放、轻微裁剪或调色后的同一张图片哈希只差少数几位。
+    该函数在进程池中运行，需要保持为模块级函数以便序列化。
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        # JPEG 解码时直接按 1/2 ~ 1/8 缩小，大图不需要完整解码
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        pixels = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = value << 1 | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    # uint64 数组每个元素中 1 的个数
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _BYTE_COUNTS[values.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+_BYTE_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class HammingIndex:
+    def __init__(self, threshold: int = 5, bits: int = 64, buffer_size: int = 4096):
+        """
+        64 位哈希的汉明距离近邻索引（multi-index hashing）
+
+        哈希切成 threshold + 1 段，两个哈希的距离不超过 threshold 时至少有一段完全相同；
+        每段维护排序后的子串，查询时二分查找各段相同的候选，再用 NumPy 一次算出候选的真实距离。
+        千万级条目时每次查询只需检查数万个候选，不需要与全部哈希比较。
+        新条目先放入缓冲区暴力比较，攒满 buffer_size 个再归并进各段的有序数组。
+
+        Args:
+            threshold (int): 视为近似重复的最大汉明距离
+            bits (int): 哈希位数，最多 64
+            buffer_size (int): 归并前缓冲的条目数
+        """
+        if not 0 <= threshold < bits <= 64:
+            raise ValueError("threshold must be in [0, bits) and bits at most 64")
+        parts = threshold + 1
+        widths = [bits // parts + (i < bits % parts) for i in range(parts)]
+        self.threshold = threshold
+        self.buffer_size = buffer_size
+        self._shifts = [sum(widths[i + 1:]) for i in range(parts)]
+        self._masks = [(1 << width) - 1 for width in widths]
+        # threshold 为 0 时只有一段，宽度可达 64 位
+        self._key_dtype = next(dtype for dtype in (np.uint16, np.uint32, np.uint64)
+                               if max(widths) <= np.iinfo(dtype).bits)
+        self._hashes = np.empty(0, dtype=np.uint64)  # 已归并的哈希，按写入顺序
+        self._keys = [np.empty(0, dtype=self._key_dtype) for _ in range(parts)]  # 每段排序后的子串
+        self._rows = [np.empty(0, dtype=np.uint32) for _ in range(parts)]  # 与 _keys 对应的行号
+        self._pending = np.empty(buffer_size, dtype=np.uint64)  # 尚未归并的哈希，前 _pending_count 个有效
+        self._pending_count = 0
+
+    def __len__(self) -> int:
+        return len(self._hashes) + self._pending_count
+
+    def add(self, value: int) -> int:
+        """加入一个哈希，返回其行号（从 0 开始按加入顺序编号）"""
+        self._pending[self._pending_count] = value
+        self._pending_count += 1
+        if self._pending_count >= self.buffer_size:
+            self.flush()
+        return len(self) - 1
+
+    def extend(self, values: np.ndarray):
+        # 批量加入，例如启动时从磁盘载入全部哈希
+        self.flush()
+        self._merge(np.asarray(values, dtype=np.uint64))
+
+    def flush(self):
+        if self._pending_count:
+            pending, self._pending_count = self._pending[:self._pending_count].copy(), 0
+            self._merge(pending)
+
+    def _merge(self, values: np.ndarray):
+        if not len(values):
+            return
+        rows = np.arange(len(self._hashes), len(self._hashes) + len(values), dtype=np.uint32)
+        self._hashes = np.concatenate([self._hashes, values])
+        for i, (shift, mask) in enumerate(zip(self._shifts, self._masks)):
+            keys = ((values >> np.uint64(shift)) & np.uint64(mask)).astype(self._key_dtype)
+            order = np.argsort(keys, kind="stable")
+            keys, new_rows = keys[order], rows[order]
+            # 有序数组的归并：一次二分定位后整体插入，代价与总条目数成线性
+            positions = np.searchsorted(self._keys[i], keys, side="right")
+            self._keys[i] = np.insert(self._keys[i], positions, keys)
+            self._rows[i] = np.insert(self._rows[i], positions, new_rows)
+
+    def search(self, value: int) -> Optional[Tuple[int, int]]:
+        """
+        距离最近且不超过 threshold 的条目
+
+        Returns:
+            tuple | None: (行号, 汉明距离)，没有足够接近的条目时为 None
+        """
+        query = np.uint64(value)
+        best = None
+        candidates = []
+        for i, (shift, mask) in enumerate(zip(self._shifts, self._masks)):
+            # 查询值转换为与数组相同的类型，否则 searchsorted 每次都要转换整个数组
+            key = self._key_dtype((value >> shift) & mask)
+            lo, hi = self._keys[i].searchsorted(key, side="left"), self._keys[i].searchsorted(key, side="right")
+            if hi > lo:
+                candidates.append(self._rows[i][lo:hi])
+        if candidates:
+            rows = np.concatenate(candidates)
+            distances = _popcount(self._hashes[rows] ^ query)
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= self.threshold:
+                best = (int(rows[nearest]), int(distances[nearest]))
+        if self._pending_count:
+            distances = _popcount(self._pending[:self._pending_count] ^ query)
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= self.threshold and (best is None or distances[nearest] < best[1]):
+                best = (len(self._hashes) + nearest, int(distances[nearest]))
+        return best
+
+
+class NearDuplicateCache:
+    def __init__(self, path: str = "caption_near_dups.sqlite3", threshold: int = 5, hash_size: int = 8,
+                 processes: Optional[int] = None, refresh_interval: float = 5.0):
+        """
+        按感知哈希复用描述结果：重新编码、缩放或轻微裁剪的同一张图片不再重复请求
+
+        已描述图片的 dHash 与结果持久化在 SQLite 文件中，启动时全部载入内存中的 HammingIndex；
+        新图片的哈希与某张已描述图片的汉明距离不超过 threshold 时直接返回其描述的副本。
+        哈希在进程池中计算；多个进程共用同一个文件时，每隔 refresh_interval 秒载入其他进程新增的条目。
+        内容完全相同的图片由 CaptionCache 处理，这里只处理内容不同但看起来相同的图片。
+
+        Args:
+            path (str): SQLite 文件路径
+            threshold (int): 视为同一张图片的最大汉明距离（64 位哈希下一般为 4 ~ 8）
+            hash_size (int): dHash 的边长，哈希为 hash_size * hash_size 位，最多 8
+            processes (int): 计算哈希的进程池大小，默认为 CPU 核数；0 表示在当前进程中计算
+            refresh_interval (float): 载入其他进程新增条目的间隔（秒）
+        """
+        self.path = path
+        self.hash_size = hash_size
+        self.processes = processes
+        self.refresh_interval = refresh_interval
+        self.index = HammingIndex(threshold, bits=hash_size * hash_size)
+        self.hits = 0
+        self.misses = 0
+        self._ids: List[int] = []  # 索引行号 -> SQLite 行号
+        self._last_id = 0
+        self._last_refresh = 0.0
+        self._executor = None
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS near_dups ("
+            "id INTEGER PRIMARY KEY, phash INTEGER NOT NULL, image TEXT, value TEXT NOT NULL)"
+        )
+        with self._lock:
+            self._refresh()
+
+    @property
+    def executor(self) -> Optional[concurrent.futures.ProcessPoolExecutor]:
+        if self.processes == 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+            return self._executor
+
+    def hash(self, image_path: str) -> int:
+        executor = self.executor
+        if executor:
+            return executor.submit(dhash_file, image_path, self.hash_size).result()
+        return dhash_file(image_path, self.hash_size)
+
+    async def ahash(self, image_path: str) -> int:
+        executor = self.executor
+        with metrics.timer("caption_phash_seconds"):
+            if executor:
+                return await asyncio.get_running_loop().run_in_executor(executor, dhash_file, image_path, self.hash_size)
+            return await asyncio.to_thread(dhash_file, image_path, self.hash_size)
+
+    def _refresh(self):
+        # 载入 _last_id 之后的条目，包括其他进程写入的
+        rows = self._conn.execute("SELECT id, phash FROM near_dups WHERE id > ? ORDER BY id",
+                                  (self._last_id,)).fetchall()
+        self._last_refresh = time.monotonic()
+        if not rows:
+            return
+        ids, hashes = zip(*rows)
+        # SQLite 只有有符号 64 位整数，哈希按补码存储
+        self.index.extend(np.array(hashes, dtype=np.int64).view(np.uint64))
+        self._ids.extend(ids)
+        self._last_id = ids[-1]
+
+    def lookup(self, phash: int) -> Optional[dict]:
+        """与 phash 足够接近的已描述图片的结果，没有时为 None"""
+        with self._lock:
+            if time.monotonic() - self._last_refresh > self.refresh_interval:
+                self._refresh()
+            found = self.index.search(phash)
+            if found is None:
+                self.misses += 1
+                metrics.inc("caption_near_dup_misses_total")
+                return None
+            row = self._conn.execute("SELECT value FROM near_dups WHERE id = ?", (self._ids[found[0]],)).fetchone()
+            self.hits += 1
+        metrics.inc("caption_near_dup_hits_total")
+        metrics.observe("caption_near_dup_distance", found[1])
+        return json.loads(row[0])
+
+    def add(self, phash: int, result: Optional[dict], image_path: Optional[str] = None):
+        """记录一张已描述图片，只记录完整的结果（nsfw 也记录）"""
+        if not result or invalid_fields(result):
+            return
+        signed = phash - (1 << 64) if phash >= 1 << 63 else phash
+        with self._lock:
+            cursor = self._conn.execute("INSERT INTO near_dups (phash, image, value) VALUES (?, ?, ?)",
+                                        (signed, image_path, json.dumps(result, ensure_ascii=False)))
+            if cursor.lastrowid == self._last_id + 1:
+                self.index.add(phash)
+                self._ids.append(cursor.lastrowid)
+                self._last_id = cursor.lastrowid
+            else:
+                # 其他进程在此之前写入了新条目，按行号顺序一起载入
+                self._refresh()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.index),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            self._conn.close()
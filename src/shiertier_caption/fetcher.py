@@ -0,0 +1,79 @@
+import glob
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class PicFetcher:
+    """
+    图片获取接口：根据任务 id 返回本地图片路径
+
+    子类实现 fetch；evict 在任务结果写入后调用，用于清理缓存，默认不做任何事。
+    fetch 会在下载线程池中并发调用，实现需要线程安全。
+    """
+
+    def fetch(self, task_id) -> str:
+        raise NotImplementedError
+
+    def evict(self, task_id, image_path: str):
+        pass
+
+
+class HfPicsFetcher(PicFetcher):
+    def __init__(self, repo: str = "picollect/armwm", cache_dir: str = "/kaggle/working/pics", evict: bool = True):
+        """
+        从 HfPics 数据集仓库下载图片，整个进程共用一个 HfPics 实例
+
+        Args:
+            repo (str): 数据集仓库
+            cache_dir (str): 缓存目录
+            evict (bool): 任务完成后是否删除缓存目录中的图片
+        """
+        self.repo = repo
+        self.cache_dir = cache_dir
+        self.evict_after_commit = evict
+        self._hf = None
+        self._lock = threading.Lock()
+
+    @property
+    def hf(self):
+        with self._lock:
+            if self._hf is None:
+                from hfpics import HfPics
+                self._hf = HfPics(repo=self.repo, cache_dir=self.cache_dir)
+            return self._hf
+
+    def fetch(self, task_id) -> str:
+        return self.hf.pic(task_id)
+
+    def evict(self, task_id, image_path: str):
+        # 只删除缓存目录中的文件
+        if not self.evict_after_commit or not image_path:
+            return
+        cache_dir = os.path.abspath(self.cache_dir)
+        image_path = os.path.abspath(image_path)
+        if os.path.commonpath([cache_dir, image_path]) != cache_dir:
+            return
+        try:
+            os.remove(image_path)
+        except FileNotFoundError:
+            pass
+
+
+class LocalDirFetcher(PicFetcher):
+    def __init__(self, folder_path: str):
+        """
+        从本地文件夹中按 任务id.扩展名 查找图片，可用于测试或已经下载好的数据集
+
+        Args:
+            folder_path (str): 图片文件夹
+        """
+        self.folder_path = folder_path
+
+    def fetch(self, task_id) -> str:
+        matches = glob.glob(os.path.join(glob.escape(self.folder_path), f"{glob.escape(str(task_id))}.*"))
+        if not matches:
+            raise FileNotFoundError(f"no image for task {task_id} in {self.folder_path}")
+        return matches[0]
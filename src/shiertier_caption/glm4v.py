@@ -1,16 +1,55 @@
-from zhipuai import ZhipuAI
-from typing import Optional, Union, List
-import base64
+from typing import TYPE_CHECKING, Iterable, Optional, Union, List
 try:
-    from .repair_json import try_parse_json_object as repair_json
+    from .aio import run_sync, LoopLocal
+    from .key_pool import KeyPool, error_code, is_overload_error
+    from .concurrency import AIMDLimit, AdaptiveConcurrency
+    from .hedging import HedgePolicy
+    from .cache import CaptionCache, hash_file
+    from .manifest import Manifest, STATUS_ERROR, result_status
+    from .batch import BatchRunner
+    from .sinks import Sink, JsonFileSink
+    from .preprocess import ImagePreprocessor, EncodedImage
+    from .transport import HttpPool, default_http_pool
+    from .provider import CaptionProvider, RepairOverloaded, parse_caption, request_outcome, take_request_tokens
+    from .metrics import metrics
+    from .pipeline import run_pipeline, scan_images
+    from .mongo_writer import BulkWriter
+    from .mongo_queue import TaskQueue
+    from .fetcher import PicFetcher, HfPicsFetcher
 except:
-    from repair_json import try_parse_json_object as repair_json
+    from aio import run_sync, LoopLocal
+    from key_pool import KeyPool, error_code, is_overload_error
+    from concurrency import AIMDLimit, AdaptiveConcurrency
+    from hedging import HedgePolicy
+    from cache import CaptionCache, hash_file
+    from manifest import Manifest, STATUS_ERROR, result_status
+    from batch import BatchRunner
+    from sinks import Sink, JsonFileSink
+    from preprocess import ImagePreprocessor, EncodedImage
+    from transport import HttpPool, default_http_pool
+    from provider import CaptionProvider, RepairOverloaded, parse_caption, request_outcome, take_request_tokens
+    from metrics import metrics
+    from pipeline import run_pipeline, scan_images
+    from mongo_writer import BulkWriter
+    from mongo_queue import TaskQueue
+    from fetcher import PicFetcher, HfPicsFetcher
 import json
+import asyncio
 import concurrent.futures
+import functools
+import logging
 import os
 from tqdm import tqdm
 import time
 
+if TYPE_CHECKING:
+    # dedup 依赖 numpy，只在传入 NearDuplicateCache 时才需要
+    from .dedup import NearDuplicateCache
+
+log = logging.getLogger(__name__)
+
+GLM_BASE_URL = "https://open.bigmodel.cn/api/paas/v4/"
+
 
 def convert_str_to_list(input: str) -> list:
     # 将输入字符串转换为列表，列表中的元素是字符串
@@ -22,16 +61,28 @@ def convert_str_to_list(input: str) -> list:
             result_list.append(i)
     return result_list
 
-class GLM4V:
-    def __init__(self, api_key: str, model: str = "glm-4v-plus-0111"):
+class GLM4V(CaptionProvider):
+    batch_endpoint = "/v4/chat/completions"
+
+    def __init__(self, api_key: str, model: str = "glm-4v-plus-0111", cache: Optional[CaptionCache] = None,
+                 preprocessor: Optional[ImagePreprocessor] = None, http_pool: Optional[HttpPool] = None):
         """
         初始化 GLM4V-Flash 客户端
 
         Args:
             api_key (str): 智谱 AI 的 API key
             model (str): 模型名称，默认为 "glm-4v-plus-0111"
+            cache (CaptionCache): 描述结果缓存，相同图片、模型、提示词与温度直接返回缓存结果
+            preprocessor (ImagePreprocessor): 上传前的图片缩放与重新编码，默认上传原图
+            http_pool (HttpPool): HTTP 连接池，默认与其他客户端共用进程内的默认连接池
         """
-        self.client = ZhipuAI(api_key=api_key)
+        self.api_key = api_key
+        self.cache = cache
+        self.preprocessor = preprocessor
+        self.http_pool = http_pool or default_http_pool()
+        self._http_slot = self.http_pool.slot()
+        self._client = None
+        self._aclient = LoopLocal(self._new_aclient)
         if model not in ["glm-4v-flash", "glm-4v", "glm-4v-plus", "glm-4v-plus-0111"]:
             raise ValueError("model must be one of ['glm-4v-flash', 'glm-4v', 'glm-4v-plus', 'glm-4v-plus-0111']")
         self.model = model
@@ -77,7 +128,9 @@ Please strictly follow the format below and output only JSON, do not output Pyth
         prompt: str = "",
         need_json: bool = True,
         temperature: float = 0.8,
-        is_url: bool = False
+        is_url: bool = False,
+        retry_busy: bool = True,
+        image_hash: Optional[str] = None
     ) -> str:
         """
         对图片进行提问并获取回答
@@ -86,26 +139,166 @@ Please strictly follow the format below and output only JSON, do not output Pyth
             image_path_or_url (str): 图片的本地路径或URL
             prompt (str): 关于图片的提问
             is_url (bool): 是否为URL链接，默认为False（即本地文件）
+            retry_busy (bool): 服务器过载（1305）时是否等待300s后重试，为False时直接抛出异常，
+                由调用方换用其他密钥
+            image_hash (str): 缓存键使用的图片哈希（CaptionCache.image_hash），传入时不再重新计算
 
         Returns:
             str: 模型的回答
         """
 
-        if not prompt:
-            prompt = self.default_prompt
+        if need_json and self.cache is not None and image_hash is None:
+            image_hash = CaptionCache.image_hash(image_path_or_url, is_url)
+        cache_key = self._cache_key(image_path_or_url, prompt, temperature, is_url, image_hash) if need_json else None
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        messages = self._build_messages(self._image_data(image_path_or_url, is_url), prompt, temperature)
+        # 发送请求
+        start = time.perf_counter()
+        if need_json:
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    #response_format = {'type': 'json_object'},
+                )
+            except Exception as e:
+                self._record_request(start, request_outcome(e))
+                if error_code(e) == "1301":
+                    print("nsfw pic")
+                    return {"nsfw": True}
+                elif error_code(e) == "1305" and retry_busy:
+                    print("服务器当前压力大，等待300s再次尝试")
+                    time.sleep(300)
+                    return self.prompt(image_path_or_url, prompt, need_json, temperature, is_url, image_hash=image_hash)
+                else:
+                    raise e
+            self._record_request(start, "ok", response)
+            result = parse_caption(response.choices[0].message.content, self.model)
+            if prompt in ("", self.default_prompt):
+                result = self.complete_caption(image_path_or_url, result, is_url=is_url, retry_busy=retry_busy,
+                                               image_hash=image_hash)
+            return self._cache_result(result, cache_key)
+        else:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages
+            )
+            self._record_request(start, "ok", response)
 
+            return response.choices[0].message.content
 
-        # 准备图片数据
-        if is_url:
-            image_data = {"url": image_path_or_url}
+    async def aprompt(
+        self,
+        image_path_or_url: str,
+        prompt: str = "",
+        need_json: bool = True,
+        temperature: float = 0.8,
+        is_url: bool = False,
+        retry_busy: bool = True,
+        encoded: Optional[EncodedImage] = None,
+        image_hash: Optional[str] = None
+    ) -> str:
+        """
+        prompt 的异步版本，参数与返回值相同
+
+        encoded 为已经编码好的图片（见 aencode_image），传入时不再重复读取与编码图片；
+        image_hash 为缓存键使用的图片哈希，不传时在线程中计算，补全字段的请求复用同一个哈希。
+
+        请求通过智谱的 OpenAI 兼容接口发送，等待响应时不占用线程，
+        单个事件循环即可同时挂起成千上万个请求。
+        """
+        if need_json and image_hash is None:
+            image_hash = await self.aimage_hash(image_path_or_url, is_url)
+        cache_key = self._cache_key(image_path_or_url, prompt, temperature, is_url, image_hash) if need_json else None
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        if not is_url and encoded is None:
+            encoded = await self.aencode_image(image_path_or_url)
+        messages = self._build_messages(self._image_data(image_path_or_url, is_url, encoded), prompt, temperature)
+        start = time.perf_counter()
+        if need_json:
+            try:
+                response = await self.aclient.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                )
+            except Exception as e:
+                self._record_request(start, request_outcome(e))
+                if error_code(e) == "1301":
+                    print("nsfw pic")
+                    return {"nsfw": True}
+                elif error_code(e) == "1305" and retry_busy:
+                    print("服务器当前压力大，等待300s再次尝试")
+                    await asyncio.sleep(300)
+                    return await self.aprompt(image_path_or_url, prompt, need_json, temperature, is_url,
+                                              encoded=encoded, image_hash=image_hash)
+                else:
+                    raise e
+            self._record_request(start, "ok", response)
+            result = parse_caption(response.choices[0].message.content, self.model)
+            if prompt in ("", self.default_prompt):
+                result = await self.acomplete_caption(image_path_or_url, result, is_url=is_url, encoded=encoded,
+                                                      retry_busy=retry_busy, image_hash=image_hash)
+            return self._cache_result(result, cache_key)
         else:
-            # 读取本地图片并转换为base64
-            with open(image_path_or_url, 'rb') as img_file:
-                img_base64 = base64.b64encode(img_file.read()).decode('utf-8')
-            image_data = {"url": img_base64}
+            response = await self.aclient.chat.completions.create(
+                model=self.model,
+                messages=messages
+            )
+            self._record_request(start, "ok", response)
+            return response.choices[0].message.content
+
+    def caption(self, image_path_or_url: str, is_url: bool = False, **kwargs) -> dict:
+        kwargs.setdefault("retry_busy", False)
+        return self.prompt(image_path_or_url, is_url=is_url, **kwargs)
+
+    async def acaption(self, image_path_or_url: str, is_url: bool = False,
+                       encoded: Optional[EncodedImage] = None, **kwargs) -> dict:
+        kwargs.setdefault("retry_busy", False)
+        return await self.aprompt(image_path_or_url, is_url=is_url, encoded=encoded, **kwargs)
+
+    def batch_body(self, image_path: str, encoded: Optional[EncodedImage] = None) -> dict:
+        return {"model": self.model, "messages": self._build_messages(self._image_data(image_path, False, encoded), "", 0.8)}
+
+    @property
+    def client(self):
+        # 同步客户端按需创建，只使用异步接口时不导入 zhipuai
+        if self._client is None:
+            from zhipuai import ZhipuAI
+            # SDK 不自行重试：过载 / 限流错误立即交给 KeyPool，冷却该密钥并换用其他密钥
+            self._client = ZhipuAI(api_key=self.api_key, http_client=self.http_pool.sync_client(self._http_slot),
+                                   max_retries=0)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def aclient(self):
+        # 异步客户端绑定事件循环，按循环懒加载
+        return self._aclient.get()
+
+    def _new_aclient(self):
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=self.api_key, base_url=GLM_BASE_URL, http_client=self.http_pool.async_client(self._http_slot),
+                           max_retries=0)
+
+    def _image_data(self, image_path_or_url: str, is_url: bool, encoded: Optional[EncodedImage] = None) -> dict:
+        # 准备图片数据，本地图片以base64上传
+        if is_url:
+            return {"url": image_path_or_url}
+        return {"url": (encoded or self.encode_image(image_path_or_url)).data}
+
+    def _build_messages(self, image_data: dict, prompt: str, temperature: float) -> list:
+        if not prompt:
+            prompt = self.default_prompt
 
         # 构建请求消息
-        messages = [{
+        return [{
             "role": "user",
             "content": [
                 {
@@ -119,156 +312,798 @@ Please strictly follow the format below and output only JSON, do not output Pyth
             ],
             "temperature": temperature
         }]
-        # print(prompt)
-        # 发送请求
-        if need_json:
+
+    def _caption_cache_key(self, image_path_or_url: str, is_url: bool, image_hash: Optional[str], prompt: str = "",
+                           temperature: float = 0.8, **kwargs) -> Optional[str]:
+        return self._cache_key(image_path_or_url, prompt, temperature, is_url, image_hash)
+
+    def _cache_key(self, image_path_or_url: str, prompt: str, temperature: float, is_url: bool,
+                   image_hash: Optional[str] = None) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return CaptionCache.make_key(image_path_or_url, self.model, prompt or self.default_prompt, temperature, is_url,
+                                     image_hash)
+
+
+def get_api_keys(api_keys: list[str] | str) -> list[str]:
+    # 支持传入列表、单个密钥或以换行分隔的多个密钥
+    if isinstance(api_keys, str):
+        if '\n' in api_keys:
+            api_keys = convert_str_to_list(api_keys)
+        else:
+            api_keys = [api_keys]
+    return api_keys
+
+
+class AsyncMultiGLM4V:
+    # 同一张图片遇到过载 / 限流时换密钥重试的最多次数，用完后按失败处理（{"error": True}）
+    max_overload_retries = 10
+
+    def __init__(self, api_keys: list[str] | str, max_concurrency: int = 1024, model: str = "glm-4v-plus-0111",
+                 key_pool: Optional[KeyPool] = None, cache: Optional[CaptionCache] = None,
+                 preprocessor: Optional[ImagePreprocessor] = None, adaptive: bool = False,
+                 hedge: Optional[HedgePolicy] = None, dedup: Optional["NearDuplicateCache"] = None):
+        """
+        基于 asyncio 的多密钥 GLM4V 客户端
+
+        所有请求运行在同一个事件循环上，由信号量限制同时在途的请求数量，
+        不再为每个请求占用一个线程。
+
+        Args:
+            api_keys (list[str] | str): API 密钥列表或以换行分隔的密钥字符串，传入 key_pool 时可为 None
+            max_concurrency (int): 同时在途的最大请求数
+            model (str): 模型名称
+            key_pool (KeyPool): 共享的密钥池，多个客户端可共用同一个密钥池，默认按 api_keys 新建
+            cache (CaptionCache): 描述结果缓存，仅在新建密钥池时传给各个 GLM4V 客户端
+            preprocessor (ImagePreprocessor): 图片预处理，仅在新建密钥池时传给各个 GLM4V 客户端，
+                新建密钥池时各个客户端还共用一个按 max_concurrency 设置大小的连接池
+            adaptive (bool): 按 AIMD 自动调整同时在途的请求数，max_concurrency 为其上限；
+                新建密钥池时每个密钥的在途数也自动调整
+            hedge (HedgePolicy): 对冲请求，耗时超过近期分位数的请求在另一个密钥上重发，取先返回的有效结果；
+                只用于异步接口，None 表示不对冲
+            dedup (NearDuplicateCache): 近似重复检测，本地图片与已描述图片的感知哈希足够接近时直接复用其描述
+        """
+        if key_pool is None:
+            api_keys = get_api_keys(api_keys)
+            http_pool = HttpPool(max_connections=max_concurrency)
+            key_pool = KeyPool([GLM4V(api_key=api_key, model=model, cache=cache, preprocessor=preprocessor,
+                                      http_pool=http_pool) for api_key in api_keys], adaptive=adaptive)
+        self.key_pool = key_pool
+        self.clients = key_pool.clients
+        # 每种缓存键（服务商、模型、缓存）各取一个客户端，占用密钥之前先查询缓存
+        cache_clients = {}
+        for client in self.clients:
+            if getattr(client, "cache", None) is not None:
+                cache_clients.setdefault((type(client), client.model, id(client.cache)), client)
+        self._cache_clients = list(cache_clients.values())
+        self.account_counts = len(self.clients)
+        self.max_concurrency = max_concurrency
+        self._semaphore = LoopLocal(lambda: asyncio.Semaphore(self.max_concurrency))
+        # 自适应并发：在 max_concurrency 以内，健康时逐步增加，过载时减半
+        self.hedge = hedge
+        self.dedup = dedup
+        self.concurrency = None
+        if adaptive:
+            self.concurrency = AdaptiveConcurrency(
+                AIMDLimit(initial=min(16, max_concurrency), max_limit=max_concurrency, scope="global"))
+
+    def key_stats(self) -> list[dict]:
+        return self.key_pool.stats()
+
+    def concurrency_stats(self) -> Optional[dict]:
+        # 自适应并发的当前上限、在途与等待数量，未开启时为 None
+        return self.concurrency.stats() if self.concurrency is not None else None
+
+    def hedge_stats(self) -> Optional[dict]:
+        # 对冲请求的次数、胜出次数与当前的触发延迟，未开启时为 None
+        return self.hedge.stats() if self.hedge is not None else None
+
+    def dedup_stats(self) -> Optional[dict]:
+        # 近似重复的命中次数与索引条目数，未开启时为 None
+        return self.dedup.stats() if self.dedup is not None else None
+
+    def _release(self, key, ok: bool = True, overloaded: bool = False, latency: Optional[float] = None,
+                 cancelled: bool = False):
+        # 本次请求（包括补全字段的请求）实际消耗的 token 交给密钥池，按实际用量限速
+        # 被取消的请求只归还密钥与并发名额，不影响密钥健康状态与并发上限
+        self.key_pool.release(key, ok=ok, overloaded=overloaded, tokens=take_request_tokens(), latency=latency,
+                              cancelled=cancelled)
+        if self.concurrency is not None:
+            self.concurrency.release(ok=ok and not cancelled, overloaded=overloaded, latency=latency)
+
+    def _cached(self, image_path_or_url: str, kwargs: dict) -> Optional[dict]:
+        # 各服务商缓存中的结果；图片哈希写回 kwargs，未命中时发出的请求不再重新计算
+        for client in self._cache_clients:
+            cached = client.cached_caption(image_path_or_url, **kwargs)
+            if cached is not None:
+                return cached
+        return None
+
+    def request(self, image_path_or_url: str, **kwargs) -> dict:
+        if self._cache_clients:
+            if kwargs.get("image_hash") is None:
+                kwargs["image_hash"] = CaptionCache.image_hash(image_path_or_url, kwargs.get("is_url", False))
+            cached = self._cached(image_path_or_url, kwargs)
+            if cached is not None:
+                return cached
+        phash = None
+        if self.dedup is not None and not kwargs.get("is_url"):
             try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    #response_format = {'type': 'json_object'},
-                )
+                phash = self.dedup.hash(image_path_or_url)
+                cached = self.dedup.lookup(phash)
             except Exception as e:
-                if '1301' in str(e):
-                    print("nsfw pic")
-                    return {"nsfw": True}
-                elif '1305' in str(e):
-                    print("服务器当前压力大，等待300s再次尝试")
-                    time.sleep(300)
-                    return self.prompt(image_path_or_url, prompt, need_json, temperature, is_url)
+                log.debug("near-duplicate lookup failed for %s: %r", image_path_or_url, e)
+            else:
+                if cached is not None:
+                    return cached
+        result = self._request(image_path_or_url, **kwargs)
+        if phash is not None:
+            self.dedup.add(phash, result, image_path_or_url)
+        return result
+
+    def _complete(self, client, image_path_or_url: str, repair: RepairOverloaded, kwargs: dict) -> dict:
+        # 补全字段时过载：换到新的密钥后只用短提示词补全，结果按原来的缓存键写入
+        result = client.complete_caption(image_path_or_url, repair.result,
+                                         **{k: v for k, v in kwargs.items() if k != "prompt"})
+        return repair.client.cache_caption(result, image_path_or_url, **kwargs)
+
+    async def _acomplete(self, client, image_path_or_url: str, repair: RepairOverloaded, kwargs: dict) -> dict:
+        result = await client.acomplete_caption(image_path_or_url, repair.result,
+                                                **{k: v for k, v in kwargs.items() if k != "prompt"})
+        return repair.client.cache_caption(result, image_path_or_url, **kwargs)
+
+    def _request(self, image_path_or_url: str, **kwargs) -> dict:
+        # 过载或限流的密钥进入冷却，请求立即换到其他健康密钥重试；
+        # 只有补全字段的请求过载时，换密钥后只重试补全
+        repair = None
+        retries = 0
+        while True:
+            if self.concurrency is not None:
+                self.concurrency.acquire()
+            key = self.key_pool.acquire()
+            take_request_tokens()  # 清零之前残留的用量，只统计本次请求
+            start = time.monotonic()
+            try:
+                if repair is None:
+                    result = key.client.caption(image_path_or_url, **kwargs)
                 else:
-                    raise e
-            response_content = response.choices[0].message.content
-            #print(response_content)
+                    result = self._complete(key.client, image_path_or_url, repair, kwargs)
+            except Exception as e:
+                overloaded = is_overload_error(e)
+                self._release(key, ok=False, overloaded=overloaded)
+                if overloaded:
+                    repair = self._repair_state(repair, e, key)
+                    retries += 1
+                    if retries > self.max_overload_retries:
+                        return self._overload_exhausted(image_path_or_url, repair, e)
+                    metrics.inc("caption_retries_total", reason="overload")
+                    continue
+                raise
+            self._release(key, latency=time.monotonic() - start)
+            return result
+
+    async def arequest(self, image_path_or_url: str, **kwargs) -> dict:
+        # 缓存与近似重复都在占用并发名额与密钥之前查询，命中时不等待限速也不影响并发与对冲的统计
+        if self._cache_clients:
+            if kwargs.get("image_hash") is None:
+                kwargs["image_hash"] = await self._cache_clients[0].aimage_hash(image_path_or_url,
+                                                                                kwargs.get("is_url", False))
+            cached = self._cached(image_path_or_url, kwargs)
+            if cached is not None:
+                return cached
+        phash = None
+        if self.dedup is not None and not kwargs.get("is_url"):
+            # 与已描述图片看起来相同（重新编码、缩放、轻微裁剪）时复用其描述，不再请求；
+            # 无法计算哈希的图片（例如 Pillow 不支持的格式）照常请求
             try:
-                old,new = repair_json(response_content)
-                return new
+                phash = await self.dedup.ahash(image_path_or_url)
+                cached = self.dedup.lookup(phash)
             except Exception as e:
-                print(e)
-                return {"error": True}
+                log.debug("near-duplicate lookup failed for %s: %r", image_path_or_url, e)
+            else:
+                if cached is not None:
+                    return cached
+        if self.hedge is None or self.account_counts < 2:
+            result = await self._arequest(image_path_or_url, **kwargs)
         else:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages
-            )
+            result = await self._ahedged(image_path_or_url, **kwargs)
+        if phash is not None:
+            self.dedup.add(phash, result, image_path_or_url)
+        return result
 
-            return response.choices[0].message.content
+    async def _ahedged(self, image_path_or_url: str, **kwargs) -> dict:
+        # 超过近期耗时分位数仍未返回时在另一个密钥上重发，取先返回的有效结果并取消另一个
+        # 计时从主请求拿到密钥并发出之后开始，排队等待密钥或并发名额的时间不算在内
+        delay = self.hedge.delay()
+        attempt = {"sent": asyncio.Event()}
+        primary = asyncio.ensure_future(self._arequest(image_path_or_url, attempt=attempt, **kwargs))
+        if delay is None:
+            return await primary
+        sent = asyncio.ensure_future(attempt["sent"].wait())
+        try:
+            await asyncio.wait({primary, sent}, return_when=asyncio.FIRST_COMPLETED)
+            start = attempt.get("start")
+            if start is not None:
+                await asyncio.wait({primary}, timeout=max(0.0, start + delay - time.monotonic()))
+        except BaseException:
+            primary.cancel()
+            raise
+        finally:
+            sent.cancel()
+        # 主请求因过载换密钥重试、尚未重新发出时不对冲
+        if primary.done() or start is None or attempt.get("start") != start or not self.hedge.try_spend():
+            return await primary
+        # 只在另一个密钥与并发名额立即可用时对冲，排队的对冲请求只会加重排队
+        spare = self._try_acquire_spare(attempt["key"])
+        if spare is None:
+            self.hedge.refund()
+            return await primary
+        metrics.inc("caption_hedges_total")
+        hedge_attempt = {"reserved": spare}
+        hedge = asyncio.ensure_future(self._arequest(image_path_or_url, attempt=hedge_attempt,
+                                                     exclude=attempt["key"], **kwargs))
+        attempts = {primary: attempt, hedge: hedge_attempt}
+        pending = {primary, hedge}
+        fallback = error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    result = task.result()
+                    if result and "error" not in result:
+                        if task is hedge:
+                            self.hedge.won()
+                            metrics.inc("caption_hedge_wins_total")
+                        return result
+                    fallback = fallback or result
+        finally:
+            now = time.monotonic()
+            for task in pending:
+                task.cancel()
+                # 落后的请求耗时至少为已经过的时间，也计入分位数，否则分位数只反映较快的请求
+                if "start" in attempts[task]:
+                    self.hedge.observe(now - attempts[task]["start"])
+            reserved = hedge_attempt.pop("reserved", None)
+            if reserved is not None:
+                # 对冲请求还没开始运行就被取消，归还为它占用的密钥
+                self._release(reserved, cancelled=True)
+        # 两个请求都没有有效结果：返回解析失败的结果，都出错时抛出先出现的异常
+        if fallback is not None:
+            return fallback
+        raise error
+
+    async def _arequest(self, image_path_or_url: str, attempt: Optional[dict] = None, exclude=None, **kwargs) -> dict:
+        # attempt 记录当前使用的密钥与发出时间，其中的 sent 事件在请求发出时置位；
+        # 对冲请求通过 exclude 换一个密钥，attempt["reserved"] 为已经连同并发名额占用好的密钥
+        key = attempt.pop("reserved", None) if attempt is not None else None
+        repair = None
+        retries = 0
+        while True:
+            if attempt is not None:
+                attempt.pop("start", None)
+            if key is None:
+                wait_start = time.perf_counter()
+                if self.concurrency is not None:
+                    await self.concurrency.aacquire()
+                key = await self._acquire_key(exclude)
+                metrics.observe("caption_key_wait_seconds", time.perf_counter() - wait_start)
+            if attempt is not None:
+                attempt["key"] = key
+            take_request_tokens()  # 清零之前残留的用量，只统计本次请求
+            start = time.monotonic()
+            if attempt is not None:
+                attempt["start"] = start
+                if "sent" in attempt:
+                    attempt["sent"].set()
+            try:
+                if repair is None:
+                    result = await key.client.acaption(image_path_or_url, **kwargs)
+                else:
+                    result = await self._acomplete(key.client, image_path_or_url, repair, kwargs)
+            except asyncio.CancelledError:
+                # 对冲中落后的请求被取消，不是密钥或服务商的错误
+                self._release(key, cancelled=True)
+                raise
+            except BaseException as e:
+                overloaded = isinstance(e, Exception) and is_overload_error(e)
+                self._release(key, ok=False, overloaded=overloaded)
+                if overloaded:
+                    repair = self._repair_state(repair, e, key)
+                    retries += 1
+                    if retries > self.max_overload_retries:
+                        return self._overload_exhausted(image_path_or_url, repair, e)
+                    metrics.inc("caption_retries_total", reason="overload")
+                    key = None
+                    continue
+                raise
+            latency = time.monotonic() - start
+            self._release(key, latency=latency)
+            if self.hedge is not None:
+                self.hedge.observe(latency)
+            return result
 
+    def _overload_exhausted(self, image_path_or_url: str, repair: Optional[RepairOverloaded], e: Exception) -> dict:
+        # 同一张图片过载重试的次数用完：按失败处理，补全字段时过载的保留已有字段并标记为未完成
+        log.warning("giving up on %s after %d overloaded attempts: %r", image_path_or_url,
+                    self.max_overload_retries + 1, e)
+        metrics.inc("caption_retries_exhausted_total")
+        if repair is not None:
+            return dict(repair.result, incomplete=repair.fields)
+        return {"error": True}
 
-class MultiGLM4V:
-    def __init__(self, api_keys: list[str] | str, max_workers: int = 64, model: str = "glm-4v-plus-0111"):
-        if isinstance(api_keys, str):
-            if '\n' in api_keys:
-                api_keys = convert_str_to_list(api_keys)
-            else:
-                api_keys = [api_keys]
-        self.clients = [ZhipuAI(api_key=api_key) for api_key in api_keys]
+    @staticmethod
+    def _repair_state(repair: Optional[RepairOverloaded], e: Exception, key) -> Optional[RepairOverloaded]:
+        # 记录补全字段时的过载，client 为给出原结果的客户端，补全后的结果写入它的缓存
+        if not isinstance(e, RepairOverloaded):
+            return repair
+        e.client = repair.client if repair is not None else key.client
+        return e
+
+    def _try_acquire_spare(self, exclude):
+        # 不等待地占用另一个密钥与并发名额，任一不可用时返回 None
+        if self.concurrency is not None and not self.concurrency.try_acquire():
+            return None
+        key, _ = self.key_pool.try_acquire(exclude)
+        if key is None and self.concurrency is not None:
+            self.concurrency.release(ok=False)
+        return key
+
+    async def _acquire_key(self, exclude=None):
+        # 等待密钥期间被取消时归还已占用的并发名额
+        try:
+            return await self.key_pool.aacquire(exclude)
+        except BaseException:
+            if self.concurrency is not None:
+                self.concurrency.release(ok=False)
+            raise
+
+    async def aprompt_one(self, image_path_or_url: str, **kwargs) -> dict:
+        start = time.perf_counter()
+        async with self._semaphore.get():
+            metrics.observe("caption_queue_wait_seconds", time.perf_counter() - start)
+            return await self.arequest(image_path_or_url, **kwargs)
+
+    async def gather(self, coros: list, desc: str = "处理图片中") -> list:
+        # 按完成顺序收集结果，任一任务出错时直接抛出
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        results = []
+        try:
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=desc):
+                results.append(await task)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return results
+
+    async def aprompt_images(self, image_paths: List[str]) -> list:
+        return await self.gather([self.aprompt_one(image_path) for image_path in image_paths])
+
+    def prompt_images(self, image_paths: List[str]) -> list:
+        return run_sync(self.aprompt_images(image_paths))
+
+
+class MultiGLM4V(AsyncMultiGLM4V):
+    def __init__(self, api_keys: list[str] | str, max_workers: int = 64, model: str = "glm-4v-plus-0111",
+                 key_pool: Optional[KeyPool] = None, cache: Optional[CaptionCache] = None,
+                 preprocessor: Optional[ImagePreprocessor] = None, manifest: Optional[Manifest] = None,
+                 sink: Optional[Sink] = None, adaptive: bool = False, hedge: Optional[HedgePolicy] = None,
+                 dedup: Optional["NearDuplicateCache"] = None):
+        # max_workers 为同时在途的请求数，请求运行在事件循环上，可以设置得远大于线程数
+        # adaptive 为 True 时在途请求数按 AIMD 自动调整，max_workers 为其上限
+        # hedge 为对冲请求的策略，慢请求在另一个密钥上重发，缩短整批的结束时间
+        # dedup 为近似重复检测，看起来相同的图片复用已有的描述
+        # manifest 为完成清单，传入后按清单跳过已完成的图片，失败的图片保留原图，可用 retry_failed 重试
+        # sink 为结果输出，默认每张图片写一个同名json文件并删除原图
+        super().__init__(api_keys, max_concurrency=max_workers, model=model, key_pool=key_pool, cache=cache,
+                         preprocessor=preprocessor, adaptive=adaptive, hedge=hedge, dedup=dedup)
         self.max_workers = max_workers
-        self.account_counts = len(self.clients)
-        for i in range(self.account_counts):
-            self.clients[i] = GLM4V(api_key=api_keys[i], model=model)
+        self.model = model
+        self.manifest = manifest
+        self.sink = sink or JsonFileSink()
 
-    def prompt_one(self, image_path_or_url: str) -> str:
-        import random
-        account_index = random.randint(0, self.account_counts - 1)
-        prompt_result = self.clients[account_index].prompt(image_path_or_url)
-        if prompt_result:
-            # json_path 是image_path_or_url的同名json文件路径
+    def record(self, image_path: str, prompt_result: Optional[dict], content_hash: Optional[str] = None,
+               error: Optional[str] = None):
+        # 把处理结果记入完成清单，没有清单时不做任何事
+        if self.manifest is not None:
+            self.manifest.record(image_path, result_status(prompt_result), self.model, content_hash, error)
 
-            json_path = image_path_or_url.replace(".jpg", ".json").replace(".png", ".json").replace(".jpeg", ".json").replace(".webp", ".json")
-            with open(json_path, "w") as f:
-                json.dump(prompt_result, f)
-            os.remove(image_path_or_url)
+    def save_result(self, image_path_or_url: str, prompt_result: dict, content_hash: Optional[str] = None) -> dict:
+        # 写入 sink 并记入完成清单；清单在结果落盘之后才记为完成，进程崩溃时未落盘的图片会重新处理
+        if not prompt_result or (self.manifest is not None and result_status(prompt_result) == STATUS_ERROR):
+            # 有清单时失败只记入清单，不写 json 也不删除原图
+            self.record(image_path_or_url, prompt_result, content_hash)
             return prompt_result
+        on_written = None
+        if self.manifest is not None:
+            on_written = functools.partial(self.record, image_path_or_url, prompt_result, content_hash)
+        self.sink.write(image_path_or_url, prompt_result, on_written=on_written)
+        return prompt_result
 
-    def prompt_images(self, image_paths: List[str]) -> str:
-        # image_path_dict的键是图片位置，值是图片的描述
+    def prompt_one(self, image_path_or_url: str) -> str:
+        prompt_result = self.request(image_path_or_url)
+        return self.save_result(image_path_or_url, prompt_result)
+
+    async def aprompt_one(self, image_path_or_url: str) -> dict:
+        prompt_result = await super().aprompt_one(image_path_or_url)
+        return self.save_result(image_path_or_url, prompt_result)
+
+    async def aprompt_images(self, image_paths: List[str]) -> list:
+        try:
+            return await super().aprompt_images(image_paths)
+        finally:
+            # 等待本批结果落盘
+            await asyncio.to_thread(self.sink.flush)
+
+    async def aprompt_folder(self, folder_path: str, return_results: bool = True, queue_size: int = 64,
+                             encode_workers: Optional[int] = None, retry_failed: bool = False,
+                             images: Optional[Iterable[str]] = None):
+        """
+        以流式流水线处理文件夹中的所有图片，跳过已完成的图片
+
+        扫描、跳过已完成、编码、请求、写入 五个阶段由有界队列串联：扫描到第一张图片即开始请求，
+        内存占用与文件夹大小无关。没有完成清单时以同名json文件判断是否完成；
+        有完成清单时只查询清单，单张图片的请求出错记为失败并继续处理其余图片。
+        分片输出（JsonlSink / ParquetSink）无法按图片判断是否完成，重新运行时需要完成清单或 remove_source。
+
+        Args:
+            folder_path (str): 图片文件夹
+            return_results (bool): 是否收集并返回所有结果，处理超大文件夹时建议设为 False
+            queue_size (int): 各阶段之间队列的容量
+            encode_workers (int): 编码阶段的并发数，默认为 CPU 核数
+            retry_failed (bool): 只重试完成清单中该文件夹下失败的图片，不扫描文件夹，需要 manifest
+            images (Iterable[str]): 代替扫描结果的图片路径，例如只处理某个分片中的图片
+
+        Returns:
+            list | int: return_results 为 True 时返回结果列表，否则返回处理的图片数量
+        """
+        if retry_failed and self.manifest is None:
+            raise ValueError("retry_failed needs a manifest")
         results = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = [executor.submit(self.prompt_one, image_paths[i]) for i in range(len(image_paths))]
-            for future in tqdm(concurrent.futures.as_completed(futures),
-                             total=len(futures),
-                             desc="处理图片中"):
-                results.append(future.result())
-        return results
+        # 禁用进度条（TQDM_DISABLE）时 tqdm 不计数，处理数量单独统计
+        processed = 0
+        progress = tqdm(desc="处理图片中")
+        manifest = self.manifest
+        hash_contents = manifest is not None and manifest.hash_contents
+
+        def skip_done(image_path: str):
+            if manifest is not None:
+                if not manifest.is_done(image_path):
+                    return image_path
+            elif not self.sink.is_done(image_path):
+                return image_path
 
-    def prompt_folder(self, folder_path: str) -> str:
-        # 遍历文件夹中的所有图片，移除有同名json文件的图片并调用prompt_images
-        image_paths = []
-        for file in os.listdir(folder_path):
-            if file.endswith(".jpg") or file.endswith(".png") or file.endswith(".jpeg") or file.endswith(".webp"):
-                json_path = file.replace(".jpg", ".json").replace(".png", ".json").replace(".jpeg", ".json").replace(".webp", ".json")
-                if not os.path.exists(json_path):
-                    image_paths.append(os.path.join(folder_path, file))
-        return self.prompt_images(image_paths)
+        def done():
+            nonlocal processed
+            processed += 1
+            progress.update()
 
+        def failed(image_path: str, content_hash: Optional[str], e: Exception):
+            # 没有清单时出错终止整个任务；有清单时记为失败，继续处理其余图片
+            if manifest is None:
+                raise e
+            self.record(image_path, None, content_hash, error=repr(e))
+            done()
 
-class MultiGLM4V_Mongo:
-    def __init__(self, api_keys: list[str] | str, mongo_url: str, max_workers: int = 64, model: str = "glm-4v-plus-0111"):
+        async def encode(image_path: str):
+            try:
+                content_hash = await asyncio.to_thread(hash_file, image_path) if hash_contents else None
+                return image_path, content_hash, await self.clients[0].aencode_image(image_path)
+            except Exception as e:
+                failed(image_path, None, e)
+
+        async def request(item):
+            image_path, content_hash, encoded = item
+            try:
+                return image_path, content_hash, await self.arequest(image_path, encoded=encoded)
+            except Exception as e:
+                failed(image_path, content_hash, e)
+
+        def write(item):
+            image_path, content_hash, prompt_result = item
+            result = self.save_result(image_path, prompt_result, content_hash)
+            done()
+            if return_results:
+                results.append(result)
+
+        if images is not None:
+            source = images
+        elif retry_failed:
+            source = manifest.paths(STATUS_ERROR, prefix=folder_path)
+        else:
+            source = scan_images(folder_path)
+        try:
+            await run_pipeline(source, [
+                (skip_done, 8),
+                (encode, encode_workers or os.cpu_count() or 4),
+                (request, self.max_concurrency),
+                (write, 4),
+            ], queue_size=queue_size)
+        finally:
+            progress.close()
+            await asyncio.to_thread(self.sink.flush)
+        return results if return_results else processed
+
+    def prompt_folder(self, folder_path: str, return_results: bool = True, retry_failed: bool = False,
+                      images: Optional[Iterable[str]] = None) -> str:
+        # 遍历文件夹中的所有图片，跳过已完成的图片并处理
+        return run_sync(self.aprompt_folder(folder_path, return_results=return_results, retry_failed=retry_failed,
+                                            images=images))
+
+    async def aprompt_urls(self, urls: Iterable[str], return_results: bool = True, queue_size: int = 64):
+        """
+        以流式流水线处理图片URL，结果写入 sink（URL 没有同名json文件，需使用 JsonlSink / ParquetSink）
+
+        Args:
+            urls (Iterable[str]): 图片URL，可以是逐行读取文件的生成器
+            return_results (bool): 是否收集并返回所有结果
+            queue_size (int): 各阶段之间队列的容量
+
+        Returns:
+            list | int: return_results 为 True 时返回结果列表，否则返回处理的URL数量
+        """
+        if isinstance(self.sink, JsonFileSink):
+            raise ValueError("urls need a sharded sink, e.g. JsonlSink")
+        results = []
+        processed = 0
+        progress = tqdm(desc="处理图片中")
+        manifest = self.manifest
+
+        def skip_done(url: str):
+            if manifest is None or not manifest.is_done(url):
+                return url
+
+        def done():
+            nonlocal processed
+            processed += 1
+            progress.update()
+
+        async def request(url: str):
+            try:
+                return url, await self.arequest(url, is_url=True)
+            except Exception as e:
+                if manifest is None:
+                    raise
+                self.record(url, None, error=repr(e))
+                done()
+
+        def write(item):
+            url, prompt_result = item
+            result = self.save_result(url, prompt_result)
+            done()
+            if return_results:
+                results.append(result)
+
+        try:
+            await run_pipeline(urls, [(skip_done, 8), (request, self.max_concurrency), (write, 4)], queue_size=queue_size)
+        finally:
+            progress.close()
+            await asyncio.to_thread(self.sink.flush)
+        return results if return_results else processed
+
+    def prompt_urls(self, urls: Iterable[str], return_results: bool = True) -> list:
+        return run_sync(self.aprompt_urls(urls, return_results=return_results))
+
+    def prompt_images_batch(self, image_paths: Iterable[str], work_dir: str = "caption_batches", wait: bool = True,
+                            **kwargs) -> dict:
+        """
+        通过 Batch API 离线处理图片，结果与 prompt_images 一样写入 sink 并记入完成清单
+
+        Args:
+            image_paths (Iterable[str]): 图片路径，为空时只继续 work_dir 中未完成的 batch
+            work_dir (str): batch 文件与状态的保存目录，中断后以同一目录重新运行即可继续
+            wait (bool): 是否等待所有 batch 结束
+            **kwargs: 传给 BatchRunner，例如 max_requests、poll_interval
+
+        Returns:
+            dict: 各状态的 batch 数量
+        """
+        def on_result(image_path: str, prompt_result: dict):
+            self.save_result(image_path, prompt_result)
+
+        if self.manifest is not None:
+            image_paths = (path for path in image_paths if not self.manifest.is_done(path))
+        runner = BatchRunner(self.clients, on_result, work_dir=work_dir, **kwargs)
+        try:
+            return runner.run(image_paths, wait=wait)
+        finally:
+            runner.close()
+            self.sink.flush()
+
+
+class MultiGLM4V_Mongo(AsyncMultiGLM4V):
+    def __init__(self, api_keys: list[str] | str, mongo_url: str, max_workers: int = 64, model: str = "glm-4v-plus-0111",
+                 key_pool: Optional[KeyPool] = None, cache: Optional[CaptionCache] = None,
+                 preprocessor: Optional[ImagePreprocessor] = None, fetcher: Optional[PicFetcher] = None,
+                 prefetch: int = 64, download_workers: int = 16, adaptive: bool = False,
+                 hedge: Optional[HedgePolicy] = None, dedup: Optional["NearDuplicateCache"] = None):
+        # fetcher 默认从 picollect/armwm 下载；下载在独立线程池中进行，提前 prefetch 个任务开始下载
+        # adaptive 为 True 时在途请求数按 AIMD 自动调整，max_workers 为其上限；hedge、dedup 见 AsyncMultiGLM4V
+        self.fetcher = fetcher or HfPicsFetcher()
+        self.prefetch = prefetch
+        self.download_pool = concurrent.futures.ThreadPoolExecutor(max_workers=download_workers)
         self.mongo_init(mongo_url)
-        api_keys = self.get_accounts(api_keys)
-        self.clients = [ZhipuAI(api_key=api_key) for api_key in api_keys]
+        if key_pool is None:
+            api_keys = self.get_accounts(api_keys)
+        super().__init__(api_keys, max_concurrency=max_workers, model=model, key_pool=key_pool, cache=cache,
+                         preprocessor=preprocessor, adaptive=adaptive, hedge=hedge, dedup=dedup)
         self.max_workers = max_workers
-        self.account_counts = len(self.clients)
-        for i in range(self.account_counts):
-            self.clients[i] = GLM4V(api_key=api_keys[i], model=model)
+        self.draining = False
+
+    def drain(self):
+        """让 run / arun 停止领取新任务，处理完已领取的任务后返回，可在信号处理函数中调用"""
+        self.draining = True
 
     def get_accounts(self, api_keys: int):
-        if isinstance(api_keys, str):
-            if '\n' in api_keys:
-                api_keys = convert_str_to_list(api_keys)
-            else:
-                api_keys = [api_keys]
-        return api_keys
+        return get_api_keys(api_keys)
 
     def mongo_init(self, mongo_url: str):
         from pymongo import MongoClient
         mongo_client = MongoClient(mongo_url)
         art_db = mongo_client.get_database("art")
         self.caption_collection = art_db.get_collection("caption")
+        # 结果由后台线程批量写入，避免每张图片一次网络往返
+        self.writer = BulkWriter(self.caption_collection)
+        # 任务通过租约原子地领取，多个节点可共用同一个集合
+        self.task_queue = TaskQueue(self.caption_collection)
 
-    def get_tasks(self) -> dict:
-        self.tasks = list(self.caption_collection.aggregate([
-            {"$match": {"status": 0}},  # 匹配未处理的文档
-            {"$sample": {"size": 100}}  # 随机获取100个文档
-        ]))
+    def get_tasks(self, size: int = 100) -> dict:
+        self.tasks = self.task_queue.lease_many(size)
 
     def get_pic(self, task_id: int) -> str:
-        from hfpics import HfPics
-        # 或使用自定义配置
-        hf = HfPics(
-            repo="picollect/armwm",  # 自定义数据集仓库
-            cache_dir="/kaggle/working/pics"   # 自定义缓存目录
-        )
-        return hf.pic(task_id)
+        return self.fetcher.fetch(task_id)
 
-    def prompt_one(self, task_id: int) -> str:
-        import random
-        account_index = random.randint(0, self.account_counts - 1)
-        prompt_result = self.clients[account_index].prompt(self.get_pic(task_id))
+    def download(self, task_id: int) -> asyncio.Future:
+        # 在下载线程池中获取图片，与请求并行
+        return asyncio.get_running_loop().run_in_executor(self.download_pool, self.get_pic, task_id)
+
+    def save_result(self, task_id: int, prompt_result: dict, image_path: Optional[str] = None):
         if prompt_result:
+            # 结果写入后清理缓存图片
+            def on_written():
+                self.fetcher.evict(task_id, image_path)
+
+            if "incomplete" in prompt_result:
+                # 没能补全的结果（incomplete）保留已有字段，状态记为 500，之后重新处理
+                self.writer.update({'_id': task_id}, {'$set': dict(prompt_result, status=500)}, upsert=True,
+                                   on_written=on_written)
+                return
             result = {}
             for k,v in prompt_result.items():
                 if k == 'nsfw':
                     status = 403
-                    self.caption_collection.update_one({'_id': task_id}, {'$set': {'status': status}}, upsert=True)
+                    self.writer.update({'_id': task_id}, {'$set': {'status': status}}, upsert=True, on_written=on_written)
                     return
                 if k == 'error':
                     status = 500
-                    self.caption_collection.update_one({'_id': task_id}, {'$set': {'status': status}}, upsert=True)
+                    self.writer.update({'_id': task_id}, {'$set': {'status': status}}, upsert=True, on_written=on_written)
                     return
                 result[k] = v
             result['status'] = 200
-            self.caption_collection.update_one({'_id': task_id}, {'$set': result}, upsert=True)
+            self.writer.update({'_id': task_id}, {'$set': result}, upsert=True, on_written=on_written)
+
+    def save_error(self, task_id: int, error: Exception, image_path: Optional[str] = None):
+        # 单个任务出错（图片缺失、非过载的接口错误等）记为 500 并记录错误，不再被重新领取
+        log.warning("task %s failed: %r", task_id, error)
+        metrics.inc("caption_task_errors_total", reason=type(error).__name__)
+
+        def on_written():
+            self.fetcher.evict(task_id, image_path)
+
+        self.writer.update({'_id': task_id}, {'$set': {'status': 500, 'error': repr(error)}}, upsert=True,
+                           on_written=on_written)
+
+    def prompt_one(self, task_id: int) -> str:
+        image_path = self.get_pic(task_id)
+        prompt_result = self.request(image_path)
+        self.save_result(task_id, prompt_result, image_path)
+
+    async def aprompt_task(self, task_id: int, image_path: Optional[str] = None):
+        # 下载图片是阻塞操作，放到线程池中执行，避免阻塞事件循环；写库只是放入后台写入队列
+        try:
+            if image_path is None:
+                image_path = await self.download(task_id)
+            prompt_result = await self.aprompt_one(image_path)
+        except Exception as e:
+            self.save_error(task_id, e, image_path)
+            return
+        self.save_result(task_id, prompt_result, image_path)
+
+    async def aprompt_images(self) -> list:
+        await asyncio.to_thread(self.get_tasks)
+        try:
+            return await self.gather([self.aprompt_task(task['_id']) for task in self.tasks])
+        finally:
+            # 下一批任务按 status 取，需要先确保本批结果已经写入
+            await asyncio.to_thread(self.writer.flush)
 
     def prompt_images(self) -> str:
-        self.get_tasks()
-        # image_path_dict的键是图片位置，值是图片的描述
-        results = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = [executor.submit(self.prompt_one, task['_id']) for task in self.tasks]
-            for future in tqdm(concurrent.futures.as_completed(futures),
-                             total=len(futures),
-                             desc="处理图片中"):
-                results.append(future.result())
-        return results
\ No newline at end of file
+        return run_sync(self.aprompt_images())
+
+    async def arun(self, max_tasks: Optional[int] = None, stop_when_empty: bool = True,
+                   poll_interval: float = 5.0, lease_batch: int = 16) -> int:
+        """
+        持续领取并处理任务，处理完一个立即补充一个，不再等待整批中最慢的图片
+
+        Args:
+            max_tasks (int): 最多处理的任务数，None 表示不限
+            stop_when_empty (bool): 没有待处理任务时是否退出，为 False 时每隔 poll_interval 秒重新查询
+            poll_interval (float): 没有任务时的查询间隔（秒）
+            lease_batch (int): 每次领取的任务数
+
+        Returns:
+            int: 处理的任务数量
+        """
+        # 领取的任务立即开始下载，缓冲 prefetch 个任务，下载始终领先请求
+        buffer = asyncio.Queue(self.prefetch)
+        processed = 0
+        progress = tqdm(desc="处理图片中")
+        leased = set()
+
+        async def feed():
+            count = 0
+            while (max_tasks is None or count < max_tasks) and not self.draining:
+                size = lease_batch if max_tasks is None else min(lease_batch, max_tasks - count)
+                tasks = await asyncio.to_thread(self.task_queue.lease_many, size)
+                if not tasks:
+                    if stop_when_empty:
+                        break
+                    await asyncio.sleep(poll_interval)
+                    continue
+                for task in tasks:
+                    leased.add(task['_id'])
+                    await buffer.put((task['_id'], self.download(task['_id'])))
+                count += len(tasks)
+            for _ in range(self.max_concurrency):
+                await buffer.put(None)
+
+        async def worker():
+            nonlocal processed
+            while True:
+                item = await buffer.get()
+                if item is None:
+                    return
+                task_id, download = item
+                try:
+                    image_path = await download
+                except Exception as e:
+                    # 下载失败的任务同样记为 500，不中断整个 run
+                    self.save_error(task_id, e)
+                else:
+                    await self.aprompt_task(task_id, image_path)
+                leased.discard(task_id)
+                processed += 1
+                progress.update()
+
+        async def heartbeat():
+            # 已领取的任务可能在缓冲区、并发队列或 key 冷却中等待超过租约时长，
+            # 定期为所有未完成的任务续约，避免被其他节点重新领取而重复处理
+            while True:
+                await asyncio.sleep(self.task_queue.lease_seconds / 3)
+                if leased:
+                    await asyncio.to_thread(self.task_queue.renew, list(leased))
+
+        tasks = [asyncio.ensure_future(feed())] + [asyncio.ensure_future(worker()) for _ in range(self.max_concurrency)]
+        renewing = asyncio.ensure_future(heartbeat())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            renewing.cancel()
+            for task in tasks:
+                task.cancel()
+            progress.close()
+            await asyncio.to_thread(self.writer.flush)
+            # 中途退出时归还尚未完成的任务
+            await asyncio.to_thread(self.task_queue.release, leased)
+        return processed
+
+    def run(self, max_tasks: Optional[int] = None, stop_when_empty: bool = True, poll_interval: float = 5.0,
+            lease_batch: int = 16) -> int:
+        return run_sync(self.arun(max_tasks=max_tasks, stop_when_empty=stop_when_empty, poll_interval=poll_interval,
+                                  lease_batch=lease_batch))
+
+    def close(self):
+        self.writer.close()
+        self.download_pool.shutdown(wait=False)
@@ -0,0 +1,90 @@
+import collections
+import threading
+from typing import Optional
+
+
+class HedgePolicy:
+    def __init__(self, percentile: float = 0.95, budget: float = 0.05, min_samples: int = 50, window: int = 1000,
+                 min_delay: float = 1.0, max_burst: float = 10.0):
+        """
+        对冲请求的触发条件与额度
+
+        请求耗时超过最近 window 个成功请求耗时的 percentile 分位数时，在另一个密钥上发出相同的请求，
+        取先返回的有效结果并取消另一个。每个请求积累 budget 个额度，每次对冲消耗 1 个，
+        对冲请求占总请求数的比例不超过 budget；额度最多积累 max_burst 个，允许短时间集中对冲。
+
+        Args:
+            percentile (float): 触发对冲的耗时分位数
+            budget (float): 对冲请求占总请求数的比例上限，例如 0.05 表示最多多花 5%
+            min_samples (int): 积累到该数量的耗时样本之前不对冲
+            window (int): 计算分位数使用的最近样本数
+            min_delay (float): 对冲前最少等待的秒数
+            max_burst (float): 额度的积累上限
+        """
+        if not 0 < percentile < 1:
+            raise ValueError("percentile must be in (0, 1)")
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_burst = max_burst
+        self.latencies = collections.deque(maxlen=window)
+        self.credits = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self._lock = threading.Lock()
+        self._delay: Optional[float] = None
+        self._stale = True
+
+    def observe(self, latency: float):
+        """记录一次成功请求的耗时"""
+        with self._lock:
+            self.latencies.append(latency)
+            self._stale = True
+
+    def delay(self) -> Optional[float]:
+        """
+        新请求开始时调用：积累额度，返回多少秒后仍未完成时对冲，None 表示样本不足、不对冲
+        """
+        with self._lock:
+            self.requests += 1
+            self.credits = min(self.max_burst, self.credits + self.budget)
+            if len(self.latencies) < self.min_samples:
+                return None
+            if self._stale:
+                # 分位数在新样本到来后才重新计算，并发很高时避免每个请求都排序
+                ordered = sorted(self.latencies)
+                self._delay = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+                self._stale = False
+            return max(self.min_delay, self._delay)
+
+    def try_spend(self) -> bool:
+        """额度足够时扣除一次对冲的额度"""
+        with self._lock:
+            if self.credits < 1:
+                return False
+            self.credits -= 1
+            self.hedges += 1
+            return True
+
+    def refund(self):
+        # try_spend 之后没有发出对冲请求，退还额度
+        with self._lock:
+            self.credits = min(self.max_burst, self.credits + 1)
+            self.hedges -= 1
+
+    def won(self):
+        # 对冲请求先于原请求返回有效结果
+        with self._lock:
+            self.wins += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "wins": self.wins,
+                "delay": round(self._delay, 3) if self._delay is not None else None,
+                "credits": round(self.credits, 2),
+            }
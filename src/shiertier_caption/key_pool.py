@@ -0,0 +1,292 @@
+import asyncio
+import random
+import threading
+import time
+from typing import List, Optional
+try:
+    from .concurrency import AIMDLimit
+except:
+    from concurrency import AIMDLimit
+
+# 所有密钥都达到并发上限时，等待在途请求结束的轮询间隔（秒）
+SATURATED_WAIT = 0.05
+
+# 智谱：1302 并发过高，1303 频率过高，1305 服务过载（HTTP 状态码为 429）
+OVERLOAD_CODES = ("1302", "1303", "1305")
+
+
+def error_code(e: Exception) -> Optional[str]:
+    """
+    API 返回的错误码，例如智谱的 "1305"，没有时为 None
+
+    OpenAI SDK 的异常带有 code 属性；智谱 SDK 的异常只有响应，错误码在响应体的 error.code 中。
+    """
+    code = getattr(e, "code", None)
+    if code is None:
+        response = getattr(e, "response", None)
+        try:
+            body = response.json() if response is not None else None
+        except Exception:
+            body = None
+        if isinstance(body, dict):
+            error = body.get("error", body)
+            code = error.get("code") if isinstance(error, dict) else None
+    return str(code) if code is not None else None
+
+
+def is_overload_error(e: Exception) -> bool:
+    """判断异常是否为服务过载 / 限流错误，这类错误应换一个密钥立即重试；只看 HTTP 状态码与错误码，不匹配错误信息"""
+    if getattr(e, "status_code", None) == 429:
+        return True
+    return error_code(e) in OVERLOAD_CODES
+
+
+def mask_key(api_key: str) -> str:
+    # 统计信息中只展示密钥的首尾，避免泄露
+    if len(api_key) <= 8:
+        return "***"
+    return f"{api_key[:4]}...{api_key[-4:]}"
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        """
+        令牌桶限速器
+
+        Args:
+            per_minute (float): 每分钟补充的令牌数
+            capacity (float): 桶容量，默认等于 per_minute，即允许一分钟的突发
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float = 1, now: Optional[float] = None) -> float:
+        """距离可以取出 amount 个令牌还需等待的秒数，0 表示可以立即取出"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        # 单次请求超过桶容量时按桶满处理，避免永远无法取出
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float = 1):
+        # amount 为负数时退还令牌，例如实际用量低于预估时
+        self.tokens = min(self.capacity, self.tokens - min(amount, self.capacity))
+
+
+class KeyState:
+    def __init__(self, client, weight: float = 1.0, rpm: Optional[float] = None, tpm: Optional[float] = None,
+                 limit: Optional[AIMDLimit] = None):
+        self.client = client
+        self.api_key = client.api_key
+        self.weight = weight
+        self.rpm_bucket = TokenBucket(rpm) if rpm else None
+        self.tpm_bucket = TokenBucket(tpm) if tpm else None
+        self.limit = limit  # 该密钥的在途请求上限，None 表示不限制
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.consecutive_overloads = 0
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.overloads = 0
+        self.tokens = 0
+        self.latency = None  # 成功请求耗时的指数移动平均（秒）
+
+    def saturated(self) -> bool:
+        return self.limit is not None and self.in_flight >= self.limit.value
+
+    def wait_time(self, tokens: float, now: float) -> float:
+        wait = max(0.0, self.cooldown_until - now)
+        if self.rpm_bucket:
+            wait = max(wait, self.rpm_bucket.wait_time(1, now))
+        if self.tpm_bucket and tokens:
+            wait = max(wait, self.tpm_bucket.wait_time(tokens, now))
+        return wait
+
+    def stats(self, now: Optional[float] = None) -> dict:
+        now = time.monotonic() if now is None else now
+        return {
+            "key": mask_key(self.api_key),
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "overloads": self.overloads,
+            "tokens": self.tokens,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "cooldown": round(max(0.0, self.cooldown_until - now), 3),
+            "limit": self.limit.value if self.limit is not None else None,
+        }
+
+
+class KeyPool:
+    def __init__(
+        self,
+        clients: list,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        weights: Optional[List[float]] = None,
+        tokens_per_request: int = 3000,
+        base_cooldown: float = 10.0,
+        max_cooldown: float = 600.0,
+        max_in_flight: Optional[int] = None,
+        adaptive: bool = False,
+    ):
+        """
+        按健康状况调度 API 密钥的密钥池，可由多个多密钥客户端共享
+
+        每个密钥带有 RPM / TPM 令牌桶，按 在途请求数 / 权重 选择负载最低的健康密钥；
+        返回过载或限流错误的密钥进入指数退避冷却，请求立即换到其他密钥重试。
+
+        Args:
+            clients (list): 客户端列表，例如 GLM4V 实例，需要有 api_key 属性
+            rpm (float): 每个密钥每分钟的请求数上限，None 表示不限制
+            tpm (float): 每个密钥每分钟的 token 数上限，None 表示不限制
+            weights (list[float]): 各密钥的权重，默认均为 1
+            tokens_per_request (int): 单次请求预估消耗的 token 数，用于 TPM 限速
+            base_cooldown (float): 首次过载的冷却秒数，连续过载时翻倍
+            max_cooldown (float): 冷却秒数上限
+            max_in_flight (int): 每个密钥同时在途的请求数上限，None 表示不限制
+            adaptive (bool): 每个密钥的在途上限按 AIMD 自动调整（从 4 开始，不超过 max_in_flight，默认 256），
+                过载时减半，健康时逐步增加
+        """
+        if not clients:
+            raise ValueError("clients must not be empty")
+        weights = weights or [1.0] * len(clients)
+        if len(weights) != len(clients):
+            raise ValueError("weights must have the same length as clients")
+        self.keys = [KeyState(client, weight, rpm, tpm, self._key_limit(client, max_in_flight, adaptive))
+                     for client, weight in zip(clients, weights)]
+        self.tokens_per_request = tokens_per_request
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key_limit(client, max_in_flight: Optional[int], adaptive: bool) -> Optional[AIMDLimit]:
+        if adaptive:
+            max_limit = max_in_flight or 256
+            return AIMDLimit(initial=min(4, max_limit), max_limit=max_limit, scope="key", key=mask_key(client.api_key))
+        if max_in_flight:
+            # 固定上限：不增不减
+            return AIMDLimit(initial=max_in_flight, min_limit=max_in_flight, max_limit=max_in_flight,
+                             scope="key", key=mask_key(client.api_key))
+        return None
+
+    @property
+    def clients(self) -> list:
+        return [key.client for key in self.keys]
+
+    def try_acquire(self, exclude: Optional[KeyState] = None) -> tuple[Optional[KeyState], float]:
+        """
+        尝试取出一个可用密钥
+
+        Args:
+            exclude (KeyState): 不取该密钥，例如对冲请求需要换一个密钥
+
+        Returns:
+            tuple: (密钥状态, 0)；没有可用密钥时返回 (None, 最短等待秒数)
+        """
+        tokens = self.tokens_per_request
+        with self._lock:
+            now = time.monotonic()
+            ready = []
+            min_wait = float("inf")
+            for key in self.keys:
+                if key is exclude:
+                    continue
+                wait = key.wait_time(tokens, now)
+                if wait <= 0 and key.saturated():
+                    wait = SATURATED_WAIT
+                if wait <= 0:
+                    ready.append(key)
+                else:
+                    min_wait = min(min_wait, wait)
+            if not ready:
+                return None, min_wait
+            # 有上限的密钥按占用比例比较，没有上限时按 在途数 / 权重
+            lowest = min(self._load(key) for key in ready)
+            key = random.choice([key for key in ready if self._load(key) == lowest])
+            if key.rpm_bucket:
+                key.rpm_bucket.take(1)
+            if key.tpm_bucket:
+                key.tpm_bucket.take(tokens)
+            key.in_flight += 1
+            key.requests += 1
+            return key, 0.0
+
+    @staticmethod
+    def _load(key: KeyState) -> float:
+        if key.limit is not None:
+            return key.in_flight / key.limit.value / key.weight
+        return key.in_flight / key.weight
+
+    def acquire(self, exclude: Optional[KeyState] = None) -> KeyState:
+        # 同步版本，没有可用密钥时阻塞等待
+        while True:
+            key, wait = self.try_acquire(exclude)
+            if key:
+                return key
+            time.sleep(wait)
+
+    async def aacquire(self, exclude: Optional[KeyState] = None) -> KeyState:
+        # 异步版本，等待期间不阻塞事件循环
+        while True:
+            key, wait = self.try_acquire(exclude)
+            if key:
+                return key
+            await asyncio.sleep(wait)
+
+    def release(self, key: KeyState, ok: bool = True, overloaded: bool = False, tokens: int = 0,
+                latency: Optional[float] = None, cancelled: bool = False):
+        """
+        归还密钥并更新健康状态
+
+        Args:
+            key (KeyState): acquire 取出的密钥
+            ok (bool): 请求是否成功
+            overloaded (bool): 是否返回了过载 / 限流错误，为 True 时密钥进入冷却
+            tokens (int): 本次请求实际消耗的 token 数，TPM 限速按其与预估值的差额补扣或退还，0 表示未知
+            latency (float): 本次请求耗时（秒）
+            cancelled (bool): 请求被取消（例如对冲中落后的请求），不计入成功或失败
+        """
+        with self._lock:
+            in_flight = key.in_flight
+            key.in_flight -= 1
+            key.tokens += tokens
+            if tokens and key.tpm_bucket:
+                key.tpm_bucket.take(tokens - self.tokens_per_request)
+            if cancelled:
+                return
+            if key.limit is not None:
+                if overloaded:
+                    key.limit.on_overload()
+                elif ok:
+                    key.limit.on_success(in_flight, latency)
+            if latency is not None:
+                key.latency = latency if key.latency is None else key.latency * 0.8 + latency * 0.2
+            if overloaded:
+                key.overloads += 1
+                key.consecutive_overloads += 1
+                cooldown = min(self.base_cooldown * 2 ** (key.consecutive_overloads - 1), self.max_cooldown)
+                key.cooldown_until = time.monotonic() + cooldown
+            elif ok:
+                key.successes += 1
+                key.consecutive_overloads = 0
+            else:
+                key.failures += 1
+
+    def stats(self) -> List[dict]:
+        """各密钥的运行时统计信息"""
+        with self._lock:
+            now = time.monotonic()
+            return [key.stats(now) for key in self.keys]
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator, Optional
+
+# 与 Mongo 任务的 status 取值一致
+STATUS_PENDING = 0
+STATUS_DONE = 200
+STATUS_NSFW = 403
+STATUS_ERROR = 500
+COMPLETED = (STATUS_DONE, STATUS_NSFW)
+
+
+def result_status(prompt_result: Optional[dict]) -> int:
+    # 解析结果对应的状态：nsfw -> 403，error、没能补全（incomplete）或空结果 -> 500，其余 -> 200
+    if not prompt_result or "error" in prompt_result or "incomplete" in prompt_result:
+        return STATUS_ERROR
+    if "nsfw" in prompt_result:
+        return STATUS_NSFW
+    return STATUS_DONE
+
+
+class Manifest:
+    def __init__(self, path: str = "caption_manifest.sqlite3", hash_contents: bool = True):
+        """
+        文件夹任务的完成清单，持久化在本地 SQLite 文件中
+
+        每张图片记录 路径、内容哈希、状态、模型、尝试次数；中断后重新运行时每个文件只需一次主键查询，
+        失败的图片保留原图并记为 500，可以只重试失败的图片而不重新扫描整个文件夹。
+
+        Args:
+            path (str): SQLite 文件路径
+            hash_contents (bool): 是否记录图片内容的 sha256，关闭可以省去一次文件读取
+        """
+        self.path = path
+        self.hash_contents = hash_contents
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 多个进程可以共用同一个清单文件，写入时等待其他进程释放锁
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            "path TEXT PRIMARY KEY, hash TEXT, status INTEGER NOT NULL, model TEXT, "
+            "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS manifest_status ON manifest (status)")
+
+    @staticmethod
+    def key(image_path: str) -> str:
+        # 本地路径统一为绝对路径，相对路径与绝对路径指向同一条记录；URL 原样保存
+        if "://" in image_path:
+            return image_path
+        return os.path.abspath(image_path)
+
+    def status(self, image_path: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM manifest WHERE path = ?", (self.key(image_path),)).fetchone()
+        return row[0] if row else None
+
+    def is_done(self, image_path: str) -> bool:
+        return self.status(image_path) in COMPLETED
+
+    def record(self, image_path: str, status: int, model: Optional[str] = None, content_hash: Optional[str] = None,
+               error: Optional[str] = None):
+        """记录一次处理结果，尝试次数加一；content_hash 为 None 时保留已有的哈希"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO manifest (path, hash, status, model, attempts, error, updated) VALUES (?, ?, ?, ?, 1, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET hash = COALESCE(excluded.hash, hash), status = excluded.status, "
+                "model = excluded.model, attempts = attempts + 1, error = excluded.error, updated = excluded.updated",
+                (self.key(image_path), content_hash, status, model, error, time.time()),
+            )
+
+    def get(self, image_path: str) -> Optional[dict]:
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM manifest WHERE path = ?", (self.key(image_path),))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column[0] for column in cursor.description], row))
+
+    def paths(self, status: int = STATUS_ERROR, prefix: Optional[str] = None, max_attempts: Optional[int] = None,
+              chunk_size: int = 1000) -> Iterator[str]:
+        """
+        按状态逐批产出图片路径，例如只重试失败的图片
+
+        Args:
+            status (int): 状态
+            prefix (str): 只产出该目录下的图片
+            max_attempts (int): 只产出尝试次数小于该值的图片，None 表示不限
+            chunk_size (int): 每次查询的数量，迭代期间不持有锁
+        """
+        prefix = os.path.join(self.key(prefix), "") if prefix else None
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT rowid, path, attempts FROM manifest WHERE status = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (status, last, chunk_size),
+                ).fetchall()
+            if not rows:
+                return
+            for rowid, path, attempts in rows:
+                last = rowid
+                if prefix and not path.startswith(prefix):
+                    continue
+                if max_attempts is not None and attempts >= max_attempts:
+                    continue
+                yield path
+
+    def stats(self) -> dict:
+        """各状态的图片数量"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM manifest GROUP BY status").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
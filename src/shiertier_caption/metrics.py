@@ -0,0 +1,186 @@
+import bisect
+import contextlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 23, 1 << 24)
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    def __init__(self, metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+def _label_key(labels: dict) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: Tuple, extra: Optional[Tuple] = None) -> str:
+    items = list(labels) + list(extra or ())
+    if not items:
+        return ""
+    body = ",".join(f'{k}="{str(v)}"'.replace("\n", " ") for k, v in items)
+    return "{" + body + "}"
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False, trace_path: Optional[str] = None):
+        """
+        描述流程的指标与追踪
+
+        记录计数器与直方图，可导出为 Prometheus 文本格式，或把每个请求写入 JSONL 追踪文件。
+        关闭时所有记录方法在第一行直接返回，开销可以忽略。
+
+        Args:
+            enabled (bool): 是否记录
+            trace_path (str): JSONL 追踪文件路径，None 表示不写追踪
+        """
+        self.enabled = enabled
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self._lock = threading.Lock()
+        self._trace_file = None
+        self._server = None
+        if trace_path:
+            self.open_trace(trace_path)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        # 仪表盘类指标（例如当前并发上限）直接覆盖
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[(name, _label_key(labels))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(BYTES_BUCKETS if name.endswith("_bytes") else SECONDS_BUCKETS)
+            histogram.observe(value)
+
+    def timer(self, name: str, **labels):
+        """记录代码块耗时的上下文管理器，关闭时返回空上下文"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def trace(self, event: str, **fields):
+        if not self.enabled or self._trace_file is None:
+            return
+        line = json.dumps({"ts": time.time(), "event": event, **fields}, ensure_ascii=False, default=str)
+        with self._lock:
+            self._trace_file.write(line + "\n")
+
+    def open_trace(self, trace_path: str):
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+            self._trace_file = open(trace_path, "a", encoding="utf-8", buffering=1 << 16)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            for (name, labels), value in counters:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), histogram in histograms:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9100, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        """在后台线程中启动 /metrics 接口，供 Prometheus 抓取"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        return self._server
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def close(self):
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+# 全局实例，默认关闭
+metrics = Metrics()
+
+
+def enable_metrics(prometheus_port: Optional[int] = None, trace_path: Optional[str] = None) -> Metrics:
+    """
+    打开全局指标记录
+
+    Args:
+        prometheus_port (int): 在该端口提供 Prometheus 文本格式的 /metrics 接口
+        trace_path (str): 把每个请求的追踪记录追加写入该 JSONL 文件
+    """
+    metrics.enabled = True
+    if trace_path:
+        metrics.open_trace(trace_path)
+    if prometheus_port:
+        metrics.serve(prometheus_port)
+    return metrics
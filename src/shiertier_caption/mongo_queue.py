@@ -0,0 +1,94 @@
+import datetime
+import os
+import socket
+import uuid
+from typing import Iterable, List, Optional
+
+# 任务状态：0 待处理，102 已租用（处理中），200 完成，403 nsfw，500 出错
+STATUS_PENDING = 0
+STATUS_LEASED = 102
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class TaskQueue:
+    def __init__(self, collection, worker_id: Optional[str] = None, lease_seconds: float = 600):
+        """
+        基于租约的 MongoDB 任务队列
+
+        通过 find_one_and_update 原子地把待处理任务标记为已租用，并记录租用者与到期时间，
+        多个节点可以同时从同一个集合取任务而不会重复处理；超时未完成的任务会被重新租出。
+
+        Args:
+            collection: pymongo 集合
+            worker_id (str): 租用者标识，默认为 主机名-进程号-随机串
+            lease_seconds (float): 租约时长，超过该时间未完成的任务可被其他租用者取走；
+                持有者可通过 renew 续约
+        """
+        self.collection = collection
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        self.collection.create_index([("status", 1), ("lease_expires", 1)])
+
+    def _now(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def lease(self) -> Optional[dict]:
+        """租用一个待处理或租约已过期的任务，没有任务时返回 None"""
+        from pymongo import ReturnDocument
+        now = self._now()
+        return self.collection.find_one_and_update(
+            {"$or": [
+                {"status": STATUS_PENDING},
+                {"status": STATUS_LEASED, "lease_expires": {"$lt": now}},
+            ]},
+            {"$set": {
+                "status": STATUS_LEASED,
+                "worker": self.worker_id,
+                "lease_expires": now + datetime.timedelta(seconds=self.lease_seconds),
+            }},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def lease_many(self, n: int) -> List[dict]:
+        tasks = []
+        for _ in range(n):
+            task = self.lease()
+            if task is None:
+                break
+            tasks.append(task)
+        return tasks
+
+    def renew(self, task_ids: Iterable) -> int:
+        """延长本租用者仍持有的任务的租约，返回续约的数量；长时间处理中的任务需要定期续约"""
+        task_ids = list(task_ids)
+        if not task_ids:
+            return 0
+        result = self.collection.update_many(
+            {"_id": {"$in": task_ids}, "status": STATUS_LEASED, "worker": self.worker_id},
+            {"$set": {"lease_expires": self._now() + datetime.timedelta(seconds=self.lease_seconds)}},
+        )
+        return result.modified_count
+
+    def release(self, task_ids: Iterable):
+        """归还本租用者尚未完成的任务，例如进程退出前"""
+        task_ids = list(task_ids)
+        if not task_ids:
+            return
+        self.collection.update_many(
+            {"_id": {"$in": task_ids}, "status": STATUS_LEASED, "worker": self.worker_id},
+            {"$set": {"status": STATUS_PENDING}, "$unset": {"worker": "", "lease_expires": ""}},
+        )
+
+    def reclaim_expired(self) -> int:
+        """把所有租约已过期的任务重置为待处理，返回重置的数量"""
+        result = self.collection.update_many(
+            {"status": STATUS_LEASED, "lease_expires": {"$lt": self._now()}},
+            {"$set": {"status": STATUS_PENDING}, "$unset": {"worker": "", "lease_expires": ""}},
+        )
+        return result.modified_count
@@ -0,0 +1,153 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Callable, List, Optional
+try:
+    from .metrics import metrics
+except:
+    from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+_FLUSH = object()
+_STOP = object()
+
+
+class BulkWriter:
+    def __init__(self, collection, batch_size: int = 500, flush_interval: float = 1.0, max_retries: int = 5,
+                 retry_interval: float = 1.0):
+        """
+        后台批量写入 MongoDB
+
+        写入请求先进入缓冲队列，由后台线程按数量或时间窗口合并为无序 bulk_write；
+        失败的批次按指数退避重试，程序退出时自动写入剩余数据。
+
+        Args:
+            collection: pymongo 集合
+            batch_size (int): 每批最多的写操作数量
+            flush_interval (float): 最长缓冲时间（秒），到时即使未满一批也写入
+            max_retries (int): 单批最大重试次数，仍失败的操作保存在 failed 中
+            retry_interval (float): 首次重试等待秒数，之后翻倍
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.written = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed: List = []
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="mongo-bulk-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def update(self, filter: dict, update: dict, upsert: bool = True, on_written: Optional[Callable] = None):
+        """
+        缓冲一条 update_one，参数与 collection.update_one 相同
+
+        on_written 在该操作成功写入后于后台线程中调用，例如清理已完成任务的缓存图片
+        """
+        from pymongo import UpdateOne
+        if self._closed:
+            raise RuntimeError("BulkWriter is closed")
+        self._queue.put((UpdateOne(filter, update, upsert=upsert), on_written))
+
+    def flush(self):
+        """立即写入缓冲区中的数据，并等待全部写入完成"""
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        ops = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = _FLUSH
+            else:
+                if item is _FLUSH or item is _STOP:
+                    # 控制标记本身也需要 task_done，flush 才能等到它
+                    self._queue.task_done()
+                else:
+                    ops.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+            if ops and (item is _FLUSH or item is _STOP or len(ops) >= self.batch_size):
+                self._write(ops)
+                for _ in ops:
+                    self._queue.task_done()
+                ops = []
+                deadline = None
+            if item is _STOP:
+                return
+
+    def _write(self, ops: list):
+        from pymongo.errors import BulkWriteError
+        pending = ops
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+                metrics.inc("caption_retries_total", reason="mongo_write")
+                time.sleep(self.retry_interval * 2 ** (attempt - 1))
+            try:
+                with metrics.timer("caption_write_seconds", sink="mongo"):
+                    self.collection.bulk_write([op for op, _ in pending], ordered=False)
+            except BulkWriteError as e:
+                # 无序写入中只有部分操作失败，仅重试失败的操作
+                failed = {error["index"] for error in e.details.get("writeErrors", [])}
+                log.warning("bulk write partially failed: %d of %d ops", len(failed), len(pending))
+                self.written += len(pending) - len(failed)
+                self._written([op for i, op in enumerate(pending) if i not in failed])
+                pending = [op for i, op in enumerate(pending) if i in failed]
+                if not pending:
+                    break
+            except Exception:
+                log.exception("bulk write failed, attempt %d", attempt + 1)
+            else:
+                self.written += len(pending)
+                self._written(pending)
+                pending = []
+                break
+        self.batches += 1
+        if pending:
+            log.error("dropping %d ops after %d retries, kept in BulkWriter.failed", len(pending), self.max_retries)
+            metrics.inc("caption_write_failures_total", len(pending), sink="mongo")
+            self.failed.extend(op for op, _ in pending)
+
+    def _written(self, ops: list):
+        for _, on_written in ops:
+            if on_written is None:
+                continue
+            try:
+                on_written()
+            except Exception:
+                log.exception("on_written callback failed")
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "retries": self.retries,
+            "failed": len(self.failed),
+        }
@@ -0,0 +1,75 @@
+import asyncio
+import os
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+IMAGE_EXTENSIONS = (".jpg", ".png", ".jpeg", ".webp")
+
+_DONE = object()
+
+
+def json_path_for(image_path: str) -> str:
+    # 图片同名的 json 文件路径
+    return image_path.replace(".jpg", ".json").replace(".png", ".json").replace(".jpeg", ".json").replace(".webp", ".json")
+
+
+def scan_images(folder_path: str) -> Iterator[str]:
+    """使用 os.scandir 逐个产出文件夹中的图片路径，不会一次性列出整个目录"""
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                yield entry.path
+
+
+async def run_pipeline(source: Iterable, stages: List[Tuple[Callable, int]], queue_size: int = 256, batch_size: int = 64):
+    """
+    以有界队列串联的流式流水线
+
+    source 在线程中按批次迭代，避免阻塞事件循环；每个阶段由若干个协程并发处理，
+    阶段之间的队列有容量上限，下游变慢时上游自动等待，内存占用与输入规模无关。
+
+    Args:
+        source (Iterable): 输入数据，例如 scan_images 生成器
+        stages (list): (处理函数, 并发数) 列表；处理函数可以是协程函数或普通函数（在线程中执行），
+            返回 None 表示丢弃该条数据，否则传给下一阶段
+        queue_size (int): 每个阶段输入队列的容量
+        batch_size (int): 每次从 source 中读取的数量
+    """
+    queues = [asyncio.Queue(queue_size) for _ in stages]
+
+    async def close(index: int):
+        for _ in range(stages[index][1]):
+            await queues[index].put(_DONE)
+
+    async def feed():
+        iterator = iter(source)
+        while True:
+            batch = await asyncio.to_thread(lambda: list(islice(iterator, batch_size)))
+            if not batch:
+                break
+            for item in batch:
+                await queues[0].put(item)
+        await close(0)
+
+    async def worker(index: int, func: Callable):
+        is_coroutine = asyncio.iscoroutinefunction(func)
+        while True:
+            item = await queues[index].get()
+            if item is _DONE:
+                return
+            output = await func(item) if is_coroutine else await asyncio.to_thread(func, item)
+            if output is not None and index + 1 < len(stages):
+                await queues[index + 1].put(output)
+
+    async def run_stage(index: int, func: Callable, workers: int):
+        await asyncio.gather(*[worker(index, func) for _ in range(workers)])
+        if index + 1 < len(stages):
+            await close(index + 1)
+
+    tasks = [asyncio.ensure_future(feed())]
+    tasks += [asyncio.ensure_future(run_stage(i, func, workers)) for i, (func, workers) in enumerate(stages)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,161 @@
+import asyncio
+import base64
+import concurrent.futures
+import io
+import logging
+import mmap
+import os
+import threading
+from typing import NamedTuple, Optional
+
+log = logging.getLogger(__name__)
+
+FORMATS = {"jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP"}
+
+
+class EncodedImage(NamedTuple):
+    data: str  # base64 编码后的图片
+    mime: str
+    original_size: int
+    encoded_size: int
+
+    @property
+    def saved(self) -> int:
+        return self.original_size - self.encoded_size
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime};base64,{self.data}"
+
+
+def guess_mime(path: str) -> str:
+    # 按扩展名推断图片类型
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    return "image/jpeg" if ext in ("jpg", "jpeg") else f"image/{ext}"
+
+
+def read_image_file(path: str) -> EncodedImage:
+    """读取原图并转换为 base64，不做任何处理"""
+    with open(path, "rb") as f:
+        data = f.read()
+    return EncodedImage(base64.b64encode(data).decode("utf-8"), guess_mime(path), len(data), len(data))
+
+
+def encode_image_file(path: str, max_side: Optional[int] = 2048, format: str = "jpeg", quality: int = 90) -> EncodedImage:
+    """
+    缩放并重新编码图片，返回 base64 结果
+
+    文件通过内存映射读取；图片无需缩放且重新编码后反而更大时，直接上传原图。
+    该函数在进程池中运行，需要保持为模块级函数以便序列化。
+
+    Args:
+        path (str): 图片路径
+        max_side (int): 最长边上限，None 表示不缩放
+        format (str): 重新编码的格式，jpeg 或 webp
+        quality (int): 编码质量
+
+    Returns:
+        EncodedImage: 编码结果
+    """
+    from PIL import Image
+
+    target = FORMATS[format.lower()]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        original_size = len(mm)
+        with Image.open(mm) as img:
+            source_format = img.format
+            resize = bool(max_side) and max(img.size) > max_side
+            if resize:
+                img.thumbnail((max_side, max_side), Image.LANCZOS)
+            if target == "JPEG" and img.mode != "RGB":
+                # JPEG 不支持透明通道，透明区域铺白底
+                rgba = img.convert("RGBA")
+                img = Image.new("RGB", rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel("A"))
+            elif target == "WEBP" and img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
+            buffer = io.BytesIO()
+            img.save(buffer, format=target, quality=quality)
+        encoded = buffer.getvalue()
+        if not resize and len(encoded) >= original_size and source_format:
+            return EncodedImage(
+                base64.b64encode(mm).decode("utf-8"),
+                Image.MIME.get(source_format, f"image/{source_format.lower()}"),
+                original_size,
+                original_size,
+            )
+    return EncodedImage(base64.b64encode(encoded).decode("utf-8"), Image.MIME[target], original_size, len(encoded))
+
+
+class ImagePreprocessor:
+    def __init__(self, max_side: Optional[int] = 2048, format: str = "jpeg", quality: int = 90, processes: Optional[int] = None):
+        """
+        上传前的图片预处理：按最长边缩放并以 JPEG / WebP 重新编码
+
+        编码在进程池中执行，事件循环与工作线程不会运行 CPU 密集的图片处理。
+
+        Args:
+            max_side (int): 最长边上限，None 表示不缩放
+            format (str): 重新编码的格式，jpeg 或 webp
+            quality (int): 编码质量
+            processes (int): 进程池大小，默认为 CPU 核数；0 表示在当前进程中编码
+        """
+        if format.lower() not in FORMATS:
+            raise ValueError(f"format must be one of {list(FORMATS)}")
+        self.max_side = max_side
+        self.format = format
+        self.quality = quality
+        self.processes = processes
+        self.images = 0
+        self.original_bytes = 0
+        self.encoded_bytes = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> Optional[concurrent.futures.ProcessPoolExecutor]:
+        if self.processes == 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+            return self._executor
+
+    def _record(self, path: str, encoded: EncodedImage) -> EncodedImage:
+        with self._lock:
+            self.images += 1
+            self.original_bytes += encoded.original_size
+            self.encoded_bytes += encoded.encoded_size
+        log.debug("preprocessed %s: %d -> %d bytes, saved %d", path, encoded.original_size, encoded.encoded_size, encoded.saved)
+        return encoded
+
+    def encode(self, path: str) -> EncodedImage:
+        args = (path, self.max_side, self.format, self.quality)
+        executor = self.executor
+        encoded = executor.submit(encode_image_file, *args).result() if executor else encode_image_file(*args)
+        return self._record(path, encoded)
+
+    async def aencode(self, path: str) -> EncodedImage:
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        args = (path, self.max_side, self.format, self.quality)
+        if executor:
+            encoded = await loop.run_in_executor(executor, encode_image_file, *args)
+        else:
+            encoded = await asyncio.to_thread(encode_image_file, *args)
+        return self._record(path, encoded)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "images": self.images,
+                "original_bytes": self.original_bytes,
+                "encoded_bytes": self.encoded_bytes,
+                "saved_bytes": self.original_bytes - self.encoded_bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
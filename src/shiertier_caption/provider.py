@@ -0,0 +1,234 @@
+import asyncio
+import contextvars
+import time
+from typing import Optional
+try:
+    from .repair_json import try_parse_json_object as repair_json
+    from .preprocess import EncodedImage, read_image_file
+    from .key_pool import error_code, is_overload_error, mask_key
+    from .metrics import metrics
+    from .schema import invalid_fields, field_prompt, merge_fields
+    from .cache import CaptionCache
+except:
+    from repair_json import try_parse_json_object as repair_json
+    from preprocess import EncodedImage, read_image_file
+    from key_pool import error_code, is_overload_error, mask_key
+    from metrics import metrics
+    from schema import invalid_fields, field_prompt, merge_fields
+    from cache import CaptionCache
+
+
+# 当前任务 / 线程中模型请求实际消耗的 token 数，caption 返回后由调用方取出并交给 KeyPool.release
+_request_tokens = contextvars.ContextVar("caption_request_tokens", default=0)
+
+
+def take_request_tokens() -> int:
+    """取出并清零当前任务中累计的 token 用量（包括补全字段的请求）"""
+    tokens = _request_tokens.get()
+    _request_tokens.set(0)
+    return tokens
+
+
+def parse_caption(response_content: str, model: str = "") -> dict:
+    # 所有模型的回答统一经过 repair_json 解析，解析失败返回 {"error": True}
+    with metrics.timer("caption_parse_seconds", model=model):
+        try:
+            old,new = repair_json(response_content)
+        except Exception as e:
+            print(e)
+            new = {"error": True}
+    if not new or new.get("error"):
+        metrics.inc("caption_parse_errors_total", model=model)
+    return new
+
+
+def request_outcome(e: Exception) -> str:
+    # 请求失败的分类：nsfw（1301）、busy（过载 / 限流）、error
+    if error_code(e) == "1301":
+        return "nsfw"
+    if is_overload_error(e):
+        return "busy"
+    return "error"
+
+
+class RepairOverloaded(Exception):
+    """
+    补全字段的请求遇到过载或限流
+
+    result 为已经得到的字段，fields 为仍需补全的字段；status_code 与 code 沿用原异常，
+    is_overload_error 与原异常的判断相同，调用方冷却密钥后用 complete_caption 在其他密钥上继续补全。
+    """
+
+    def __init__(self, result: dict, fields: list, cause: Exception):
+        super().__init__(f"overloaded while repairing {fields}: {cause}")
+        self.result = result
+        self.fields = fields
+        self.cause = cause
+        self.status_code = getattr(cause, "status_code", None)
+        self.code = error_code(cause)
+
+
+class CaptionProvider:
+    """
+    统一的图片描述接口，GLM4V、SiliconFlow 等模型客户端都实现该接口
+
+    caption / acaption 返回解析后的结果，格式与 GLM4V.prompt 相同；服务过载或限流时直接抛出异常，
+    由调用方（KeyPool、Router）换用其他密钥或模型重试。子类需要提供 api_key、model 与 preprocessor 属性。
+    """
+
+    api_key: str
+    model: str
+    preprocessor = None
+    cache = None
+    # Batch API 中每行请求的 url 与创建 batch 时的 endpoint
+    batch_endpoint = "/v1/chat/completions"
+    # 默认提示词的结果缺少字段时只针对这些字段补问的次数，0 表示不补全
+    field_repairs = 1
+
+    def encode_image(self, image_path: str) -> EncodedImage:
+        with metrics.timer("caption_encode_seconds"):
+            if self.preprocessor:
+                encoded = self.preprocessor.encode(image_path)
+            else:
+                encoded = read_image_file(image_path)
+        metrics.observe("caption_payload_bytes", len(encoded.data))
+        return encoded
+
+    async def aencode_image(self, image_path: str) -> EncodedImage:
+        # 读取与编码不在事件循环中执行：预处理交给进程池，原图读取交给线程
+        with metrics.timer("caption_encode_seconds"):
+            if self.preprocessor:
+                encoded = await self.preprocessor.aencode(image_path)
+            else:
+                encoded = await asyncio.to_thread(read_image_file, image_path)
+        metrics.observe("caption_payload_bytes", len(encoded.data))
+        return encoded
+
+    def cache_caption(self, result: dict, image_path_or_url: str, is_url: bool = False,
+                      image_hash: Optional[str] = None, **kwargs) -> dict:
+        """按 caption 的缓存键写入结果，例如在其他密钥上补全字段后的结果；参数与 cached_caption 相同"""
+        return self._cache_result(result, self._caption_cache_key(image_path_or_url, is_url, image_hash, **kwargs))
+
+    def cached_caption(self, image_path_or_url: str, is_url: bool = False, image_hash: Optional[str] = None,
+                       **kwargs) -> Optional[dict]:
+        """
+        以相同参数调用 caption 时的缓存结果，未命中或没有缓存时为 None，不发送请求
+
+        多密钥客户端在占用密钥与并发名额之前先查询，命中缓存的图片不消耗限速额度。
+        image_hash 为 CaptionCache.image_hash 的结果，kwargs 为 caption 的其余参数（prompt 等）。
+        """
+        return self._cache_get(self._caption_cache_key(image_path_or_url, is_url, image_hash, **kwargs))
+
+    def _caption_cache_key(self, image_path_or_url: str, is_url: bool, image_hash: Optional[str],
+                           **kwargs) -> Optional[str]:
+        # caption 使用的缓存键，子类按各自的请求参数实现
+        return None
+
+    def _cache_get(self, cache_key: Optional[str]) -> Optional[dict]:
+        if not cache_key:
+            return None
+        cached = self.cache.get(cache_key)
+        # 旧版本的缓存中可能是未解析的原始回答，忽略
+        return cached if isinstance(cached, dict) else None
+
+    def _cache_result(self, result: dict, cache_key: Optional[str] = None) -> dict:
+        # 只缓存成功解析的结果；没能补全的结果（incomplete）下次重新请求
+        if cache_key and result and not result.get("error") and "incomplete" not in result:
+            self.cache.set(cache_key, result)
+        return result
+
+    async def aimage_hash(self, image_path_or_url: str, is_url: bool = False) -> Optional[str]:
+        """缓存键使用的图片哈希，没有缓存时为 None；读取与哈希整个文件在线程中进行，不阻塞事件循环"""
+        if self.cache is None:
+            return None
+        if is_url:
+            return CaptionCache.image_hash(image_path_or_url, is_url)
+        return await asyncio.to_thread(CaptionCache.image_hash, image_path_or_url)
+
+    def complete_caption(self, image_path_or_url: str, result: dict, is_url: bool = False, **kwargs) -> dict:
+        """
+        默认提示词的结果缺少字段或字段格式不对时，用只包含这些字段的短提示词重新提问，并合并到原结果中
+
+        kwargs 传给 caption。补问遇到过载或限流时抛出 RepairOverloaded，其中带有已经得到的字段，
+        调用方冷却当前密钥后在其他密钥上只重试短提示词（见 AsyncMultiGLM4V）；
+        原结果没有任何有效字段时直接抛出原来的过载异常，与完整请求过载相同。
+        """
+        for _ in range(self.field_repairs):
+            fields = invalid_fields(result)
+            if not fields:
+                break
+            try:
+                repaired = self.caption(image_path_or_url, is_url=is_url, prompt=field_prompt(fields), **kwargs)
+            except Exception as e:
+                self._repair_failed(e, result, fields)
+                raise
+            result = self._merge_repair(result, repaired, fields)
+        return result
+
+    async def acomplete_caption(self, image_path_or_url: str, result: dict, is_url: bool = False,
+                                encoded: Optional[EncodedImage] = None, **kwargs) -> dict:
+        for _ in range(self.field_repairs):
+            fields = invalid_fields(result)
+            if not fields:
+                break
+            try:
+                repaired = await self.acaption(image_path_or_url, is_url=is_url, encoded=encoded,
+                                               prompt=field_prompt(fields), **kwargs)
+            except Exception as e:
+                self._repair_failed(e, result, fields)
+                raise
+            result = self._merge_repair(result, repaired, fields)
+        return result
+
+    def _repair_failed(self, e: Exception, result: dict, fields: list):
+        # 补问过载且已有可以保留的字段时改为抛出 RepairOverloaded；其他情况由调用方抛出原异常
+        if isinstance(e, RepairOverloaded) or not is_overload_error(e) or not result or "error" in result:
+            return
+        metrics.inc("caption_field_repairs_total", model=self.model, outcome="busy")
+        raise RepairOverloaded(result, fields, e) from e
+
+    def _merge_repair(self, result: dict, repaired: dict, fields: list) -> dict:
+        if repaired and "nsfw" in repaired:
+            return repaired
+        merged = merge_fields(result, repaired, fields)
+        missing = invalid_fields(merged)
+        metrics.inc("caption_field_repairs_total", model=self.model, outcome="partial" if missing else "ok")
+        metrics.inc("caption_repaired_fields_total", len(fields) - len(missing), model=self.model)
+        return merged
+
+    def _record_request(self, start: float, outcome: str, response=None):
+        # 记录单次模型请求的耗时、token 用量与结果，start 为 time.perf_counter()
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        total_tokens = getattr(usage, "total_tokens", 0) or prompt_tokens + completion_tokens
+        if total_tokens:
+            _request_tokens.set(_request_tokens.get() + total_tokens)
+        if not metrics.enabled:
+            return
+        latency = time.perf_counter() - start
+        labels = {"model": self.model, "key": mask_key(self.api_key)}
+        metrics.observe("caption_request_seconds", latency, **labels)
+        metrics.inc("caption_requests_total", outcome=outcome, **labels)
+        if usage is not None:
+            metrics.inc("caption_tokens_total", prompt_tokens, type="prompt", **labels)
+            metrics.inc("caption_tokens_total", completion_tokens, type="completion", **labels)
+        metrics.trace("request", latency=latency, outcome=outcome, prompt_tokens=prompt_tokens,
+                      completion_tokens=completion_tokens, **labels)
+
+    def caption(self, image_path_or_url: str, is_url: bool = False, **kwargs) -> dict:
+        raise NotImplementedError
+
+    def batch_body(self, image_path: str, encoded: Optional[EncodedImage] = None) -> dict:
+        """Batch API 中单个请求的 body，使用默认提示词；client 属性需要提供 files 与 batches 接口"""
+        raise NotImplementedError
+
+    async def acaption(self, image_path_or_url: str, is_url: bool = False,
+                       encoded: Optional[EncodedImage] = None, **kwargs) -> dict:
+        """
+        Args:
+            image_path_or_url (str): 图片的本地路径或URL
+            is_url (bool): 是否为URL链接
+            encoded (EncodedImage): 已经编码好的图片（见 aencode_image），传入时不再重复读取与编码
+        """
+        raise NotImplementedError
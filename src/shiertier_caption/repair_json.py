@@ -7,11 +7,87 @@ import json
 import logging
 import re
 import ast
+from typing import Optional
 
 from json_repair import repair_json
 
 log = logging.getLogger(__name__)
 
+# 字符串外需要关注的字符 / 字符串内需要关注的字符
+_TOKEN = re.compile(r'["{}\[\]]')
+_STRING_TOKEN = re.compile(r'["\\]')
+_FENCE = re.compile(r"```(?:json|JSON)?")
+_CLOSE = {"{": "}", "[": "]"}
+
+
+def _strip_trailing_comma(piece: str) -> str:
+    stripped = piece.rstrip()
+    if stripped.endswith(","):
+        return stripped[:-1]
+    return piece
+
+
+def extract_json_object(text: str) -> Optional[str]:
+    """
+    单次扫描提取最外层的 JSON 对象
+
+    跳过 markdown 代码块标记与前后的说明文字，按括号配对找到完整的最外层对象，
+    同时修复 LLM 输出中常见的问题：对象 / 数组末尾多余的逗号，以及输出被截断时
+    未闭合的字符串与括号。字符串中未转义的换行交给 json.loads(strict=False) 处理。
+
+    :return: 修复后的 JSON 字符串；找不到对象或括号不匹配时返回 None
+    """
+    fence = _FENCE.search(text)
+    start = text.find("{", fence.end()) if fence else -1
+    if start < 0:
+        start = text.find("{")
+    if start < 0:
+        return None
+
+    out = []
+    stack = []
+    in_string = False
+    segment = pos = start
+    length = len(text)
+    while True:
+        match = (_STRING_TOKEN if in_string else _TOKEN).search(text, pos)
+        if match is None:
+            break
+        i = match.start()
+        ch = text[i]
+        if in_string:
+            if ch == "\\":
+                pos = i + 2
+            else:
+                in_string = False
+                pos = i + 1
+            continue
+        pos = i + 1
+        if ch == '"':
+            in_string = True
+        elif ch in _CLOSE:
+            stack.append(_CLOSE[ch])
+        else:
+            if not stack or stack.pop() != ch:
+                return None
+            out.append(_strip_trailing_comma(text[segment:i]))
+            out.append(ch)
+            segment = pos
+            if not stack:
+                return "".join(out)
+
+    # 输出被截断：闭合字符串，去掉悬空的逗号 / 冒号，再补齐括号
+    # 末尾悬空的转义符会吞掉补上的引号，需要去掉
+    tail = text[segment:length - 1] if in_string and pos > length else text[segment:]
+    if in_string:
+        tail += '"'
+    tail = _strip_trailing_comma(tail)
+    if tail.rstrip().endswith(":"):
+        tail = tail.rstrip() + " null"
+    out.append(tail)
+    out.extend(reversed(stack))
+    return "".join(out)
+
 
 def try_parse_ast_to_json(function_string: str) -> tuple[str, dict]:
     """
@@ -37,7 +113,46 @@ def try_parse_ast_to_json(function_string: str) -> tuple[str, dict]:
     return ast_info, json_result
 
 
+def _loads_object(text: str) -> Optional[dict]:
+    try:
+        result = json.loads(text, strict=False)
+    except json.JSONDecodeError:
+        return None
+    return result if isinstance(result, dict) else None
+
+
 def try_parse_json_object(input: str) -> tuple[str, dict]:
+    """
+    解析 LLM 输出中的 JSON 对象
+
+    快速路径依次尝试：直接解析；截取代码块中第一个 { 到最后一个 } 解析；
+    extract_json_object 单次扫描修复后解析。都失败时才回退到 try_parse_json_object_fallback
+    （多轮字符串替换 + json_repair + ast）。
+    """
+    result = _loads_object(input)
+    if result:
+        return input, result
+
+    fence = _FENCE.search(input)
+    start = input.find("{", fence.end()) if fence else -1
+    if start < 0:
+        start = input.find("{")
+    end = input.rfind("}")
+    if 0 <= start < end:
+        candidate = input[start:end + 1]
+        result = _loads_object(candidate)
+        if result is not None:
+            return candidate, result
+
+    candidate = extract_json_object(input)
+    if candidate is not None:
+        result = _loads_object(candidate)
+        if result is not None:
+            return candidate, result
+    return try_parse_json_object_fallback(input)
+
+
+def try_parse_json_object_fallback(input: str) -> tuple[str, dict]:
     """JSON cleaning and formatting utilities."""
     # Sometimes, the LLM returns a json string with some extra description, this function will clean it up.
 
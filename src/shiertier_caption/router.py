@@ -0,0 +1,116 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Union
+try:
+    from .key_pool import KeyPool, KeyState
+except:
+    from key_pool import KeyPool, KeyState
+
+
+class ProviderHealth:
+    def __init__(self, name: str, pool: KeyPool, default_latency: float):
+        self.name = name
+        self.pool = pool
+        self.latency = default_latency  # 成功请求耗时的指数移动平均（秒）
+        self.error_rate = 0.0  # 过载 / 出错比例的指数移动平均
+        self.requests = 0
+        self.errors = 0
+
+    def weight(self, min_weight: float) -> float:
+        return max(min_weight, 1.0 - self.error_rate) / max(self.latency, 1e-3)
+
+
+class Router:
+    def __init__(self, pools: Union[Dict[str, KeyPool], List[KeyPool]], default_latency: float = 30.0,
+                 alpha: float = 0.2, min_weight: float = 0.02):
+        """
+        跨模型服务商的路由器，把同一个任务分摊到多个服务商（例如 GLM4V 与 SiliconFlow）及其密钥上
+
+        每个服务商对应一个 KeyPool；按实时的耗时与错误率为服务商加权随机选择，
+        某个服务商返回 1305 / 429 时其密钥进入冷却、权重下降，全部密钥冷却时流量自动切到其他服务商。
+        Router 与 KeyPool 的接口相同，可以直接作为 key_pool 传给 MultiGLM4V / MultiGLM4V_Mongo，
+        所有服务商的结果都通过 caption / acaption 解析为相同的格式。
+
+        Args:
+            pools (dict | list): 服务商名称到 KeyPool 的映射，或 KeyPool 列表
+            default_latency (float): 尚无成功请求时假定的耗时（秒）
+            alpha (float): 指数移动平均的系数，越大越偏向最近的请求
+            min_weight (float): 错误率很高的服务商保留的最小权重，用于探测其是否恢复
+        """
+        if isinstance(pools, list):
+            pools = {f"{pool.clients[0].__class__.__name__}-{i}": pool for i, pool in enumerate(pools)}
+        if not pools:
+            raise ValueError("pools must not be empty")
+        self.providers = [ProviderHealth(name, pool, default_latency) for name, pool in pools.items()]
+        self.alpha = alpha
+        self.min_weight = min_weight
+        self._owner = {id(key): provider for provider in self.providers for key in provider.pool.keys}
+        self._lock = threading.Lock()
+
+    @property
+    def clients(self) -> list:
+        return [client for provider in self.providers for client in provider.pool.clients]
+
+    def _ordered_providers(self) -> List[ProviderHealth]:
+        # 按权重的加权随机排列（Efraimidis-Spirakis）
+        with self._lock:
+            weighted = [(random.random() ** (1.0 / provider.weight(self.min_weight)), provider)
+                        for provider in self.providers]
+        weighted.sort(key=lambda item: item[0], reverse=True)
+        return [provider for _, provider in weighted]
+
+    def try_acquire(self, exclude: Optional[KeyState] = None) -> tuple[Optional[KeyState], float]:
+        min_wait = float("inf")
+        for provider in self._ordered_providers():
+            key, wait = provider.pool.try_acquire(exclude)
+            if key:
+                return key, 0.0
+            min_wait = min(min_wait, wait)
+        return None, min_wait
+
+    def acquire(self, exclude: Optional[KeyState] = None) -> KeyState:
+        while True:
+            key, wait = self.try_acquire(exclude)
+            if key:
+                return key
+            time.sleep(wait)
+
+    async def aacquire(self, exclude: Optional[KeyState] = None) -> KeyState:
+        while True:
+            key, wait = self.try_acquire(exclude)
+            if key:
+                return key
+            await asyncio.sleep(wait)
+
+    def release(self, key: KeyState, ok: bool = True, overloaded: bool = False, tokens: int = 0,
+                latency: Optional[float] = None, cancelled: bool = False):
+        provider = self._owner[id(key)]
+        provider.pool.release(key, ok=ok, overloaded=overloaded, tokens=tokens, latency=latency, cancelled=cancelled)
+        if cancelled:
+            return
+        failed = overloaded or not ok
+        with self._lock:
+            provider.requests += 1
+            provider.errors += failed
+            provider.error_rate += self.alpha * (failed - provider.error_rate)
+            if latency is not None and not failed:
+                provider.latency += self.alpha * (latency - provider.latency)
+
+    def stats(self) -> Dict[str, dict]:
+        """各服务商的耗时、错误率、当前权重与各密钥的统计信息"""
+        with self._lock:
+            summary = {
+                provider.name: {
+                    "latency": round(provider.latency, 3),
+                    "error_rate": round(provider.error_rate, 3),
+                    "weight": round(provider.weight(self.min_weight), 4),
+                    "requests": provider.requests,
+                    "errors": provider.errors,
+                }
+                for provider in self.providers
+            }
+        for provider in self.providers:
+            summary[provider.name]["keys"] = provider.pool.stats()
+        return summary
@@ -0,0 +1,66 @@
+"""
+默认提示词输出的 JSON 结构：字段校验、只补缺失字段的短提示词，以及补全结果的合并
+
+长提示词的回答被截断或某个字段格式不对时，只针对这些字段重新提问，
+不再重跑完整的多风格提示词，token 用量与耗时只有完整请求的一小部分。
+"""
+from typing import Dict, List, Optional
+
+# 字段名 -> (类型, 补全时给模型的说明)，字段名与默认提示词的输出格式一致（包括 midjoury 的拼写）
+CAPTION_FIELDS: Dict[str, tuple] = {
+    "regular": (str, "a one-paragraph summary mentioning every part, character, style, camera angle and composition"),
+    "midjoury": (list, "a list of Midjourney-style comma-separated phrases that still capture the interactions"),
+    "structural": (list, "a list that breaks the image down hierarchically in a hyper-structured way"),
+    "middle": (dict, "an object grouping up to 10 details by type, from macro to micro, from abstract to concrete"),
+    "creation": (list, "a list of steps explaining how to create this exact image"),
+    "deviantart request": (str, "a DeviantArt commission request describing exactly what you want, without greeting"),
+}
+
+FIELD_PROMPT = """Describe this image. Output only the following fields, each as its own independent description:
+{fields}
+If the image contains text or recognizable characters, mention them. Use an information dense style, never use euphemisms.
+
+# Output Format
+Output only JSON, do not output Python code or other information:
+{example}"""
+
+_EXAMPLES = {str: '"string"', list: "[list]", dict: "{type1:{},type2:{},...}"}
+
+
+def invalid_fields(result: Optional[dict]) -> List[str]:
+    """
+    默认提示词的结果中缺失或格式不对的字段，全部有效时为空列表
+
+    nsfw 结果不需要补全，返回空列表；解析失败（{"error": True} 或空结果）时所有字段都无效。
+    """
+    if result and "nsfw" in result:
+        return []
+    if not result or "error" in result:
+        return list(CAPTION_FIELDS)
+    return [name for name, (kind, _) in CAPTION_FIELDS.items()
+            if not isinstance(result.get(name), kind) or not result[name]]
+
+
+def field_prompt(fields: List[str]) -> str:
+    """只要求输出 fields 这几个字段的短提示词"""
+    described = "\n".join(f'- "{name}": {CAPTION_FIELDS[name][1]}' for name in fields)
+    example = "{" + ",".join(f'"{name}": {_EXAMPLES[CAPTION_FIELDS[name][0]]}' for name in fields) + "}"
+    return FIELD_PROMPT.format(fields=described, example=example)
+
+
+def merge_fields(partial: Optional[dict], repaired: Optional[dict], fields: List[str]) -> dict:
+    """
+    把补全请求中有效的字段合并到原结果
+
+    原结果中有效的字段保持不变；合并后仍有字段无效时保留已有的字段，
+    一个有效字段都没有时返回 {"error": True}。
+    """
+    merged = {} if not partial or "error" in partial else dict(partial)
+    if repaired and "error" not in repaired and "nsfw" not in repaired:
+        for name in fields:
+            value = repaired.get(name)
+            if isinstance(value, CAPTION_FIELDS[name][0]) and value:
+                merged[name] = value
+    if len(invalid_fields(merged)) == len(CAPTION_FIELDS):
+        return {"error": True}
+    return merged
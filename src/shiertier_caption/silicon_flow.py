@@ -2,11 +2,21 @@ from typing import Optional, Union, List
 import base64
 try:
     from .repair_json import try_parse_json_object as repair_json
+    from .aio import LoopLocal
+    from .cache import CaptionCache
+    from .preprocess import ImagePreprocessor, EncodedImage
+    from .provider import CaptionProvider, parse_caption, request_outcome
+    from .transport import HttpPool, default_http_pool
 except:
     from repair_json import try_parse_json_object as repair_json
+    from aio import LoopLocal
+    from cache import CaptionCache
+    from preprocess import ImagePreprocessor, EncodedImage
+    from provider import CaptionProvider, parse_caption, request_outcome
+    from transport import HttpPool, default_http_pool
 import json
 import time
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 def encode_image(image_path):
     with open(image_path, "rb") as image_file:
@@ -25,31 +35,45 @@ def _image_content(image_path):
         type = image_path.split(".")[-1]
         return f"data:image/{type};base64,{encode_image(image_path)}"
 
-def image_content(image_path):
+def image_content(image_path, preprocessor: Optional[ImagePreprocessor] = None):
     return {
         "type": "image_url",
         "image_url": {
-            "url": _image_content(image_path),
+            "url": preprocessor.encode(image_path).data_url if preprocessor else _image_content(image_path),
             "detail":"high"
         }
     }
 
-class SiliconFlow:
-    def __init__(self, api_key: str, model: str = "Qwen/Qwen2-VL-72B-Instruct"):
+class SiliconFlow(CaptionProvider):
+    def __init__(self, api_key: str, model: str = "Qwen/Qwen2-VL-72B-Instruct", cache: Optional[CaptionCache] = None,
+                 preprocessor: Optional[ImagePreprocessor] = None, http_pool: Optional[HttpPool] = None):
         """
         初始化 SiliconFlow 客户端
 
         Args:
             api_key (str): 硅基流动的 API key
             model (str): 模型名称，默认为 "Qwen/QVQ-72B-Preview"
+            cache (CaptionCache): 描述结果缓存，相同图片、模型与提示词直接返回缓存结果
+            preprocessor (ImagePreprocessor): 上传前的图片缩放与重新编码，默认上传原图
+            http_pool (HttpPool): HTTP 连接池，默认与其他客户端共用进程内的默认连接池
         """
+        self.http_pool = http_pool or default_http_pool()
+        self._http_slot = self.http_pool.slot()
         self.client = OpenAI(
             api_key=api_key, # 从https://cloud.siliconflow.cn/account/ak获取
-            base_url="https://api.siliconflow.cn/v1"
+            base_url="https://api.siliconflow.cn/v1",
+            http_client=self.http_pool.sync_client(self._http_slot),
+            # SDK 不自行重试，过载 / 限流错误立即交给 KeyPool 换用其他密钥
+            max_retries=0
         )
         self.api_key = api_key
         self.base_url = "https://api.siliconflow.cn/v1"
         self.model = model
+        self.cache = cache
+        self.preprocessor = preprocessor
+        self._aclient = LoopLocal(lambda: AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                                      http_client=self.http_pool.async_client(self._http_slot),
+                                                      max_retries=0))
 
         self.default_prompt = """Your task is to describe every aspect, object, and interaction within this image, such that a blind person could perfectly capture it within their imagination if read aloud. You need to do it multiple times, each one a different "style" of description.
 - In the regular/informal styles, use language that's relevant to the subject matter. Never use euphemisms. Describe it like the target audience of the image would (e.g. on an online forum where this image was shared).
@@ -69,7 +93,7 @@ Please output in JSON format with the following fields:
         is_url: bool = False
     ) -> str:
         """
-        对图片进行提问并获取回答
+        对图片进行提问并获取回答，不经过缓存（缓存在 caption 中按解析后的结果进行）
 
         Args:
             image_path_or_url (str): 图片的本地路径或URL
@@ -77,18 +101,117 @@ Please output in JSON format with the following fields:
             is_url (bool): 是否为URL链接，默认为False（即本地文件）
 
         Returns:
-            dict: 模型的回答
+            str: 模型的回答
         """
+        messages = self._build_messages(self._image_data(image_path_or_url, is_url), prompt)
+        start = time.perf_counter()
+        try:
+            response = self.client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        stream=False
+                )
+        except Exception as e:
+            self._record_request(start, request_outcome(e))
+            raise
+        self._record_request(start, "ok", response)
+        return response.choices[0].message.content
+
+    async def aprompt(
+        self,
+        image_path_or_url: str,
+        prompt: str = "",
+        is_url: bool = False,
+        encoded: Optional[EncodedImage] = None
+    ) -> str:
+        """
+        prompt 的异步版本，参数与返回值相同
+
+        encoded 为已经编码好的图片（见 aencode_image），传入时不再重复读取与编码图片。
+        """
+        if not is_url and encoded is None:
+            encoded = await self.aencode_image(image_path_or_url)
+        messages = self._build_messages(self._image_data(image_path_or_url, is_url, encoded), prompt)
+        start = time.perf_counter()
+        try:
+            response = await self.aclient.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=False
+            )
+        except Exception as e:
+            self._record_request(start, request_outcome(e))
+            raise
+        self._record_request(start, "ok", response)
+        return response.choices[0].message.content
+
+    def caption(self, image_path_or_url: str, is_url: bool = False, prompt: str = "",
+                image_hash: Optional[str] = None) -> dict:
+        # 与 GLM4V 一致，返回经过 repair_json 解析的结果，默认提示词缺少的字段单独补问；只缓存解析成功的结果
+        if self.cache is not None and image_hash is None:
+            image_hash = CaptionCache.image_hash(image_path_or_url, is_url)
+        cache_key = self._cache_key(image_path_or_url, prompt, is_url, image_hash)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        result = parse_caption(self.prompt(image_path_or_url, prompt=prompt, is_url=is_url), self.model)
+        if prompt in ("", self.default_prompt):
+            result = self.complete_caption(image_path_or_url, result, is_url=is_url, image_hash=image_hash)
+        return self._cache_result(result, cache_key)
+
+    async def acaption(self, image_path_or_url: str, is_url: bool = False,
+                       encoded: Optional[EncodedImage] = None, prompt: str = "",
+                       image_hash: Optional[str] = None) -> dict:
+        # 图片哈希在线程中只计算一次，补全字段的请求复用
+        if image_hash is None:
+            image_hash = await self.aimage_hash(image_path_or_url, is_url)
+        cache_key = self._cache_key(image_path_or_url, prompt, is_url, image_hash)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        result = parse_caption(await self.aprompt(image_path_or_url, prompt=prompt, is_url=is_url, encoded=encoded),
+                               self.model)
+        if prompt in ("", self.default_prompt):
+            result = await self.acomplete_caption(image_path_or_url, result, is_url=is_url, encoded=encoded,
+                                                  image_hash=image_hash)
+        return self._cache_result(result, cache_key)
+
+    def batch_body(self, image_path: str, encoded: Optional[EncodedImage] = None) -> dict:
+        return {"model": self.model, "messages": self._build_messages(self._image_data(image_path, False, encoded), ""),
+                "stream": False}
+
+    def _caption_cache_key(self, image_path_or_url: str, is_url: bool, image_hash: Optional[str], prompt: str = "",
+                           **kwargs) -> Optional[str]:
+        return self._cache_key(image_path_or_url, prompt, is_url, image_hash)
+
+    def _cache_key(self, image_path_or_url: str, prompt: str, is_url: bool, image_hash: Optional[str] = None) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return CaptionCache.make_key(image_path_or_url, self.model, prompt or self.default_prompt, None, is_url,
+                                     image_hash)
+
+    @property
+    def aclient(self):
+        # 异步客户端绑定事件循环，按循环懒加载
+        return self._aclient.get()
+
+    def _image_data(self, image_path_or_url: str, is_url: bool, encoded: Optional[EncodedImage] = None) -> dict:
+        # 准备图片数据，本地图片以 data URL 上传
+        url = image_path_or_url if is_url else (encoded or self.encode_image(image_path_or_url)).data_url
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": url,
+                "detail": "high"
+            }
+        }
+
+    def _build_messages(self, image_data: dict, prompt: str) -> list:
         if not prompt:
             prompt = self.default_prompt
 
-        # 准备图片数据
-        if is_url:
-            image_data = {"url": image_path_or_url}
-        else:
-            image_data = image_content(image_path_or_url)
         # 构建请求消息
-        messages = [{
+        return [{
             "role": "user",
             "content": [
                 image_data,
@@ -98,12 +221,6 @@ Please output in JSON format with the following fields:
                 }
             ]
         }]
-        response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    stream=False
-            )
-        return response.choices[0].message.content
 
 if __name__ == "__main__":
     silicon_flow = SiliconFlow("")
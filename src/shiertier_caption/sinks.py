@@ -0,0 +1,327 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+try:
+    from .metrics import metrics
+    from .pipeline import json_path_for
+except:
+    from metrics import metrics
+    from pipeline import json_path_for
+
+log = logging.getLogger(__name__)
+
+_FLUSH = object()
+_STOP = object()
+
+
+class Sink:
+    """
+    描述结果的输出位置
+
+    write 接收 (图片路径, 解析后的结果)；flush 返回时已写入的结果必须落盘。
+    on_written 在该结果落盘之后调用，例如记入完成清单；写入失败时不会调用。
+    """
+
+    def write(self, image_path: str, result: dict, on_written: Optional[Callable] = None):
+        raise NotImplementedError
+
+    def is_done(self, image_path: str) -> bool:
+        # 能否仅凭输出判断图片已完成，分片输出无法按图片查询，需要配合完成清单
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonFileSink(Sink):
+    def __init__(self, remove_source: bool = True):
+        """
+        每张图片一个同名json文件，与之前的输出格式相同
+
+        Args:
+            remove_source (bool): 写入后是否删除原图
+        """
+        self.remove_source = remove_source
+
+    def write(self, image_path: str, result: dict, on_written: Optional[Callable] = None):
+        with metrics.timer("caption_write_seconds", sink="json"):
+            with open(json_path_for(image_path), "w") as f:
+                json.dump(result, f)
+            if self.remove_source:
+                os.remove(image_path)
+        if on_written is not None:
+            on_written()
+
+    def is_done(self, image_path: str) -> bool:
+        return os.path.exists(json_path_for(image_path))
+
+
+class ShardedSink(Sink):
+    suffix = ""
+    name = "sharded"
+
+    def __init__(self, directory: str, prefix: str = "captions", records_per_shard: int = 100_000,
+                 batch_size: int = 1000, flush_interval: float = 1.0, remove_source: bool = False):
+        """
+        按记录数轮转的分片输出，由后台线程批量写入
+
+        结果先进入缓冲队列，后台线程按数量或时间窗口合并写入当前分片，写满 records_per_shard 条后
+        fsync 并换下一个分片。删除原图与 on_written 回调在其所在分片 fsync 之后进行，
+        进程崩溃不会丢失已删除原图或已记入完成清单的结果。写入出错时记录第一个错误，由 flush / close 抛出。
+        分片编号接着目录中已有的分片继续，重新运行不会覆盖；多个进程写同一目录时需使用不同的 prefix。
+
+        Args:
+            directory (str): 输出目录
+            prefix (str): 分片文件名前缀，分片为 {prefix}-00000{suffix}
+            records_per_shard (int): 每个分片的记录数
+            batch_size (int): 每批最多写入的记录数
+            flush_interval (float): 最长缓冲时间（秒）
+            remove_source (bool): 结果落盘后是否删除原图
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.records_per_shard = records_per_shard
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.remove_source = remove_source
+        self.written = 0
+        self.shards = 0
+        os.makedirs(directory, exist_ok=True)
+        self._index = self._next_index()
+        self._shard_records = 0
+        self._unsynced: List[Tuple[str, Optional[Callable]]] = []  # 当前分片中尚未 fsync 的 (原图, 回调)
+        self._error: Optional[BaseException] = None  # 上次 flush 之后第一个写入错误
+        self._shard_open = False
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-sink", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _next_index(self) -> int:
+        pattern = re.compile(rf"^{re.escape(self.prefix)}-(\d+){re.escape(self.suffix)}$")
+        indexes = [int(m.group(1)) for m in map(pattern.match, os.listdir(self.directory)) if m]
+        return max(indexes) + 1 if indexes else 0
+
+    @property
+    def shard_path(self) -> str:
+        return os.path.join(self.directory, f"{self.prefix}-{self._index:05d}{self.suffix}")
+
+    def write(self, image_path: str, result: dict, on_written: Optional[Callable] = None):
+        if self._closed:
+            raise RuntimeError(f"{self.__class__.__name__} is closed")
+        self._queue.put((image_path, result, on_written))
+
+    def flush(self):
+        """写入缓冲区中的结果并 fsync 当前分片，期间的写入错误在这里抛出"""
+        self._queue.put(_FLUSH)
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _failed(self, error: Exception, message: str, *args):
+        # 后台线程中的错误先记下来，由 flush / close 在调用方线程中抛出
+        log.error(message, *args, exc_info=error)
+        if self._error is None:
+            self._error = error
+
+    def _run(self):
+        # 与 BulkWriter 相同的缓冲方式：满一批或超过 flush_interval 即写入
+        records = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            else:
+                if item is not _FLUSH and item is not _STOP:
+                    records.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+            if records and (item is None or item is _FLUSH or item is _STOP or len(records) >= self.batch_size):
+                try:
+                    self._write_records(records)
+                except Exception as e:
+                    metrics.inc("caption_write_failures_total", len(records), sink=self.name)
+                    self._failed(e, "failed to write %d records to %s", len(records), self.shard_path)
+                for _ in records:
+                    self._queue.task_done()
+                records = []
+                deadline = None
+            if item is _FLUSH or item is _STOP:
+                try:
+                    self._sync(final=item is _STOP)
+                except Exception as e:
+                    self._failed(e, "failed to sync %s", self.shard_path)
+                # 控制标记在落盘之后才 task_done，flush 返回时结果已经落盘
+                self._queue.task_done()
+            if item is _STOP:
+                return
+
+    def _write_records(self, records: list):
+        with metrics.timer("caption_write_seconds", sink=self.name):
+            while records:
+                if not self._shard_open:
+                    self._open(self.shard_path)
+                    self._shard_open = True
+                chunk = records[:self.records_per_shard - self._shard_records]
+                records = records[len(chunk):]
+                self._append(chunk)
+                self._shard_records += len(chunk)
+                self.written += len(chunk)
+                self._unsynced.extend((image_path, on_written) for image_path, _, on_written in chunk)
+                if self._shard_records >= self.records_per_shard:
+                    self._rotate()
+
+    def _rotate(self):
+        # 关闭并 fsync 当前分片，下一批写入新的分片
+        self._close()
+        self._shard_open = False
+        self._shard_records = 0
+        self._index += 1
+        self.shards += 1
+        self._synced()
+
+    def _sync(self, final: bool = False):
+        if not self._shard_open:
+            return
+        if final:
+            self._rotate()
+        else:
+            self._fsync()
+            self._synced()
+
+    def _synced(self):
+        # 当前分片已经 fsync，删除原图并通知调用方
+        unsynced, self._unsynced = self._unsynced, []
+        for image_path, on_written in unsynced:
+            if self.remove_source:
+                try:
+                    os.remove(image_path)
+                except FileNotFoundError:
+                    pass
+            if on_written is not None:
+                try:
+                    on_written()
+                except Exception:
+                    log.exception("on_written callback failed")
+
+    def _open(self, path: str):
+        raise NotImplementedError
+
+    def _append(self, records: list):
+        raise NotImplementedError
+
+    def _fsync(self):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"pending": self._queue.qsize(), "written": self.written, "shards": self.shards}
+
+
+class JsonlSink(ShardedSink):
+    suffix = ".jsonl"
+    name = "jsonl"
+
+    def __init__(self, directory: str, prefix: str = "captions", records_per_shard: int = 100_000, **kwargs):
+        """
+        分片 JSONL 输出，每行为 {"path": 图片路径, "caption": 结果}，参数见 ShardedSink
+        """
+        self._file = None
+        super().__init__(directory, prefix=prefix, records_per_shard=records_per_shard, **kwargs)
+
+    def _open(self, path: str):
+        self._file = open(path, "w", encoding="utf-8")
+
+    def _append(self, records: list):
+        self._file.writelines(json.dumps({"path": image_path, "caption": result}, ensure_ascii=False) + "\n"
+                              for image_path, result, _ in records)
+
+    def _fsync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close(self):
+        self._fsync()
+        self._file.close()
+        self._file = None
+
+
+class ParquetSink(ShardedSink):
+    suffix = ".parquet"
+    name = "parquet"
+
+    def __init__(self, directory: str, prefix: str = "captions", records_per_shard: int = 100_000, **kwargs):
+        """
+        分片 Parquet 输出，列为 path 与 caption（结果的 JSON 字符串），每批写入一个 row group
+
+        Parquet 的文件尾在关闭时才写入，分片先写入 .tmp 文件，关闭并 fsync 后再改名；
+        因此 flush 会结束当前分片，频繁 flush 会产生较小的分片。
+        需要安装 pyarrow：pip install shiertier_caption[parquet]
+        """
+        import pyarrow as pa
+
+        self._schema = pa.schema([("path", pa.string()), ("caption", pa.string())])
+        self._writer = None
+        self._tmp_path: Optional[str] = None
+        super().__init__(directory, prefix=prefix, records_per_shard=records_per_shard, **kwargs)
+
+    def _open(self, path: str):
+        import pyarrow.parquet as pq
+
+        self._tmp_path = path + ".tmp"
+        self._writer = pq.ParquetWriter(self._tmp_path, self._schema, compression="zstd")
+
+    def _append(self, records: list):
+        import pyarrow as pa
+
+        self._writer.write_table(pa.table({
+            "path": [image_path for image_path, _, _ in records],
+            "caption": [json.dumps(result, ensure_ascii=False) for _, result, _ in records],
+        }, schema=self._schema))
+
+    def _sync(self, final: bool = False):
+        # 未关闭的 Parquet 文件不可读，落盘即结束当前分片
+        super()._sync(final=True)
+
+    def _fsync(self):
+        pass
+
+    def _close(self):
+        self._writer.close()
+        with open(self._tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(self._tmp_path, self._tmp_path[:-len(".tmp")])
+        self._writer = None
@@ -0,0 +1,104 @@
+import importlib.util
+import itertools
+import math
+import threading
+from typing import Optional
+try:
+    from .aio import LoopLocal
+except:
+    from aio import LoopLocal
+
+
+def http2_available() -> bool:
+    # httpx 的 HTTP/2 支持需要额外安装 h2：pip install shiertier_caption[http2]
+    return importlib.util.find_spec("h2") is not None
+
+
+class HttpPool:
+    def __init__(self, max_connections: int = 256, keepalive_expiry: float = 120.0, http2: Optional[bool] = None,
+                 timeout: float = 600.0, connect_timeout: float = 10.0, connections_per_client: int = 16):
+        """
+        多个客户端、多个密钥共用的 HTTP 连接池
+
+        每个密钥各自新建 ZhipuAI / AsyncOpenAI 客户端时，每个客户端都有独立的连接池，
+        同一个服务商的请求要为每个密钥分别建立 TCP 与 TLS 连接，事件循环每次重建时还要全部重新建立。
+        共用连接池后连接按主机复用，密钥只体现在每个请求的请求头中。
+
+        httpcore 每次分配连接都要遍历池中所有连接与排队的请求，单个池的连接数很多时 CPU 开销随并发平方增长，
+        因此连接分摊到若干个 httpx 客户端上，每个客户端最多 connections_per_client 个连接，
+        各个密钥通过 slot() 依次分到其中一个。
+
+        Args:
+            max_connections (int): 总连接数上限，一般与同时在途的请求数相同
+            keepalive_expiry (float): 空闲连接的保持时间（秒），描述请求间隔较长，默认比 httpx 的 5 秒长
+            http2 (bool): 是否使用 HTTP/2，None 表示安装了 h2 时使用
+            timeout (float): 读取超时（秒），长提示词的描述可能需要数分钟
+            connect_timeout (float): 建立连接的超时（秒）
+            connections_per_client (int): 每个 httpx 客户端的连接数
+        """
+        self.clients = max(1, math.ceil(max_connections / connections_per_client))
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2_available() if http2 is None else http2
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._slots = itertools.count()
+        self._sync_clients = {}
+        self._lock = threading.Lock()
+        # 每个事件循环结束时关闭在该循环上创建的客户端
+        self._async_clients = LoopLocal(dict, close=self._close_clients)
+
+    def slot(self) -> int:
+        """依次分配客户端编号，每个密钥取一次"""
+        return next(self._slots) % self.clients
+
+    def _new_client(self, asynchronous: bool = False):
+        import httpx
+
+        connections = math.ceil(self.max_connections / self.clients)
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections,
+                              keepalive_expiry=self.keepalive_expiry)
+        timeout = httpx.Timeout(self.timeout, connect=self.connect_timeout)
+        client_class = httpx.AsyncClient if asynchronous else httpx.Client
+        return client_class(limits=limits, timeout=timeout, http2=self.http2, follow_redirects=True)
+
+    def sync_client(self, slot: int = 0):
+        with self._lock:
+            if slot not in self._sync_clients:
+                self._sync_clients[slot] = self._new_client()
+            return self._sync_clients[slot]
+
+    def async_client(self, slot: int = 0):
+        # httpx.AsyncClient 绑定事件循环，按循环懒加载
+        clients = self._async_clients.get()
+        if slot not in clients:
+            clients[slot] = self._new_client(asynchronous=True)
+        return clients[slot]
+
+    def close(self):
+        with self._lock:
+            for client in self._sync_clients.values():
+                client.close()
+            self._sync_clients = {}
+
+    async def aclose(self):
+        """关闭当前事件循环上的异步客户端，run_sync 结束时对每个循环自动调用"""
+        await self._close_clients(self._async_clients.pop() or {})
+
+    @staticmethod
+    async def _close_clients(clients: dict):
+        for client in clients.values():
+            await client.aclose()
+
+
+_default_pool: Optional[HttpPool] = None
+_default_lock = threading.Lock()
+
+
+def default_http_pool() -> HttpPool:
+    """单独创建的客户端默认共用的连接池"""
+    global _default_pool
+    with _default_lock:
+        if _default_pool is None:
+            _default_pool = HttpPool()
+        return _default_pool
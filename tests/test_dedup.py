@@ -0,0 +1,42 @@
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from shiertier_caption.dedup import HammingIndex
+
+
+def _brute_force(hashes, value, threshold):
+    best = None
+    for row, h in enumerate(hashes):
+        distance = bin(h ^ value).count("1")
+        if distance <= threshold and (best is None or distance < best[1]):
+            best = (row, distance)
+    return best
+
+
+@pytest.mark.parametrize("threshold", [0, 1, 5, 15])
+def test_search_matches_brute_force(threshold):
+    rng = random.Random(threshold)
+    hashes = [rng.getrandbits(64) for _ in range(300)]
+    index = HammingIndex(threshold, buffer_size=64)
+    for h in hashes:
+        index.add(h)
+    for h in hashes[:50]:
+        flipped = h
+        for bit in rng.sample(range(64), min(threshold, 3)):
+            flipped ^= 1 << bit
+        found = index.search(flipped)
+        assert found is not None and found[1] == _brute_force(hashes, flipped, threshold)[1]
+
+
+def test_threshold_zero_uses_full_width_keys():
+    # threshold 为 0 时整个哈希是一段，高 32 位不同的哈希不能被当作相同
+    index = HammingIndex(0, buffer_size=4)
+    low = 0x12345678
+    index.extend(np.array([low, (1 << 63) | low, (1 << 40) | low], dtype=np.uint64))
+    assert index.search(low) == (0, 0)
+    assert index.search((1 << 63) | low) == (1, 0)
+    assert index.search((1 << 40) | low) == (2, 0)
+    assert index.search((1 << 41) | low) is None
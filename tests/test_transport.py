@@ -0,0 +1,43 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("httpx")
+
+from shiertier_caption.aio import run_sync
+from shiertier_caption.transport import HttpPool
+
+
+def test_async_clients_closed_per_loop_with_concurrent_run_sync():
+    pool = HttpPool(max_connections=32, connections_per_client=16)
+    created = []
+    new_client = pool._new_client
+
+    def track(asynchronous=False):
+        client = new_client(asynchronous)
+        created.append(client)
+        return client
+
+    pool._new_client = track
+    barrier = threading.Barrier(2)
+
+    async def use_pool():
+        clients = [pool.async_client(slot) for slot in range(pool.clients)]
+        # 两个循环同时持有各自的客户端，互不覆盖
+        await asyncio.to_thread(barrier.wait)
+        assert [pool.async_client(slot) for slot in range(pool.clients)] == clients
+        assert not any(client.is_closed for client in clients)
+        return clients
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(run_sync(use_pool()))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 2
+    assert not set(results[0]) & set(results[1])
+    assert len(created) == 2 * pool.clients
+    assert all(client.is_closed for client in created)